@@ -0,0 +1,69 @@
+from preprocess.dataset import Dataset
+from evaluation.metric import Metric
+from evaluation.runner import Runner
+import profiling
+from preprocess import resources
+import argparse
+import json
+import os
+import threading
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="HMM", choices=["HMM", "MEM", "seq2seq"])
+    parser.add_argument("--years", type=int, nargs="+", default=[2010, 2011, 2012, 2013, 2014, 2015])
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--out-dir", default="outputs")
+    parser.add_argument("--engine", default="python", choices=["python", "numpy"], help="HMM Viterbi decoder")
+    parser.add_argument("--compiled", action="store_true", help="use the compiled HMM.bin / MEM.bin tables")
+    parser.add_argument("--lm", default="bigram", choices=["bigram", "kn"], help="MEM: 2-gram tables or the Kneser-Ney exps_MEM/lm.bin")
+    parser.add_argument("--phrases", action="store_true", help="MEM: multi-word spans from exps_MEM/phrase_table.bin")
+    parser.add_argument("--beam-threshold", type=float, default=None, help="MEM: score margin to the best hypothesis, e.g. 10")
+    parser.add_argument("--distortion-limit", type=int, default=None, help="MEM: maximum reordering jump, e.g. 6")
+    parser.add_argument("--beam-width", type=int, default=None, help="HMM: states kept per position")
+    parser.add_argument("--beam-margin", type=float, default=None, help="HMM: log-prob margin to the best state")
+    parser.add_argument("--smoothing", action="store_true", help="HMM: backoff tables and OOV passthrough (python engine)")
+    parser.add_argument("--cache-size", type=int, default=0, help="translation cache entries per process, 0 disables it")
+    parser.add_argument("--cache-path", default=None, help="cache file kept between runs")
+    parser.add_argument("--shortlist", action="store_true", help="seq2seq: restrict the output vocabulary to exps_HMM/map.json candidates")
+    parser.add_argument("--profile", action="store_true", help="write stage timers / counters to <model>.profile.json")
+    parser.add_argument("--profile-sample", type=float, default=0.0, help="fraction of calls dumped as cProfile stats")
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable(args.profile_sample, os.path.join(args.out_dir, "profiles"))
+
+    options = {}
+    if args.model == "HMM":
+        options = {"engine": args.engine, "compiled": args.compiled,
+                   "beam_width": args.beam_width, "beam_margin": args.beam_margin, "smoothing": args.smoothing}
+    elif args.model == "MEM":
+        options = {"compiled": args.compiled, "lm": args.lm, "phrases": args.phrases,
+                   "beam_threshold": args.beam_threshold, "distortion_limit": args.distortion_limit}
+    elif args.model == "seq2seq":
+        options = {"shortlist": args.shortlist}
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    runner = Runner(args.model, args.workers, options, args.cache_size, args.cache_path)
+    # the metric segments with jieba, its dictionary is loaded while the first test set is translated
+    # (started after the pool has forked)
+    threading.Thread(target=resources.warmup, kwargs={"punkt": False, "jieba": True}, daemon=True).start()
+    metric = Metric()
+    report = {}
+    for year in args.years:
+        test_data = Dataset(type="test", year=year).get_all_item()
+        out_path = os.path.join(args.out_dir, f"{args.model}.tst{year}.zh")
+        preds, stats = runner.run([pair["en"] for pair in test_data], out_path)
+
+        target_gt = [pair["zh"] for pair in test_data]
+        stats["BLEU-1"] = metric.eval(pred=preds, target=target_gt)[1]
+        stats["BLEU-2"] = metric.eval_2(pred=preds, target=target_gt)[1]
+        stats["corpus BLEU-4"] = metric.bleu(pred=preds, target=target_gt)[1]
+        report[f"tst{year}"] = stats
+        print(f"tst{year}:", json.dumps(stats))
+    runner.close()
+
+    with open(os.path.join(args.out_dir, f"{args.model}.report.json"), 'w', encoding='utf8') as json_file:
+        json.dump(report, json_file, indent=2)
+    if args.profile:
+        with open(os.path.join(args.out_dir, f"{args.model}.profile.json"), 'w', encoding='utf8') as json_file:
+            json.dump(profiling.profiler.snapshot(), json_file, indent=2)
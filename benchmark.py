@@ -0,0 +1,318 @@
+'''
+Benchmark suite on a synthetic corpus (evaluation/fixtures.py), runs
+without the IWSLT data: table build time of every Dataset.build_* /
+generate_* step, model import / load time and resident memory, decode latency by
+source length, batch throughput of evaluation.runner.Runner and Metric
+scoring time. Everything runs in a scratch working directory.
+
+    python benchmark.py --size small --out outputs/benchmark.json
+    python benchmark.py --ambiguity high --models HMM HMM-numpy MEM
+    python benchmark.py --save-baseline outputs/benchmark.baseline.json
+    python benchmark.py --baseline outputs/benchmark.baseline.json --threshold 0.2
+
+With --baseline the results are compared entry by entry, entries more than
+--threshold worse than the baseline are listed and the exit status is 1.
+When HMM and HMM-numpy both run, the numpy engine (its Python and its
+vectorized steps) must translate the test set exactly like the python
+Viterbi, the exit status is 1 otherwise.
+'''
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+
+# MEM decodes without pruning by default, the benchmark measures the pruned decoder
+MEM_PRUNING = {"beam_threshold": 10.0, "distortion_limit": 6}
+MODELS = {"HMM": ("HMM", {}),
+          "HMM-numpy": ("HMM", {"engine": "numpy", "compiled": True}),
+          "MEM": ("MEM", {**MEM_PRUNING}),
+          "MEM-compiled": ("MEM", {"compiled": True, **MEM_PRUNING}),
+          "MEM-kn": ("MEM", {"compiled": True, "lm": "kn", **MEM_PRUNING}),
+          "MEM-phrases": ("MEM", {"compiled": True, "lm": "kn", "phrases": True, **MEM_PRUNING}),
+          "seq2seq": ("seq2seq", {"checkpoint": "exps_seq2seq/checkpoint.pt", "epoch": 1})}
+MODULES = {"HMM": "models.HMM", "MEM": "models.MEM", "seq2seq": "seq2seq"}
+LENGTH_BUCKETS = [(1, 10), (11, 20), (21, 40), (41, None)]
+HIGHER_IS_BETTER = {"sentences/s"}
+# differences below these are noise whatever the relative change
+NOISE_FLOOR = {"s": 0.005, "ms": 0.2, "MB": 2.0, "sentences/s": 0.0}
+
+
+def resident_memory():
+    '''
+    return:
+        resident set size in bytes (peak RSS where /proc is not available)
+    '''
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure_load(name, options):
+    '''
+    runs in a fresh process, the model module is imported first so that
+    only the tables / weights are counted
+    return:
+        import seconds, load seconds, resident memory growth in bytes
+    '''
+    begin = time.perf_counter()
+    from evaluation.runner import load_model
+    importlib.import_module(MODULES[name])
+    imported = time.perf_counter() - begin
+    rss = resident_memory()
+    begin = time.perf_counter()
+    model = load_model(name, dict(options))
+    seconds = time.perf_counter() - begin
+    growth = resident_memory() - rss
+    del model
+    return imported, seconds, growth
+
+
+class Bench:
+    def __init__(self, repeat=3):
+        self.repeat = repeat
+        self.results = {}
+
+    def record(self, name, value, unit):
+        self.results[name] = {"value": float(value), "unit": unit}
+        print(f"{name:<48} {value:12.4f} {unit}")
+
+    def time(self, name, function):
+        '''
+        one timed call (table builds write files, they are not repeated)
+        '''
+        begin = time.perf_counter()
+        result = function()
+        self.record(name, time.perf_counter() - begin, "s")
+        return result
+
+    def tables(self, workers):
+        from preprocess.dataset import Dataset
+        dst = self.time("tables/load corpus", Dataset)
+        self.time("tables/segment", dst.get_segments)
+        self.time("tables/build_vocab", dst.build_vocab)
+        self.time("tables/build_translate_table", dst.build_translate_table)
+        self.time("tables/build_language_model", dst.build_language_model)
+        self.time("tables/build_kn_language_model", dst.build_kn_language_model)
+        self.time(f"tables/build_phrase_table x{workers}", lambda: dst.build_phrase_table(workers=workers))
+        self.time("tables/generate_HMM_PI", dst.generate_HMM_PI)
+        self.time("tables/generate_HMM_A", dst.generate_HMM_A)
+        self.time("tables/generate_HMM_B", dst.generate_HMM_B)
+        self.time("tables/generate_map", dst.generate_map)
+        self.time(f"tables/build_all_tables x{workers}", lambda: dst.build_all_tables(workers))
+        self.time("tables/compile_tables", dst.compile_tables)
+
+    def train_seq2seq(self, options):
+        import seq2seq
+        model = seq2seq.Model(32, 64, 32, 64, 64)
+        self.time("train/seq2seq epoch", lambda: model.train(options["epoch"], 0.01, options["checkpoint"]))
+
+    def load(self, label, name, options):
+        context = multiprocessing.get_context("spawn")
+        measurements = []
+        for _ in range(self.repeat):
+            with context.Pool(1) as pool:
+                measurements.append(pool.apply(measure_load, (name, options)))
+        imported, seconds, growth = np.median(np.array(measurements), axis=0)
+        self.record(f"import/{label}", imported, "s")
+        self.record(f"load/{label}", seconds, "s")
+        self.record(f"memory/{label}", growth / (1 << 20), "MB")
+
+    def latency(self, label, model, sentences):
+        '''
+        best of `repeat` calls per sentence, p50 / p90 per source length bucket
+        '''
+        for s in sentences[:5]:
+            model.translate(s)
+        latencies = {bucket: [] for bucket in LENGTH_BUCKETS}
+        for s in sentences:
+            n = len(s.split())
+            bucket = next(b for b in LENGTH_BUCKETS if n >= b[0] and (b[1] is None or n <= b[1]))
+            best = None
+            for _ in range(self.repeat):
+                begin = time.perf_counter()
+                model.translate(s)
+                elapsed = time.perf_counter() - begin
+                best = elapsed if best is None else min(best, elapsed)
+            latencies[bucket].append(best * 1000)
+        for (lo, hi), values in latencies.items():
+            if values:
+                bucket = f"{lo}-{hi}" if hi is not None else f"{lo}+"
+                self.record(f"latency/{label}/{bucket} words p50", np.percentile(values, 50), "ms")
+                self.record(f"latency/{label}/{bucket} words p90", np.percentile(values, 90), "ms")
+
+    def throughput(self, label, name, options, sentences, workers):
+        from evaluation.runner import Runner
+        runner = Runner(name, workers, dict(options))
+        # workers load the model lazily, the warm-up waits for them
+        list(runner.iter_translate(sentences[:max(1, workers) * 8]))
+        begin = time.perf_counter()
+        preds = [pred if pred is not None else "" for pred, _, _ in runner.iter_translate(sentences)]
+        elapsed = time.perf_counter() - begin
+        runner.close()
+        self.record(f"throughput/{label} x{workers}", len(sentences) / elapsed, "sentences/s")
+        return preds
+
+    def metric(self, preds, targets):
+        '''
+        cold calls, the jieba memo is cleared before every one
+        '''
+        from evaluation.metric import Metric
+        from preprocess.segment import cut_zh_cached
+        metric = Metric()
+        for name, function in [("BLEU-1", metric.eval), ("BLEU-2", metric.eval_2), ("corpus BLEU-4", metric.bleu)]:
+            best = None
+            for _ in range(self.repeat):
+                cut_zh_cached.cache_clear()
+                begin = time.perf_counter()
+                function(pred=preds, target=targets)
+                elapsed = time.perf_counter() - begin
+                best = elapsed if best is None else min(best, elapsed)
+            self.record(f"metric/{name}", best, "s")
+
+
+def check_engines(sentences):
+    '''
+    return:
+        number of test sentences where a path of the numpy engine disagrees
+        with the python Viterbi
+    '''
+    from models.HMM import Model
+    expected = [Model().translate(s) for s in sentences]
+    model = Model(engine="numpy", compiled=True)
+    mismatches = 0
+    for small_step in [model.engine.small_step, 0]:
+        model.engine.small_step = small_step
+        mismatches += sum(model.translate(s) != pred for s, pred in zip(sentences, expected))
+    return mismatches
+
+
+def compare(results, baseline, threshold):
+    '''
+    return:
+        [(name, baseline value, value, relative change)], entries worse than the
+        baseline by more than threshold (and more than the noise floor of the unit)
+    '''
+    regressions = []
+    for name, entry in results.items():
+        if name not in baseline or baseline[name]["unit"] != entry["unit"]:
+            continue
+        old, new = baseline[name]["value"], entry["value"]
+        if old <= 0:
+            continue
+        worse = old - new if entry["unit"] in HIGHER_IS_BETTER else new - old
+        if worse / old > threshold and worse > NOISE_FLOOR.get(entry["unit"], 0.0):
+            regressions.append((name, old, new, worse / old))
+    return regressions
+
+
+def run(args):
+    from evaluation.fixtures import make_corpus
+    bench = Bench(args.repeat)
+    test = make_corpus(".", args.size, args.seed, ambiguity=args.ambiguity)
+    sentences = [pair["en"] for pair in test]
+    targets = [pair["zh"] for pair in test]
+
+    bench.tables(args.workers)
+    if "seq2seq" in args.models:
+        bench.train_seq2seq(MODELS["seq2seq"][1])
+
+    from evaluation.runner import load_model
+    preds = None
+    for label in args.models:
+        name, options = MODELS[label]
+        bench.load(label, name, options)
+        model = load_model(name, dict(options))
+        inputs = sentences
+        if name == "seq2seq":
+            # same as Runner: unknown words are dropped, empty sentences skipped
+            inputs = [" ".join(w for w in s.split() if w in model.en_word_2_index) for s in sentences]
+            inputs = [s for s in inputs if s]
+        bench.latency(label, model, inputs)
+        del model
+        for workers in sorted({1, args.workers}):
+            label_preds = bench.throughput(label, name, options, sentences, workers)
+        if preds is None:
+            preds = label_preds
+    if preds is not None:
+        bench.metric(preds, targets)
+    if "HMM" in args.models and "HMM-numpy" in args.models:
+        bench.record("check/HMM engine mismatches", check_engines(sentences), "sentences")
+    return bench.results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="small", choices=["small", "medium", "large"], help="synthetic corpus size")
+    parser.add_argument("--ambiguity", default="low", choices=["low", "high"],
+                        help="candidates per source word of the synthetic corpus, high is closer to real data")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--models", nargs="+", default=list(MODELS), choices=list(MODELS))
+    parser.add_argument("--workers", type=int, default=2, help="table builder / Runner processes")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions, the best / median is reported")
+    parser.add_argument("--work-dir", default=None, help="scratch directory, a temporary one by default")
+    parser.add_argument("--out", default="outputs/benchmark.json")
+    parser.add_argument("--baseline", default=None, help="results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown reported as a regression")
+    parser.add_argument("--save-baseline", default=None, help="also write the results there")
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    save_path = os.path.abspath(args.save_baseline) if args.save_baseline else None
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="mt-bench-")
+    if args.work_dir is not None and os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    # the models read their tables relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        results = run(args)
+    finally:
+        os.chdir(cwd)
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {"meta": {"size": args.size, "ambiguity": args.ambiguity, "seed": args.seed, "repeat": args.repeat, "workers": args.workers,
+                       "python": platform.python_version(), "platform": platform.platform(),
+                       "cpus": os.cpu_count(), "date": time.strftime("%Y-%m-%d %H:%M:%S")},
+              "results": results}
+    for path in [out, save_path]:
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, 'w', encoding='utf8') as json_file:
+                json.dump(report, json_file, indent=2)
+    print("saved", out)
+
+    mismatches = results.get("check/HMM engine mismatches", {"value": 0})["value"]
+    if mismatches:
+        print(f"ENGINE MISMATCH: the numpy HMM engine differs from the python one on {mismatches:.0f} sentences")
+        sys.exit(1)
+
+    if baseline_path is not None:
+        if not os.path.exists(baseline_path):
+            print(f"{args.baseline} Not Found.")
+            sys.exit(2)
+        with open(baseline_path, 'r', encoding='utf-8') as json_file:
+            baseline = json.load(json_file)
+        if baseline["meta"]["size"] != args.size:
+            print(f"warning: baseline size {baseline['meta']['size']}, this run {args.size}")
+        if baseline["meta"].get("ambiguity", "low") != args.ambiguity:
+            print(f"warning: baseline ambiguity {baseline['meta'].get('ambiguity', 'low')}, this run {args.ambiguity}")
+        regressions = compare(results, baseline["results"], args.threshold)
+        for name, old, new, change in regressions:
+            print(f"REGRESSION {name}: {old:.4f} -> {new:.4f} ({change:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print(f"no regression beyond {args.threshold:.0%}")
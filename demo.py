@@ -3,8 +3,14 @@ from models.MEM import Model
 from models.HMM import Model as HMM
 from evaluation.metric import Metric
 from tqdm import tqdm
+import argparse
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", default="python", choices=["python", "numpy"],
+                        help="HMM Viterbi decoder")
+    args = parser.parse_args()
+
     # testing dataset
     dst_test = Dataset(type="test", year=2010)
     test_data = dst_test.get_all_item()
@@ -12,7 +18,7 @@ if __name__ == "__main__":
     target_gt = []
     
     # get prediction
-    model = HMM()
+    model = HMM(engine=args.engine)
     for pair in tqdm(test_data):
         source = pair["en"]
         pred = model.translate(source)
@@ -28,3 +34,7 @@ if __name__ == "__main__":
     _, avg = metric.eval_2(pred=target_pred, 
                             target=target_gt)
     print('avg BLUE-2:', avg)
+
+    _, corpus_bleu = metric.bleu(pred=target_pred,
+                                 target=target_gt)
+    print('corpus BLEU-4:', corpus_bleu)
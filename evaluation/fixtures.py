@@ -0,0 +1,169 @@
+'''
+Synthetic IWSLT-shaped corpus for the benchmarks: a random bilingual
+lexicon, parallel sentences drawn from it with some reordering and a
+forward.align in fast_align format, all written under a working directory
+with the same layout as the real data (data/zh-en, exps_MEM, exps_HMM).
+Deterministic for a given seed, nothing is downloaded.
+
+The ambiguity level sets the search size the decoders see: "low" gives about
+2 translations per source word (at most 3), "high" draws from more synonyms
+more often and misaligns some words, about 5 per word and up to the 10 the
+tables keep, closer to the fan-out of the real data.
+'''
+
+import os
+import random
+
+SIZES = {"small": {"vocab": 500, "train": 2000, "test": 200},
+         "medium": {"vocab": 3000, "train": 20000, "test": 500},
+         "large": {"vocab": 10000, "train": 100000, "test": 1000}}
+# synonyms: zh alternatives of every en word, synonym_rate: how often one is used
+# instead of the main translation, noise: probability of a wrong / extra alignment link
+AMBIGUITY = {"low": {"synonyms": 2, "synonym_rate": 0.2, "noise": 0.0},
+             "high": {"synonyms": 8, "synonym_rate": 0.5, "noise": 0.1}}
+LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def jieba_words(min_freq=200):
+    '''
+    2-3 character words of the jieba dictionary, a sentence made of them is
+    segmented back into the same words almost always
+    '''
+    import jieba
+    jieba.dt.initialize()
+    return sorted(w for w, f in jieba.dt.FREQ.items()
+                  if f >= min_freq and 2 <= len(w) <= 3 and all('\u4e00' <= c <= '\u9fff' for c in w))
+
+
+class Lexicon:
+    '''
+    en word -> zh words, translated as zh[i] most of the time and as one of
+    its synonyms (zh[i + 1], zh[i + 7], zh[i + 13], ...) otherwise, so that every
+    Chinese word has several English sources (a probability of exactly 1 reads
+    as unseen in the HMM tables);
+    sentences are walks over a sparse successor graph (a few Zipf-distributed
+    successors per word) so that the 2-gram and transition tables are dense
+    enough to decode with
+    '''
+    def __init__(self, size, rng, successors=4, synonyms=2, synonym_rate=0.2):
+        en = set()
+        while len(en) < size:
+            en.add("".join(rng.choice(LETTERS) for _ in range(rng.randint(2, 8))))
+        self.en = sorted(en)
+        self.zh = rng.sample(jieba_words(), size)
+        self.weights = [1.0 / (r + 1) for r in range(size)]
+        self.successors = [rng.choices(range(size), self.weights, k=successors) for _ in range(size)]
+        self.offsets = [1 + 6 * k for k in range(synonyms)]
+        self.synonym_rate = synonym_rate
+
+    def sentence(self, rng, length):
+        '''
+        return:
+            English words, Chinese words, target position of every English word
+        '''
+        ids = rng.choices(range(len(self.en)), self.weights)
+        while len(ids) < length:
+            ids.append(rng.choice(self.successors[ids[-1]]))
+        order = list(range(length))
+        # local reordering: swap a few neighbours
+        for i in range(length - 1):
+            if rng.random() < 0.05:
+                order[i], order[i + 1] = order[i + 1], order[i]
+        position = {src: tgt for tgt, src in enumerate(order)}
+        zh = [self.zh[(i + rng.choice(self.offsets)) % len(self.zh)] if rng.random() < self.synonym_rate else self.zh[i]
+              for i in ids]
+        return [self.en[i] for i in ids], [zh[src] for src in order], [position[i] for i in range(length)]
+
+
+def sentence_length(rng):
+    # mostly short sentences with a tail up to 60 words, like TED talks
+    return min(60, max(1, int(rng.lognormvariate(2.4, 0.6))))
+
+
+def write_xml(path, lines, lang):
+    with open(path, 'w', encoding='utf-8') as xml_file:
+        xml_file.write(f'<mteval>\n<srcset setid="synthetic" srclang="{lang}">\n<doc docid="0">\n')
+        for i, line in enumerate(lines):
+            xml_file.write(f'<seg id="{i + 1}"> {line} </seg>\n')
+        xml_file.write('</doc>\n</srcset>\n</mteval>\n')
+
+
+def make_corpus(root, size="small", seed=0, years=(2010,), ambiguity="low"):
+    '''
+    param:
+        root(str): working directory, data/zh-en and exps_MEM/forward.align are written under it
+        size(str): small / medium / large (see SIZES)
+        seed(int): random seed, the same seed writes the same files
+        ambiguity(str): low / high (see AMBIGUITY)
+        years(tuple): test sets, the validation set is a copy of the first one
+    return:
+        test pairs of the first year [{'en': 'xxx', 'zh': 'yyy'}, ...]
+    '''
+    config = SIZES[size]
+    level = AMBIGUITY[ambiguity]
+    rng = random.Random(seed)
+    lexicon = Lexicon(config["vocab"], rng, synonyms=level["synonyms"], synonym_rate=level["synonym_rate"])
+    data_root = os.path.join(root, "data", "zh-en")
+    for path in [data_root, os.path.join(root, "exps_MEM"), os.path.join(root, "exps_HMM")]:
+        os.makedirs(path, exist_ok=True)
+
+    # train.tags: one talk header every 100 lines, Chinese words separated by spaces;
+    # the alignment indexes the words, written as segmented by jieba (see Dataset.get_segments)
+    with open(os.path.join(data_root, "train.tags.zh-en.en"), 'w', encoding='utf-8') as en_file, \
+            open(os.path.join(data_root, "train.tags.zh-en.zh"), 'w', encoding='utf-8') as zh_file:
+        pairs = []
+        for i in range(config["train"]):
+            if i % 100 == 0:
+                en_file.write(f"<url>http://synthetic/{i}</url>\n")
+                zh_file.write(f"<url>http://synthetic/{i}</url>\n")
+            en, zh, position = lexicon.sentence(rng, sentence_length(rng))
+            en_file.write(" ".join(en) + "\n")
+            zh_file.write(" ".join(zh) + "\n")
+            pairs.append((en, zh, position))
+
+    write_alignment(os.path.join(root, "exps_MEM", "forward.align"), pairs, level["noise"], random.Random(seed + 1))
+
+    test = []
+    for year in years:
+        rng_test = random.Random(seed * 1000 + year)
+        pairs = [lexicon.sentence(rng_test, sentence_length(rng_test)) for _ in range(config["test"])]
+        en_lines = [" ".join(en) for en, _, _ in pairs]
+        zh_lines = ["".join(zh) for _, zh, _ in pairs]
+        write_xml(os.path.join(data_root, f"IWSLT17.TED.tst{year}.zh-en.en.xml"), en_lines, "en")
+        write_xml(os.path.join(data_root, f"IWSLT17.TED.tst{year}.zh-en.zh.xml"), zh_lines, "zh")
+        if year == years[0]:
+            write_xml(os.path.join(data_root, "IWSLT17.TED.dev2010.zh-en.en.xml"), en_lines, "en")
+            write_xml(os.path.join(data_root, "IWSLT17.TED.dev2010.zh-en.zh.xml"), zh_lines, "zh")
+            test = [{"en": en, "zh": zh} for en, zh in zip(en_lines, zh_lines)]
+    return test
+
+
+def write_alignment(path, pairs, noise=0.0, rng=None):
+    '''
+    the Chinese side is re-segmented with jieba like the table builders do,
+    every English word is aligned to the first jieba word overlapping its
+    lexicon translation; with probability noise it is aligned to a random
+    word instead, and with probability noise it gets an extra link to a
+    neighbour, like the errors of a real aligner
+    '''
+    from preprocess.segment import cut_zh
+    with open(path, 'w', encoding='utf-8') as align_file:
+        for en, zh, position in pairs:
+            starts = []
+            offset = 0
+            for word in zh:
+                starts.append(offset)
+                offset += len(word)
+            segmented = cut_zh("".join(zh))
+            word_at = []
+            for k, word in enumerate(segmented):
+                word_at += [k] * len(word)
+            links = []
+            for i in range(len(en)):
+                k = word_at[starts[position[i]]]
+                if noise and rng.random() < noise:
+                    k = rng.randrange(len(segmented))
+                links.append(f"{i}-{k}")
+                if noise and rng.random() < noise and k + 1 < len(segmented):
+                    links.append(f"{i}-{k + 1}")
+            align_file.write(" ".join(links) + "\n")
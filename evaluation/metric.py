@@ -1,53 +1,108 @@
-import jieba
+from collections import Counter
+import numpy as np
+from preprocess.segment import cut_zh_cached
 
 class Metric:
     def __init__(self):
         self.mode = "BLEU-1"
-    
+
+    def segment(self, sentence):
+        '''
+        sentences may be given as strings or already segmented word lists
+        '''
+        if isinstance(sentence, str):
+            return cut_zh_cached(sentence)
+        return sentence
+
     def eval(self, pred, target):
         '''
         param:
-            pred(list): ['aaa', 'bbb', 'ccc']
-            target(list): ['xxx', 'yyy', 'zzz']
+            pred(list): ['aaa', 'bbb', 'ccc'] or [['a', 'aa'], ...]
+            target(list): ['xxx', 'yyy', 'zzz'] or [['x', 'xx'], ...]
         return:
             BLUE(list), avg_BLUE(float)
         '''
         BLUE_val = []
 
         for s, t in zip(pred, target):
-            s_seg_list = list(jieba.cut(s, cut_all=False))
-            t_seg_list = list(jieba.cut(t, cut_all=False))
-            
+            s_seg_list = self.segment(s)
+            t_seg_set = set(self.segment(t))
+
             blue = 0
             for seg in s_seg_list:
-                if seg in t_seg_list:
+                if seg in t_seg_set:
                     blue += 1
-            BLUE_val.append(blue / len(s_seg_list))
+            BLUE_val.append(blue / len(s_seg_list) if s_seg_list else 0)
 
         return BLUE_val, sum(BLUE_val) / len(BLUE_val)
 
     def eval_2(self, pred, target):
         '''
         param:
-            pred(list): ['aaa', 'bbb', 'ccc']
-            target(list): ['xxx', 'yyy', 'zzz']
+            pred(list): ['aaa', 'bbb', 'ccc'] or [['a', 'aa'], ...]
+            target(list): ['xxx', 'yyy', 'zzz'] or [['x', 'xx'], ...]
         return:
             BLUE(list), avg_BLUE(float)
         '''
         BLUE_val = []
 
         for s, t in zip(pred, target):
-            s_seg_list = list(jieba.cut(s, cut_all=False))
-            t_seg_list = list(jieba.cut(t, cut_all=False))
-            
+            s_seg_list = self.segment(s)
+            t_seg_list = self.segment(t)
+            t_bigram = Counter(zip(t_seg_list, t_seg_list[1:]))
+
             blue = 0
-            for i in range(len(s_seg_list) - 1):
-                word1 = s_seg_list[i]
-                word2 = s_seg_list[i+1]
-                for j in range(len(t_seg_list) - 1):
-                    if (word1 == t_seg_list[j]) and (word2 == t_seg_list[j+1]):
-                        blue += 1
+            for bigram in zip(s_seg_list, s_seg_list[1:]):
+                blue += t_bigram.get(bigram, 0)
+
+            BLUE_val.append(blue / (len(s_seg_list) - 1) if len(s_seg_list) > 1 else 0)
 
-            BLUE_val.append(blue / (len(s_seg_list) - 1))
+        return BLUE_val, sum(BLUE_val) / len(BLUE_val)
 
-        return BLUE_val, sum(BLUE_val) / len(BLUE_val)
\ No newline at end of file
+    def bleu_stats(self, pred, target, max_n=4):
+        '''
+        return:
+            np.array of shape (len(pred), 2 * max_n + 2), per sentence:
+            clipped matches of 1..max_n-grams, number of 1..max_n-grams, pred length, target length
+        '''
+        stats = np.zeros((len(pred), 2 * max_n + 2))
+        for k, (s, t) in enumerate(zip(pred, target)):
+            s_seg_list = self.segment(s)
+            t_seg_list = self.segment(t)
+            for n in range(1, max_n + 1):
+                s_grams = Counter(zip(*[s_seg_list[i:] for i in range(n)]))
+                t_grams = Counter(zip(*[t_seg_list[i:] for i in range(n)]))
+                stats[k, n - 1] = sum(min(c, t_grams[g]) for g, c in s_grams.items() if g in t_grams)
+                stats[k, max_n + n - 1] = max(len(s_seg_list) - n + 1, 0)
+            stats[k, -2] = len(s_seg_list)
+            stats[k, -1] = len(t_seg_list)
+        return stats
+
+    def bleu_from_stats(self, stats, max_n, smooth):
+        matches = stats[..., :max_n]
+        totals = stats[..., max_n:2 * max_n]
+        if smooth:
+            # add-one smoothing for n > 1, otherwise short sentences score 0
+            matches = matches + np.r_[0, np.ones(max_n - 1)]
+            totals = totals + np.r_[0, np.ones(max_n - 1)]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_p = np.where(matches > 0, np.log(matches) - np.log(np.maximum(totals, 1)), -np.inf)
+            hyp_len, ref_len = stats[..., -2], stats[..., -1]
+            log_bp = np.minimum(0, 1 - ref_len / np.maximum(hyp_len, 1))
+        return np.where(hyp_len > 0, np.exp(log_p.mean(axis=-1) + log_bp), 0)
+
+    def bleu(self, pred, target, max_n=4):
+        '''
+        BLEU-max_n with clipped n-gram counts and brevity penalty, sentence and
+        corpus level from a single pass over the data
+        param:
+            pred(list): ['aaa', 'bbb', 'ccc'] or [['a', 'aa'], ...]
+            target(list): ['xxx', 'yyy', 'zzz'] or [['x', 'xx'], ...]
+            max_n(int): 1-4
+        return:
+            BLEU(list, smoothed sentence BLEU), corpus_BLEU(float)
+        '''
+        stats = self.bleu_stats(pred, target, max_n)
+        sentence = self.bleu_from_stats(stats, max_n, smooth=True)
+        corpus = self.bleu_from_stats(stats.sum(axis=0), max_n, smooth=False)
+        return sentence.tolist(), float(corpus)
@@ -0,0 +1,209 @@
+import os
+import glob
+import time
+import uuid
+from multiprocessing import Pool, util
+import numpy as np
+from models.cache import TranslationCache
+from preprocess import resources
+from profiling import profiler
+
+_model = None
+
+
+def load_model(name, options):
+    '''
+    param:
+        name(str): HMM / MEM / seq2seq
+        options(dict): constructor keyword arguments
+    '''
+    if name == "HMM":
+        from models.HMM import Model
+        return Model(**options)
+    if name == "MEM":
+        from models.MEM import Model
+        return Model(**options)
+    if name == "seq2seq":
+        import seq2seq
+        epoch = options.pop("epoch", 40)
+        lr = options.pop("lr", 0.001)
+        checkpoint = options.pop("checkpoint", "exps_seq2seq/checkpoint.pt")
+        if os.path.exists(checkpoint):
+            model = seq2seq.Model.load(checkpoint)
+            if model.epoch >= epoch:
+                return model
+        model = seq2seq.Model(50, 100, 107, 100, 2, **options)
+        model.train(epoch, lr, checkpoint)
+        return model
+    raise ValueError(f"unknown model {name}")
+
+
+def init_worker(name, options, cache_size=0, cache_path=None, save_prefix=None):
+    '''
+    param:
+        save_prefix(str): pool workers write their cache to <save_prefix>.<pid>
+            when they exit, Runner.close merges the files
+    '''
+    global _model
+    _model = load_model(name, dict(options))
+    if cache_size > 0:
+        _model.cache = TranslationCache(cache_size, path=cache_path)
+        if save_prefix is not None:
+            util.Finalize(None, _model.cache.save, args=(f"{save_prefix}.{os.getpid()}",), exitpriority=10)
+
+
+def translate_one(sentence, index=None):
+    '''
+    return:
+        prediction (None if the model raised), latency in seconds, cache hit
+    '''
+    begin = time.perf_counter()
+    hits = _model.cache.hits if _model.cache is not None else 0
+    try:
+        pred = profiler.sample("translate", _model.translate, sentence)
+    except Exception as e:
+        print(f"translate failed on sentence {index}:", repr(e))
+        pred = None
+    hit = _model.cache is not None and _model.cache.hits > hits
+    return pred, time.perf_counter() - begin, hit
+
+
+def translate_pooled(item):
+    '''
+    translate_one of (index, sentence) in a pool worker, the instrumentation
+    of the worker is sent back with every result
+    '''
+    index, sentence = item
+    return translate_one(sentence, index) + (profiler.drain() if profiler.enabled else None,)
+
+
+class Runner:
+    '''
+    translate sentence lists with a pool of worker processes, each worker
+    loads the model once; seq2seq is decoded in batches in this process
+    with cache_size > 0 every process keeps its own TranslationCache, the
+    cache file (cache_path) is read at start and written by close(), the
+    entries of the pool workers are merged into it
+    '''
+    def __init__(self, name, workers=1, options=None, cache_size=0, cache_path=None):
+        self.name = name
+        self.workers = workers
+        self.options = options or {}
+        self.pool = None
+        self.model = None
+        self.translator = None
+        self.cache = None
+        self.cache_size = cache_size
+        self.cache_path = cache_path
+        self.save_prefix = None
+        if name == "seq2seq":
+            options = dict(self.options)
+            shortlist = options.pop("shortlist", False)
+            self.model = load_model(name, options)
+            from seq2seq_inference import Translator, Shortlist
+            if cache_size > 0:
+                self.cache = TranslationCache(cache_size, path=cache_path)
+            self.translator = Translator(self.model, Shortlist.from_model(self.model) if shortlist else None, cache=self.cache)
+        elif workers > 1:
+            # checked once here, the forked workers inherit the tokenizer
+            resources.warmup()
+            if cache_size > 0 and cache_path is not None:
+                self.save_prefix = f"{cache_path}.{uuid.uuid4().hex[:8]}"
+            self.pool = Pool(workers, initializer=init_worker,
+                             initargs=(name, self.options, cache_size, cache_path, self.save_prefix))
+        else:
+            init_worker(name, self.options, cache_size, cache_path)
+            self.cache = _model.cache
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            if self.save_prefix is not None:
+                self.merge_worker_caches()
+        if self.cache is not None and self.cache.path is not None:
+            self.cache.save()
+
+    def merge_worker_caches(self):
+        '''
+        every worker started from the cache file, their entries are added
+        worker by worker, up to cache_size
+        '''
+        paths = sorted(glob.glob(f"{glob.escape(self.save_prefix)}.*"), key=os.path.getmtime)
+        if not paths:
+            return
+        merged = TranslationCache(self.cache_size)
+        for path in paths:
+            merged.load(path)
+            os.remove(path)
+        merged.save(self.cache_path)
+
+    def iter_translate(self, sentences, batch_size=64):
+        '''
+        yield:
+            (prediction, latency in seconds, cache hit), in input order, the
+            prediction is None if the model failed on the sentence
+        '''
+        if self.model is not None:
+            # unknown words would make the whole batch fail
+            vocab = self.model.en_word_2_index
+            sentences = [" ".join(w for w in s.split() if w in vocab) for s in sentences]
+            for b in range(0, len(sentences), batch_size):
+                batch = sentences[b:b + batch_size]
+                cached = [self.cache is not None and self.cache.sentence_key(s) in self.cache.entries for s in batch]
+                begin = time.perf_counter()
+                preds = profiler.sample("translate_batch", self.translator.translate_batch, batch)
+                latency = (time.perf_counter() - begin) / len(preds)
+                for pred, hit in zip(preds, cached):
+                    yield pred, latency, hit
+        elif self.pool is not None:
+            for pred, latency, hit, state in self.pool.imap(translate_pooled, enumerate(sentences), chunksize=8):
+                if state is not None:
+                    profiler.merge(state)
+                yield pred, latency, hit
+        else:
+            for i, sentence in enumerate(sentences):
+                yield translate_one(sentence, i)
+
+    def run(self, sentences, out_path=None):
+        '''
+        param:
+            sentences(list): English sentences
+            out_path(str): predictions are written there line by line as they finish
+        return:
+            predictions(list), stats(dict); failed sentences are predicted as ""
+            and counted in stats["failures"]
+        '''
+        from tqdm import tqdm
+        preds = []
+        latencies = []
+        hits = 0
+        failed = []
+        out_file = open(out_path, 'w', encoding='utf-8') if out_path else None
+        begin = time.perf_counter()
+        for i, (pred, latency, hit) in enumerate(tqdm(self.iter_translate(sentences), total=len(sentences))):
+            if pred is None:
+                failed.append(i)
+                pred = ""
+            preds.append(pred)
+            latencies.append(latency)
+            hits += hit
+            if out_file:
+                out_file.write(pred + '\n')
+                out_file.flush()
+        elapsed = time.perf_counter() - begin
+        if out_file:
+            out_file.close()
+
+        latencies = np.array(latencies) * 1000
+        stats = {"sentences": len(sentences),
+                 "seconds": elapsed,
+                 "sentences/sec": len(sentences) / elapsed if elapsed > 0 else 0.0}
+        for q in (50, 90, 99):
+            stats[f"p{q} ms"] = float(np.percentile(latencies, q)) if len(latencies) else 0.0
+        stats["empty outputs"] = sum(1 for pred in preds if not pred)
+        stats["failures"] = len(failed)
+        if failed:
+            print(f"warning: {len(failed)} sentences failed to translate (scored as empty), first: {failed[:10]}")
+        stats["cache hit rate"] = hits / len(sentences) if len(sentences) else 0.0
+        return preds, stats
@@ -0,0 +1,50 @@
+from preprocess.dataset import Dataset
+from evaluation.metric import Metric
+from models.HMM import Model
+import argparse
+import json
+import os
+import time
+
+if __name__ == "__main__":
+    # speed / quality of the beam-pruned HMM decoder against the exact one
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--years", type=int, nargs="+", default=[2010])
+    parser.add_argument("--engine", default="numpy", choices=["python", "numpy"])
+    parser.add_argument("--widths", type=int, nargs="+", default=[1, 2, 5, 10, 20, 50])
+    parser.add_argument("--margins", type=float, nargs="+", default=[5.0, 10.0, 20.0])
+    parser.add_argument("--out", default="outputs/HMM.beam.json")
+    args = parser.parse_args()
+
+    test_data = [pair for year in args.years for pair in Dataset(type="test", year=year).get_all_item()]
+    sentences = [pair["en"] for pair in test_data]
+    target_gt = [pair["zh"] for pair in test_data]
+    metric = Metric()
+    model = Model(engine=args.engine)
+
+    def run(width, margin):
+        model.beam_width = width
+        model.beam_margin = margin
+        if model.engine is not None:
+            model.engine.beam_width = width
+            model.engine.beam_margin = margin
+        begin = time.perf_counter()
+        preds = [model.translate(s) for s in sentences]
+        return preds, time.perf_counter() - begin
+
+    exact, exact_time = run(None, None)
+    settings = [(None, None)] + [(w, None) for w in args.widths] + [(None, m) for m in args.margins] + \
+               [(w, m) for w in args.widths for m in args.margins]
+    report = []
+    for width, margin in settings:
+        preds, elapsed = (exact, exact_time) if width is None and margin is None else run(width, margin)
+        report.append({"beam_width": width, "beam_margin": margin,
+                       "sentences/sec": len(sentences) / elapsed if elapsed > 0 else 0.0,
+                       "speedup": exact_time / elapsed if elapsed > 0 else 0.0,
+                       "same as exact": sum(p == e for p, e in zip(preds, exact)) / len(preds),
+                       "BLEU-1": metric.eval(pred=preds, target=target_gt)[1]})
+        print(json.dumps(report[-1]))
+
+    os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+    with open(args.out, 'w', encoding='utf8') as json_file:
+        json.dump(report, json_file, indent=2)
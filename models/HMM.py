@@ -1,16 +1,62 @@
 import os
 import json
-import nltk
-from queue import PriorityQueue
-from copy import *
 import math
+import heapq
+from models.viterbi import ViterbiEngine
+from preprocess.store import Store
+from preprocess import resources
+from profiling import profiler
 
 
 class Model:
-    def __init__(self):
+    def __init__(self, engine="python", compiled=False, cache=None, beam_width=None, beam_margin=None,
+                 smoothing=False, oov_log_p=math.log(1e-6)):
+        '''
+        param:
+            engine(str): python / numpy (vectorized Viterbi, same output)
+            compiled(bool): memory-map exps_HMM/HMM.bin instead of loading the json
+                tables, implies the numpy engine (see Dataset.compile_tables)
+            cache(TranslationCache): translations of repeated sentences, None to disable
+            beam_width(int): histogram pruning, states kept per position, None keeps all
+            beam_margin(float): threshold pruning, drop states whose log-prob is more
+                than this below the best one at the same position, None keeps all
+            smoothing(bool): python engine only, unseen transitions / emissions get the
+                backoff probabilities of HMM_A_backoff.json / HMM_B_backoff.json (tables
+                built with Dataset.generate_HMM_A(smoothing=...)), and a word without a
+                reachable state is passed through as it is, so the lattice never collapses
+            oov_log_p(float): log-prob of a passthrough step
+        '''
         self.data_root = "data/zh-en"
         self.exp_dir = "exps_HMM"
-
+        self.engine = None
+        self.cache = cache
+        self.beam_width = beam_width
+        self.beam_margin = beam_margin
+        self.smoothing = smoothing
+        self.oov_log_p = oov_log_p
+        self.HMM_A_backoff = None
+        self.HMM_B_backoff = None
+        if smoothing and (compiled or engine != "python"):
+            raise ValueError("smoothing is only supported by the python engine")
+
+        if compiled:
+            self.engine = ViterbiEngine.from_store(Store(os.path.join(self.exp_dir, "HMM.bin")))
+        else:
+            self.load_json_tables()
+            if smoothing:
+                self.HMM_A_backoff = self.load_backoff("HMM_A_backoff.json")
+                self.HMM_B_backoff = self.load_backoff("HMM_B_backoff.json")
+            if engine == "numpy":
+                self.engine = ViterbiEngine.from_tables(self.HMM_PI, self.HMM_A, self.HMM_B, self.map)
+            else:
+                self.build_start_states()
+        if self.engine is not None:
+            self.engine.beam_width = beam_width
+            self.engine.beam_margin = beam_margin
+
+        resources.ensure_punkt()
+
+    def load_json_tables(self):
         if not os.path.exists(os.path.join(self.exp_dir, "HMM_PI.json")):
             print("HMM_PI.json Not Found.")
         else:
@@ -35,32 +81,124 @@ class Model:
             with open(os.path.join(self.exp_dir, "map.json"), 'r', encoding='utf-8') as json_file:
                 self.map = json.load(json_file)
 
-        nltk.download('punkt')
+    def load_backoff(self, name):
+        if not os.path.exists(os.path.join(self.exp_dir, name)):
+            print(f"{name} Not Found.")
+            return None
+        with open(os.path.join(self.exp_dir, name), 'r', encoding='utf-8') as json_file:
+            return json.load(json_file)
+
+    def build_start_states(self):
+        '''
+        inverted index English word -> [(zh, log PI + log B)] over the states with a
+        valid emission, in HMM_PI order, so step 0 does not scan all of HMM_PI
+        '''
+        pi_rank = {key: i for i, key in enumerate(self.HMM_PI)}
+        self.start_states = {}
+        for zh in self.HMM_B:
+            if zh not in pi_rank:
+                continue
+            for en in self.HMM_B[zh]:
+                log_pb = self.get_log_pb(zh, en)
+                if log_pb < 0:
+                    self.start_states.setdefault(en, []).append((pi_rank[zh], zh, math.log(self.HMM_PI[zh]) + log_pb))
+        for en in self.start_states:
+            self.start_states[en] = [(zh, delta) for _, zh, delta in sorted(self.start_states[en])]
+        self.pi_rank = pi_rank
+
+    def smoothed_start_states(self, en):
+        '''
+        smoothing mode: the start states of en plus its map candidates without a
+        seen emission, scored through HMM_B_backoff like the later positions
+        '''
+        states = list(self.start_states.get(en, []))
+        seen = {zh for zh, _ in states}
+        unseen = sorted((zh for zh in set(self.map.get(en, [])) if zh in self.pi_rank and zh not in seen),
+                        key=self.pi_rank.get)
+        for zh in unseen:
+            log_pb = self.get_log_pb(zh, en)
+            if log_pb < 0:
+                states.append((zh, math.log(self.HMM_PI[zh]) + log_pb))
+        return states
+
+    def prune(self, layer):
+        '''
+        beam pruning of one Viterbi position {zh: [delta, psi]}, keeps the dict order
+        '''
+        if not layer:
+            return layer
+        if self.beam_margin is not None:
+            best = max(v[0] for v in layer.values())
+            layer = {k: v for k, v in layer.items() if v[0] >= best - self.beam_margin}
+        if self.beam_width is not None and len(layer) > self.beam_width:
+            keep = set(heapq.nlargest(self.beam_width, layer, key=lambda k: layer[k][0]))
+            layer = {k: v for k, v in layer.items() if k in keep}
+        return layer
 
     def get_log_pb(self, zh, en):
         if zh in self.HMM_B:
             if en in self.HMM_B[zh]:
                 return math.log(self.HMM_B[zh][en])
+        if self.HMM_B_backoff is not None and en in self.HMM_B_backoff["unigram"]:
+            return math.log(self.HMM_B_backoff["backoff"].get(zh, 1.0) * self.HMM_B_backoff["unigram"][en])
         return 1
 
     def get_log_pa(self, zh1, zh2):
         if zh1 in self.HMM_A:
             if zh2 in self.HMM_A[zh1]:
                 return math.log(self.HMM_A[zh1][zh2])
+        if self.HMM_A_backoff is not None and zh2 in self.HMM_A_backoff["unigram"]:
+            return math.log(self.HMM_A_backoff["backoff"].get(zh1, 1.0) * self.HMM_A_backoff["unigram"][zh2])
         return 1
 
-    def translate(self, en):
-        en_seg_list = nltk.word_tokenize(en)
-        en_seg_list = [w.lower() for w in en_seg_list]
+    def passthrough(self, prev, layer, en):
+        '''
+        smoothing mode: keep the reachable states of a position, if there are none
+        the English word itself becomes the only state, reached from the best
+        previous one at the cost oov_log_p
+        '''
+        layer = {k: v for k, v in layer.items() if v[1] != ''}
+        if not layer:
+            if prev:
+                best = max(prev, key=lambda k: prev[k][0])
+                layer = {en: [prev[best][0] + self.oov_log_p, best]}
+            else:
+                layer = {en: [self.oov_log_p, '']}
+        return layer
 
+    def translate(self, en):
+        if self.cache is not None:
+            return self.cache.lookup(self.cache.sentence_key(en), lambda: self.translate_uncached(en))
+        return self.translate_uncached(en)
+
+    def translate_uncached(self, en):
+        with profiler.timer("hmm.tokenize"):
+            en_seg_list = resources.word_tokenize(en)
+            en_seg_list = [w.lower() for w in en_seg_list]
+        return self.decode(en_seg_list)
+
+    def decode(self, en_seg_list):
+        with profiler.timer("hmm.decode"):
+            if self.engine is not None:
+                return self.engine.decode(en_seg_list)
+            return self.viterbi(en_seg_list)
+
+    def viterbi(self, en_seg_list):
         T = len(en_seg_list)
+        if T == 0:
+            return ""
 
         viterbi = [{} for _ in range(T)]
 
-        for key in self.HMM_PI:
-            log_pb = self.get_log_pb(key, en_seg_list[0])
-            if log_pb < 0:
-                viterbi[0][key] = [math.log(self.HMM_PI[key]) + log_pb, '']
+        if self.smoothing:
+            start_states = self.smoothed_start_states(en_seg_list[0])
+        else:
+            start_states = self.start_states.get(en_seg_list[0], [])
+        for key, delta in start_states:
+            viterbi[0][key] = [delta, '']
+        if self.smoothing and not viterbi[0]:
+            viterbi[0] = self.passthrough({}, {}, en_seg_list[0])
+        viterbi[0] = self.prune(viterbi[0])
 
         for i in range(1, T):
             en = en_seg_list[i]
@@ -80,6 +218,15 @@ class Model:
                                         delta_max = delta_t
                                         psi = zh
                         viterbi[i][zh_t] = [delta_max, psi]
+            if self.smoothing:
+                viterbi[i] = self.passthrough(viterbi[i - 1], viterbi[i], en)
+            viterbi[i] = self.prune(viterbi[i])
+
+        if profiler.enabled:
+            profiler.count("hmm.viterbi_steps", T)
+            profiler.count("hmm.states_expanded", sum(len(layer) for layer in viterbi))
+            profiler.count("hmm.transition_lookups", sum(len(viterbi[i - 1]) * len(self.map[en_seg_list[i]])
+                                                         for i in range(1, T) if en_seg_list[i] in self.map))
 
         target = ""
         if viterbi[-1]:
@@ -90,6 +237,9 @@ class Model:
                 if delta > delta_max:
                     delta_max = delta
                     psi = key
+            # no reachable state at the end (same as the numpy engine)
+            if psi == '':
+                return ""
             target = psi
             for i in range(T - 1, -1, -1):
                 psi = viterbi[i][psi][1]
@@ -1,120 +1,204 @@
 import os
 import json
-import nltk
-from queue import PriorityQueue
-from copy import *
 import math
+import numpy as np
+from models.stack_decoder import StackDecoder
+from models.lm import LanguageModel
+from preprocess import resources
+from profiling import profiler
+from preprocess.store import Store, Row, DictTable, ListTable
+from preprocess.phrases import PhraseTable
 
 class Model:
-    def __init__(self):
+    def __init__(self, compiled=False, stack_size=30, top_k=3, beam_threshold=None, distortion_limit=None, cache=None,
+                 lm="bigram", phrases=False):
+        '''
+        param:
+            compiled(bool): memory-map exps_MEM/MEM.bin instead of loading the json
+                tables (see Dataset.compile_tables)
+            stack_size(int): histogram pruning, hypotheses kept per stack
+            top_k(int): translations tried per source word
+            beam_threshold(float): threshold pruning, drop hypotheses whose score plus
+                future cost is more than this below the best one, None (default) to disable,
+                e.g. 10.0
+            distortion_limit(int): maximum reordering jump, None (default) for unlimited, e.g. 6
+            cache(TranslationCache): translations of repeated sentences, None to disable
+            lm(str): "bigram" is the language_model.json (or compiled) 2-gram table,
+                "kn" the Kneser-Ney trigram exps_MEM/lm.bin (Dataset.build_kn_language_model),
+                hypotheses then carry its integer LM state; it decodes about 1.5x slower
+                than the bigram tables, trigram states recombine fewer hypotheses
+            phrases(bool): translate source spans of several words in one step with the
+                phrase table exps_MEM/phrase_table.bin (Dataset.build_phrase_table), see
+                span_options
+        '''
+        if lm not in ("bigram", "kn"):
+            raise ValueError(f"unknown language model {lm}")
         self.data_root = "data/zh-en"
         self.exp_dir = "exps_MEM"
+        self.cache = cache
+        self.lm = None
+        self.language_model = None
+        self.phrase_table = None
 
+        if compiled:
+            store = Store(os.path.join(self.exp_dir, "MEM.bin"))
+            vocab = store.strings("vocab")
+            self.translate_table = ListTable(store.csr("translate"), vocab)
+            if lm == "bigram":
+                self.language_model = {"start_word": Row(store["start.indices"], store["start.logp"], vocab),
+                                       "2-gram": DictTable(store.csr("2-gram"), vocab)}
+        else:
+            self.load_json_tables(language_model=lm == "bigram")
+        if lm == "kn":
+            self.lm = LanguageModel(Store(os.path.join(self.exp_dir, "lm.bin")))
+        if phrases:
+            self.phrase_table = PhraseTable(Store(os.path.join(self.exp_dir, "phrase_table.bin")))
+
+        self.weight_trans = 1.0
+        self.weight_lang = 0.1
+        self.weight_distort = 1.0
+        self.alpha = 0.5
+        self.stack_size = stack_size
+        self.top_k = top_k
+        self.beam_threshold = beam_threshold
+        self.distortion_limit = distortion_limit
+        self.lm_best = None
+        self.decoder = StackDecoder(self)
+
+        resources.ensure_punkt()
+    
+    def load_json_tables(self, language_model=True):
         if not os.path.exists(os.path.join(self.exp_dir, "translate_table.json")):
             print("Error, you need the translation table to run the Maximum Entropy Model!!!")
         else:
             with open(os.path.join(self.exp_dir, "translate_table.json"), 'r', encoding='utf-8') as json_file:
                 self.translate_table = json.load(json_file)
 
+        if not language_model:
+            return
         if not os.path.exists(os.path.join(self.exp_dir, "language_model.json")):
             print("Error, you need the language model to run the Maximum Entropy Model!!!")
         else:
             with open(os.path.join(self.exp_dir, "language_model.json"), 'r', encoding='utf-8') as json_file:
                 self.language_model = json.load(json_file)
 
-        self.weight_trans = 1.0
-        self.weight_lang = 0.1
-        self.weight_distort = 1.0
-        self.alpha = 0.5
-        
-        nltk.download('punkt')
-    
-    def cal_language_model(self, sentence):
+    def lm_score(self, state, word):
+        '''
+        param:
+            state(str): previous target word, None at the start of the sentence
+            word(str): next target word
+        return:
+            log p(word | state), new state
+        '''
+        if self.lm is not None:
+            return self.lm.score(state, word)
         lang_p = 1e-6
-        if len(sentence) == 1:
-            if sentence[0] in self.language_model["start_word"]:
-                lang_p = self.language_model["start_word"][sentence[0]]
-        else:
-            word1 = sentence[-2]
-            word2 = sentence[-1]
-            if (word1 in self.language_model["2-gram"]) and (word2 in self.language_model["2-gram"][word1]):
-                lang_p = self.language_model["2-gram"][word1][word2]
-        
-        return math.log(lang_p)
+        if state is None:
+            if word in self.language_model["start_word"]:
+                lang_p = self.language_model["start_word"][word]
+        elif (state in self.language_model["2-gram"]) and (word in self.language_model["2-gram"][state]):
+            lang_p = self.language_model["2-gram"][state][word]
+
+        return math.log(lang_p), word
+
+    def lm_future(self, word):
+        '''
+        optimistic context-free estimate of log p(word) for the future cost:
+        the best start / 2-gram probability of any context followed by word
+        '''
+        if self.lm is not None:
+            return self.lm.best(word)
+        if self.lm_best is None:
+            self.lm_best = dict(self.language_model["start_word"])
+            bigram = self.language_model["2-gram"]
+            if isinstance(bigram, DictTable):
+                best = bigram.col_max()
+                for i in np.flatnonzero(best > -np.inf):
+                    word2 = bigram.vocab[int(i)]
+                    self.lm_best[word2] = max(self.lm_best.get(word2, 0), math.exp(best[i]))
+            else:
+                for word1 in bigram:
+                    for word2, p in bigram[word1].items():
+                        if p > self.lm_best.get(word2, 0):
+                            self.lm_best[word2] = p
+        return math.log(self.lm_best.get(word, 1e-6))
+
+    def cal_language_model(self, sentence):
+        state = sentence[-2] if len(sentence) > 1 else None
+        return self.lm_score(state, sentence[-1])[0]
+
+    def translation_options(self, en_word):
+        '''
+        return:
+            [(zh_word, log p), ...] for the top_k translations of en_word
+        '''
+        if en_word not in self.translate_table:
+            return [('', math.log(1e-6))]
+        return [(zh[0], math.log(zh[1])) for zh in self.translate_table[en_word][:self.top_k]]
+
+    def span_options(self, source_seg_list):
+        '''
+        return:
+            for every source position i, [(end, [(zh words, log p), ...]), ...] the
+            top_k translations of the span i..end-1
+        every word keeps its translate_table options; with the phrase table the
+        confident phrases (PhraseTable.confident) of several words are added,
+        scored by their lexical weight, the same scale as the word options. The
+        longest one starting after the previous unit is a unit: the words inside
+        get no other expansion and no span crosses its borders, so the decoder
+        has fewer, larger steps
+        '''
+        n = len(source_seg_list)
+        phrases = [[] for _ in range(n)]
+        unit_end = [None] * n
+        if self.phrase_table is not None:
+            end = 0
+            for i in range(n):
+                phrases[i] = [(e, p) for e, p in self.phrase_table.lookup(source_seg_list, i)
+                              if e > i + 1 and self.phrase_table.confident(p)]
+                if i >= end and phrases[i]:
+                    end = unit_end[i] = phrases[i][-1][0]
+        # start of the next unit at or after every position, positions inside a unit
+        next_unit = [n] * (n + 1)
+        inside = [False] * n
+        for i in range(n - 1, -1, -1):
+            next_unit[i] = i if unit_end[i] is not None else next_unit[i + 1]
+            if unit_end[i] is not None:
+                inside[i + 1:unit_end[i]] = [True] * (unit_end[i] - i - 1)
+
+        options = []
+        for i, en_word in enumerate(source_seg_list):
+            if unit_end[i] is not None:
+                options.append([(unit_end[i], self.phrase_table.translations(phrases[i][-1][1])[:self.top_k])])
+            elif inside[i]:
+                options.append([])
+            else:
+                spans = [(i + 1, [((zh_word,), log_p) for zh_word, log_p in self.translation_options(en_word)])]
+                spans += [(e, self.phrase_table.translations(p)[:self.top_k])
+                          for e, p in phrases[i] if e <= next_unit[i + 1]]
+                options.append(spans)
+        return options
 
     def translate(self, source):
+        if self.cache is not None:
+            return self.cache.lookup(self.cache.sentence_key(source), lambda: self.translate_uncached(source))
+        return self.translate_uncached(source)
+
+    def translate_uncached(self, source):
         # divide with nltk
-        source_seg_list = nltk.word_tokenize(source)
-        source_seg_list = [w.lower() for w in source_seg_list]
-        
-        # translate
-        stack_size = 30
-        top_k = 3
-        target_list = []
-
-        beam_stack = [PriorityQueue() for _ in range(len(source_seg_list) + 1)]
-        inital = {"vis": [False for _ in range(len(source_seg_list))],
-                  "sentence": [], 'pos': -1,
-                  "trans_cost": 0, "lang_cost": 0}
-        beam_stack[0].put((0, inital))
+        with profiler.timer("mem.tokenize"):
+            source_seg_list = resources.word_tokenize(source)
+            source_seg_list = [w.lower() for w in source_seg_list]
+        return self.decode(source_seg_list)
 
+    def decode(self, source_seg_list):
         # beam search
-        for i in range(1, len(source_seg_list) + 1):
-            record = []
-            while (not beam_stack[i-1].empty()):
-                # pop out the parent
-                parent = beam_stack[i-1].get()[1]
-
-                # generate new candidate
-                for j in range(len(source_seg_list)):
-                    if parent["vis"][j] == False:
-                        en_word = source_seg_list[j]
-
-                        if en_word not in self.translate_table:
-                            zh_candidate = [('', 1e-6)]
-                        else:
-                            zh_candidate = self.translate_table[en_word][:top_k]
-                        for zh in zh_candidate:
-                            zh_word = zh[0]
-                            trans_p = zh[1] 
-
-                            candidate = {}
-                            candidate["vis"] = deepcopy(parent["vis"])
-                            candidate["vis"][j] = True
-                            candidate["sentence"] = deepcopy(parent["sentence"])
-                            candidate["sentence"].append(zh_word)
-                            candidate["pos"] = j
-                            candidate["trans_cost"] = parent["trans_cost"] + math.log(trans_p)
-                            candidate["lang_cost"] = parent["lang_cost"] + self.cal_language_model(candidate["sentence"])
-                            reorder_cost = math.pow(self.alpha, abs(parent["pos"] - candidate["pos"] + 1))
-                            reorder_cost = math.log(reorder_cost)
-
-                            candidate_cost = self.weight_trans * candidate["trans_cost"] +\
-                                             self.weight_lang * candidate["lang_cost"] +\
-                                             self.weight_distort * reorder_cost
-
-                            if candidate_cost in record:
-                                continue
-                            else:
-                                record.append(candidate_cost)
-
-                            # update the candidate stack
-                            if beam_stack[i].qsize() >= stack_size:
-                                min_candidate = beam_stack[i].get()
-                                if min_candidate[0] < candidate_cost:
-                                    beam_stack[i].put((candidate_cost, candidate))
-                                else:
-                                    beam_stack[i].put(min_candidate)
-                            else:
-                                beam_stack[i].put((candidate_cost, candidate))
-
-        last_stack = beam_stack[-1]
-        while (not last_stack.empty()):
-            data = last_stack.get()
-            target_list = data[1]["sentence"]
+        with profiler.timer("mem.options"):
+            options = self.span_options(source_seg_list)
+        with profiler.timer("mem.decode"):
+            best = self.decoder.decode(options)
 
         # form a complete sentence
-        target_sentence = ""
-        for w in target_list:
-            target_sentence += w
-        return target_sentence
\ No newline at end of file
+        if best is None:
+            return ""
+        return "".join(best.sentence())
@@ -0,0 +1,119 @@
+import os
+import json
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize(sentence):
+    '''
+    NFKC, collapsed whitespace, so that copies of a segment that only differ
+    in spacing or full-width characters share one cache entry
+    '''
+    return " ".join(unicodedata.normalize("NFKC", sentence).split())
+
+
+class TranslationCache:
+    '''
+    bounded translation cache in front of Model.translate, keyed on the
+    normalized source sentence (see sentence_key), the models still translate
+    the sentence as it is
+        policy: "lru" evicts the least recently used entry, "fifo" the oldest
+        path: json file the entries are loaded from / saved to (save)
+    '''
+    def __init__(self, max_size=10000, policy="lru", path=None):
+        if policy not in ("lru", "fifo"):
+            raise ValueError(f"unknown cache policy {policy}")
+        self.max_size = max_size
+        self.policy = policy
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    @staticmethod
+    def key(tokens):
+        return " ".join(tokens)
+
+    @staticmethod
+    def sentence_key(sentence, prefix=()):
+        '''
+        param:
+            prefix(list): tokens put before the sentence, e.g. decoding options
+        '''
+        return " ".join(list(prefix) + normalize(sentence).split())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        '''
+        return:
+            the cached translation, None on a miss
+        '''
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.policy == "lru":
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def lookup(self, key, translate):
+        '''
+        param:
+            translate(function): called without arguments on a miss
+        '''
+        value = self.get(key)
+        if value is None:
+            value = translate()
+            self.put(key, value)
+        return value
+
+    def lookup_batch(self, keys, translate_batch):
+        '''
+        param:
+            keys(list): one key per sentence
+            translate_batch(function): list of missed indexes -> list of translations
+        return:
+            translations(list), in the order of keys
+        '''
+        results = [self.get(k) for k in keys]
+        missed = [i for i, r in enumerate(results) if r is None]
+        if missed:
+            for i, value in zip(missed, translate_batch(missed)):
+                results[i] = value
+                self.put(keys[i], value)
+        return results
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"size": len(self.entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": self.hits / total if total else 0.0}
+
+    def load(self, path):
+        with open(path, 'r', encoding='utf-8') as json_file:
+            for key, value in json.load(json_file):
+                self.put(key, value)
+
+    def save(self, path=None):
+        '''
+        entries are written oldest first, so loading keeps the eviction order
+        '''
+        path = path or self.path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", 'w', encoding='utf-8') as json_file:
+            json.dump(list(self.entries.items()), json_file, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,249 @@
+'''
+Interpolated Kneser-Ney trigram language model for MEM, stored as a
+sorted-array trie in a preprocess.store file (exps_MEM/lm.bin).
+
+Layout, V words (0 <unk>, 1 <s>, 2 </s>), n2 bigrams, n3 trigrams:
+    uni.logp[w], uni.backoff[v]      log p(w), log backoff of context v
+    uni.ptr[v]..uni.ptr[v + 1]       bigrams (v, w) in bi.*, sorted by w
+    bi.word, bi.logp, bi.backoff     w, log p(w | v), log backoff of context (v, w)
+    bi.ptr[k]..bi.ptr[k + 1]         trigrams (v, w, x) of bigram k in tri.*, sorted by x
+    bi.next[k], tri.next[j]          state after the entry
+    tri.word, tri.logp               x, log p(x | v, w)
+Log-probs and backoffs are quantized to 2 ** bits codebook entries
+(*.codebook), the codes are uint8 / uint16.
+
+A state is the longest context that has continuations: a word id v < V
+(context v) or V + k (context bigram k). score() follows the trie from the
+state, one binary search in a sorted range per probe, and returns the next
+state, so hypotheses only carry an int. The ranges a decoder probes are
+read into Python lists the first time (LanguageModel.row) and searched with
+bisect, a miss of the score memo costs a few list lookups.
+'''
+
+from bisect import bisect_left
+import math
+import numpy as np
+
+UNK, BOS, EOS = 0, 1, 2
+SPECIALS = ["<unk>", "<s>", "</s>"]
+
+
+def discount(counts):
+    '''
+    D = n1 / (n1 + 2 n2) from the count-of-counts
+    '''
+    n1 = int(np.count_nonzero(counts == 1))
+    n2 = int(np.count_nonzero(counts == 2))
+    if n1 == 0 or n2 == 0:
+        return 0.5
+    return min(max(n1 / (n1 + 2 * n2), 0.1), 0.9)
+
+
+def quantize(values, bits):
+    '''
+    return:
+        codes(uint8 / uint16), codebook(float32) with codebook[codes] ~ values,
+        exact when there are at most 2 ** bits distinct values
+    '''
+    size = 1 << bits
+    distinct = np.unique(values)
+    if len(distinct) <= size:
+        codebook = distinct
+    else:
+        codebook = np.unique(np.quantile(values, (np.arange(size) + 0.5) / size))
+    middle = (codebook[1:] + codebook[:-1]) / 2
+    codes = np.searchsorted(middle, values).astype(np.uint8 if bits <= 8 else np.uint16)
+    return codes, codebook.astype(np.float32)
+
+
+def ngrams(tokens, sentence, n, V):
+    '''
+    unique codes (w1 * V + w2) * V + ... of the n-grams inside one sentence, counts
+    '''
+    i = np.flatnonzero(sentence[:len(tokens) - n + 1] == sentence[n - 1:])
+    code = tokens[i]
+    for k in range(1, n):
+        code = code * V + tokens[i + k]
+    return np.unique(code, return_counts=True)
+
+
+def kneser_ney(ids, offsets, words, bits=8):
+    '''
+    param:
+        ids(np.array), offsets(np.array): token id stream of the sentences, sentence i
+            is ids[offsets[i]:offsets[i + 1]] (e.g. Segments.zh_ids / zh_offsets)
+        words(list): id -> word of the stream ids
+        bits(int): 8 or 16, log-prob quantization
+    return:
+        arrays for write_store (see the layout above), vocabulary(list), metadata(dict)
+    '''
+    used, inverse = np.unique(np.asarray(ids), return_inverse=True)
+    vocab = SPECIALS + [words[int(i)] for i in used]
+    V = len(vocab)
+    if V ** 3 >= 1 << 63:
+        raise ValueError(f"vocabulary of {V} words is too large for int64 trigram codes")
+
+    # <s> w1 ... wn </s> for every sentence
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    starts = offsets[:-1] + 2 * np.arange(len(lengths))
+    tokens = np.empty(len(inverse) + 2 * len(lengths), dtype=np.int64)
+    inside = np.ones(len(tokens), dtype=bool)
+    inside[starts] = False
+    inside[starts + lengths + 1] = False
+    tokens[starts] = BOS
+    tokens[starts + lengths + 1] = EOS
+    tokens[inside] = inverse + len(SPECIALS)
+    sentence = np.repeat(np.arange(len(lengths)), lengths + 2)
+
+    tri_code, tri_count = ngrams(tokens, sentence, 3, V)
+    bi_code, bi_count = ngrams(tokens, sentence, 2, V)
+    bi_ctx, bi_word = bi_code // V, bi_code % V
+    tri_ctx, tri_word = tri_code // V, tri_code % V
+    tri_parent = np.searchsorted(bi_code, tri_ctx)
+    tri_lower = np.searchsorted(bi_code, tri_code % (V * V))
+
+    # adjusted counts: continuation counts N1+(. w) / N1+(. v w), raw counts after <s>
+    bi_adjusted = np.bincount(tri_lower, minlength=len(bi_code)).astype(np.float64)
+    bi_adjusted[bi_ctx == BOS] = bi_count[bi_ctx == BOS]
+    uni_adjusted = np.bincount(bi_word, minlength=V).astype(np.float64)
+    tri_adjusted = tri_count.astype(np.float64)
+    d1, d2, d3 = discount(uni_adjusted[uni_adjusted > 0]), discount(bi_adjusted), discount(tri_adjusted)
+
+    # unigram, interpolated with the uniform distribution (covers <unk>)
+    total = uni_adjusted.sum()
+    uni_p = (np.maximum(uni_adjusted - d1, 0) + d1 * np.count_nonzero(uni_adjusted) / V) / total
+
+    # bigram: p(w | v) = max(a - D2, 0) / a(v .) + gamma(v) p(w)
+    bi_total = np.bincount(bi_ctx, weights=bi_adjusted, minlength=V)
+    bi_types = np.bincount(bi_ctx, minlength=V)
+    uni_gamma = np.divide(d2 * bi_types, bi_total, out=np.ones(V), where=bi_total > 0)
+    bi_p = np.maximum(bi_adjusted - d2, 0) / bi_total[bi_ctx] + uni_gamma[bi_ctx] * uni_p[bi_word]
+
+    # trigram: p(x | v w) = max(a - D3, 0) / a(v w .) + gamma(v w) p(x | w)
+    tri_total = np.bincount(tri_parent, weights=tri_adjusted, minlength=len(bi_code))
+    tri_types = np.bincount(tri_parent, minlength=len(bi_code))
+    bi_gamma = np.divide(d3 * tri_types, tri_total, out=np.ones(len(bi_code)), where=tri_total > 0)
+    tri_p = np.maximum(tri_adjusted - d3, 0) / tri_total[tri_parent] + bi_gamma[tri_parent] * bi_p[tri_lower]
+
+    uni_ptr = np.searchsorted(bi_ctx, np.arange(V + 1)).astype(np.int64)
+    bi_ptr = np.append(np.searchsorted(tri_ctx, bi_code), len(tri_code)).astype(np.int64)
+    has_children = np.diff(bi_ptr) > 0
+    bi_next = np.where(has_children, V + np.arange(len(bi_code)), bi_word)
+    tri_next = np.where(has_children[tri_lower], V + tri_lower, tri_word)
+
+    arrays = {"uni.ptr": uni_ptr,
+              "bi.word": bi_word.astype(np.int32), "bi.ptr": bi_ptr, "bi.next": bi_next.astype(np.int32),
+              "tri.word": tri_word.astype(np.int32), "tri.next": tri_next.astype(np.int32)}
+    for name, values in [("uni.logp", np.log(uni_p)), ("uni.backoff", np.log(uni_gamma)),
+                         ("bi.logp", np.log(bi_p)), ("bi.backoff", np.log(bi_gamma)),
+                         ("tri.logp", np.log(tri_p))]:
+        arrays[name], arrays[f"{name}.codebook"] = quantize(values, bits)
+    meta = {"order": 3, "bits": bits, "discounts": [d1, d2, d3],
+            "unigrams": V, "bigrams": len(bi_code), "trigrams": len(tri_code)}
+    return arrays, vocab, meta
+
+
+class LanguageModel:
+    '''
+    scoring view of a trie written by kneser_ney, memory-mapped from a Store
+        score(state, word): log p(word | state), next state; state None is the
+            start of the sentence
+        best(word): largest log-prob of word in any context (future cost estimate)
+    '''
+    def __init__(self, store, memo_size=1 << 20):
+        self.vocab = store.strings("vocab")
+        self.V = len(self.vocab)
+        self.uni_ptr = store["uni.ptr"]
+        self.bi_word, self.bi_ptr, self.bi_next = store["bi.word"], store["bi.ptr"], store["bi.next"]
+        self.tri_word, self.tri_next = store["tri.word"], store["tri.next"]
+        self.codes = {}
+        self.codebooks = {}
+        for name in ["uni.logp", "uni.backoff", "bi.logp", "bi.backoff", "tri.logp"]:
+            self.codes[name] = store[name]
+            self.codebooks[name] = store[f"{name}.codebook"].tolist()
+        self.memo = {}
+        self.memo_size = memo_size
+        self.bi_rows = {}
+        self.tri_rows = {}
+        self.best_logp = None
+
+    def value(self, name, i):
+        return self.codebooks[name][self.codes[name][i]]
+
+    def row(self, rows, key, ptr, words, logp, next_state):
+        '''
+        return:
+            word ids, log-probs and next states of the sorted range key, as lists
+        '''
+        row = rows.get(key)
+        if row is None:
+            lo, hi = int(ptr[key]), int(ptr[key + 1])
+            codebook = self.codebooks[logp]
+            row = rows[key] = (words[lo:hi].tolist(), [codebook[c] for c in self.codes[logp][lo:hi].tolist()],
+                               next_state[lo:hi].tolist())
+        return row
+
+    def word_id(self, word):
+        # the vocabulary memoizes the ids it finds
+        return self.vocab.get(word, UNK)
+
+    def score(self, state, word):
+        '''
+        param:
+            state(int): from a previous score(), None at the start of the sentence
+            word(str): next word
+        return:
+            log p(word | state), next state
+        '''
+        w = self.word_id(word)
+        key = (BOS if state is None else state) * self.V + w
+        result = self.memo.get(key)
+        if result is None:
+            if len(self.memo) >= self.memo_size:
+                self.memo.clear()
+                self.bi_rows.clear()
+                self.tri_rows.clear()
+            result = self.memo[key] = self.score_id(BOS if state is None else state, w)
+        return result
+
+    def score_id(self, state, w):
+        V = self.V
+        backoff = 0.0
+        if state >= V:
+            k = state - V
+            words, logp, next_state = self.row(self.tri_rows, k, self.bi_ptr, self.tri_word, "tri.logp", self.tri_next)
+            i = bisect_left(words, w)
+            if i < len(words) and words[i] == w:
+                return logp[i], next_state[i]
+            backoff += self.value("bi.backoff", k)
+            state = int(self.bi_word[k])
+        words, logp, next_state = self.row(self.bi_rows, state, self.uni_ptr, self.bi_word, "bi.logp", self.bi_next)
+        i = bisect_left(words, w)
+        if i < len(words) and words[i] == w:
+            return backoff + logp[i], next_state[i]
+        backoff += self.value("uni.backoff", state)
+        return backoff + self.value("uni.logp", w), w
+
+    def best(self, word):
+        if self.best_logp is None:
+            best = np.array(self.codebooks["uni.logp"])[self.codes["uni.logp"]]
+            np.maximum.at(best, self.bi_word, np.array(self.codebooks["bi.logp"])[self.codes["bi.logp"]])
+            np.maximum.at(best, self.tri_word, np.array(self.codebooks["tri.logp"])[self.codes["tri.logp"]])
+            self.best_logp = best.tolist()
+        return self.best_logp[self.word_id(word)]
+
+    def sentence_logp(self, words, eos=True):
+        '''
+        log p of a whole sentence, with the end of sentence by default
+        '''
+        state = None
+        total = 0.0
+        for word in list(words) + (["</s>"] if eos else []):
+            logp, state = self.score(state, word)
+            total += logp
+        return total
+
+    def perplexity(self, sentences):
+        n = sum(len(s) + 1 for s in sentences)
+        return math.exp(-sum(self.sentence_logp(s) for s in sentences) / n) if n else 0.0
@@ -0,0 +1,185 @@
+import heapq
+import math
+from operator import attrgetter
+from profiling import profiler
+
+
+class Hypothesis:
+    '''
+    partial translation, the target sentence is recovered through the parent
+    back-pointers instead of being copied on every expansion
+    '''
+    __slots__ = ("score", "estimate", "trans_cost", "lang_cost", "distort_cost",
+                 "coverage", "pos", "state", "phrase", "parent")
+
+    def __init__(self, score, estimate, trans_cost, lang_cost, distort_cost, coverage, pos, state, phrase, parent):
+        self.score = score
+        self.estimate = estimate    # score + future cost of the uncovered source words
+        self.trans_cost = trans_cost
+        self.lang_cost = lang_cost
+        self.distort_cost = distort_cost
+        self.coverage = coverage    # bitmask of translated source positions
+        self.pos = pos              # last translated source position
+        self.state = state          # language model context
+        self.phrase = phrase        # target words of the last step
+        self.parent = parent
+
+    def sentence(self):
+        words = []
+        hyp = self
+        while hyp.parent is not None:
+            words.extend(reversed(hyp.phrase))
+            hyp = hyp.parent
+        return words[::-1]
+
+
+class StackDecoder:
+    '''
+    Stack decoder for MEM.Model: stack i holds hypotheses covering i source
+    words, a step translates a span of one or more source words (a phrase)
+    and adds to the stack of its new coverage. Hypotheses with the same coverage, last position and language
+    model state share their future, so only the best of them is kept
+    (recombination). Stacks are ranked by score + future cost and pruned to
+    model.stack_size (histogram) and to model.beam_threshold below the best
+    (threshold); model.distortion_limit bounds the reordering jump.
+    '''
+    def __init__(self, model):
+        self.model = model
+
+    def future_cost_table(self, options):
+        '''
+        param:
+            options(list): see decode
+        return:
+            future[i][j]: best weighted score for translating source span i..j-1
+                without context (translation + lm_future estimate)
+        '''
+        model = self.model
+        n = len(options)
+        future = [[-math.inf] * (n + 1) for _ in range(n + 1)]
+        for i in range(n):
+            for end, translations in options[i]:
+                for phrase, log_p in translations:
+                    cost = model.weight_trans * log_p + model.weight_lang * sum(model.lm_future(w) for w in phrase)
+                    future[i][end] = max(future[i][end], cost)
+        for length in range(2, n + 1):
+            for i in range(n - length + 1):
+                j = i + length
+                for k in range(i + 1, j):
+                    future[i][j] = max(future[i][j], future[i][k] + future[k][j])
+        return future
+
+    def future_cost(self, future, coverage, n):
+        cost = 0
+        start = -1
+        for i in range(n + 1):
+            if i < n and not coverage >> i & 1:
+                if start < 0:
+                    start = i
+            elif start >= 0:
+                cost += future[start][i]
+                start = -1
+        return cost
+
+    def decode(self, options):
+        '''
+        param:
+            options(list): for every source position i, [(end, [(zh words, log p), ...]), ...]
+                the translations of the span i..end-1, spans sorted by end
+        return:
+            best Hypothesis, None if no complete translation was found
+        '''
+        model = self.model
+        n = len(options)
+        stack_size = model.stack_size
+        beam_threshold = model.beam_threshold
+        limit = model.distortion_limit if model.distortion_limit is not None else n
+        log_alpha = math.log(model.alpha)
+        future = self.future_cost_table(options)
+        future_cache = {}
+        lm_cache = {}
+        generated = pruned = recombined = 0
+
+        # per stack: recombination dict, min-heap of the stack_size best estimates
+        # seen so far, best estimate
+        best = [{} for _ in range(n + 1)]
+        threshold = [[] for _ in range(n + 1)]
+        best_estimate = [-math.inf] * (n + 1)
+
+        stack = [Hypothesis(0, future[0][n], 0, 0, 0, 0, -1, None, None, None)]
+        for covered in range(n + 1):
+            if covered > 0:
+                stack = heapq.nlargest(stack_size, best[covered].values(), key=attrgetter("estimate"))
+                if beam_threshold is not None:
+                    stack = [h for h in stack if h.estimate >= best_estimate[covered] - beam_threshold]
+                pruned += len(best[covered]) - len(stack)
+                best[covered] = None
+            if covered == n:
+                break
+            for parent in stack:
+                # first uncovered position, the decoder has to be able to jump back to it
+                first = 0
+                while parent.coverage >> first & 1:
+                    first += 1
+                for j in range(max(first, parent.pos + 1 - limit), min(n, parent.pos + 2 + limit)):
+                    if parent.coverage >> j & 1:
+                        continue
+                    distort_cost = parent.distort_cost + abs(parent.pos - j + 1) * log_alpha
+                    for end, translations in options[j]:
+                        span = ((1 << (end - j)) - 1) << j
+                        # longer spans overlap / jump as well
+                        if parent.coverage & span:
+                            break
+                        if j != first and end - first > limit:
+                            break
+                        coverage = parent.coverage | span
+                        if coverage not in future_cache:
+                            future_cache[coverage] = self.future_cost(future, coverage, n)
+                        future_j = future_cache[coverage]
+                        size = covered + end - j
+                        stack_best, stack_threshold = best[size], threshold[size]
+                        generated += len(translations)
+                        for phrase, log_p in translations:
+                            lang_p = 0.0
+                            state = parent.state
+                            for zh_word in phrase:
+                                lm_key = (state, zh_word)
+                                if lm_key not in lm_cache:
+                                    lm_cache[lm_key] = model.lm_score(state, zh_word)
+                                word_p, state = lm_cache[lm_key]
+                                lang_p += word_p
+
+                            trans_cost = parent.trans_cost + log_p
+                            lang_cost = parent.lang_cost + lang_p
+                            score = model.weight_trans * trans_cost +\
+                                    model.weight_lang * lang_cost +\
+                                    model.weight_distort * distort_cost
+                            estimate = score + future_j
+                            if len(stack_threshold) == stack_size and estimate <= stack_threshold[0]:
+                                pruned += 1
+                                continue
+                            if beam_threshold is not None and estimate < best_estimate[size] - beam_threshold:
+                                pruned += 1
+                                continue
+                            best_estimate[size] = max(best_estimate[size], estimate)
+
+                            key = (coverage, end - 1, state)
+                            old = stack_best.get(key)
+                            if old is None:
+                                if len(stack_threshold) < stack_size:
+                                    heapq.heappush(stack_threshold, estimate)
+                                else:
+                                    heapq.heappushpop(stack_threshold, estimate)
+                            else:
+                                recombined += 1
+                                if old.score >= score:
+                                    continue
+                            stack_best[key] = Hypothesis(score, estimate, trans_cost, lang_cost, distort_cost,
+                                                         coverage, end - 1, state, phrase, parent)
+
+        if profiler.enabled:
+            profiler.count("mem.hypotheses_generated", generated)
+            profiler.count("mem.hypotheses_pruned", pruned)
+            profiler.count("mem.hypotheses_recombined", recombined)
+            profiler.count("mem.lm_lookups", len(lm_cache))
+        return stack[0] if stack and n > 0 else None
@@ -0,0 +1,293 @@
+import math
+import numpy as np
+from preprocess.store import Vocab, build_csr, pack_strings
+from profiling import profiler
+
+
+def prune_transitions(HMM_A, top_k=None, mass=None):
+    '''
+    keep the most likely successors of every predecessor in HMM_A
+    param:
+        top_k(int): at most top_k successors per predecessor
+        mass(float): the fewest successors covering this share of the
+            probability mass, e.g. 0.95
+    return:
+        pruned HMM_A (same format), backoff(dict): predecessor -> mean
+        probability of its dropped successors, only for predecessors that lost some
+    '''
+    pruned = {}
+    backoff = {}
+    for zh1, successors in HMM_A.items():
+        ranked = sorted(successors.items(), key=lambda x: x[1], reverse=True)
+        keep = len(ranked)
+        if top_k is not None:
+            keep = min(keep, top_k)
+        if mass is not None:
+            total = 0
+            for k, (_, p) in enumerate(ranked[:keep]):
+                total += p
+                if total >= mass:
+                    keep = k + 1
+                    break
+        pruned[zh1] = dict(ranked[:keep])
+        dropped = [p for _, p in ranked[keep:]]
+        if dropped:
+            backoff[zh1] = sum(dropped) / len(dropped)
+    return pruned, backoff
+
+
+class ViterbiEngine:
+    '''
+    Vectorized log-space Viterbi decoder for the HMM.
+
+    Chinese states and English words share one interned vocabulary. The
+    tables are kept as log-probability arrays:
+        log_pi: log PI for the first len(log_pi) ids (the HMM_PI keys, in order)
+        A:      CSR indexed by successor, holding sorted predecessor ids
+        B:      CSR indexed by English word, holding sorted state ids
+        cand:   CSR indexed by English word, holding the map.json candidates
+        a_backoff: log-prob of a transition missing from A, per predecessor id,
+                   None (or -inf) keeps missing transitions impossible
+    Each step is a max / argmax over the candidate x predecessor matrix.
+    Steps of at most small_step cells (most of them with a few candidates per
+    word) are computed in Python over rows read into dicts once, the numpy
+    calls would cost more than the arithmetic; both paths give the same scores.
+    beam_width / beam_margin prune the states of every position like HMM.Model.prune.
+    '''
+    def __init__(self, vocab, log_pi, a, b, cand, a_backoff=None, small_step=256):
+        self.vocab = vocab
+        self.log_pi = log_pi
+        self.a_indptr, self.a_indices, self.a_logp = a
+        self.b_indptr, self.b_indices, self.b_logp = b
+        self.c_indptr, self.c_indices = cand[0], cand[1]
+        self.a_backoff = a_backoff
+        self.beam_width = None
+        self.beam_margin = None
+        self.small_step = small_step
+        self.a_rows = {}
+        self.b_rows = {}
+        self.backoff_list = None
+
+    @classmethod
+    def from_tables(cls, HMM_PI, HMM_A, HMM_B, map, backoff=None):
+        '''
+        build the engine from the json tables loaded by HMM.Model
+        param:
+            backoff(dict): predecessor -> probability of its pruned
+                transitions, see prune_transitions
+        '''
+        # PI keys first, so id order equals the iteration order of HMM_PI
+        vocab = Vocab(HMM_PI)
+        log_pi = np.array([math.log(HMM_PI[key]) for key in HMM_PI], dtype=np.float64)
+
+        # the reference decoder treats log-prob 0 (p == 1) as a missing entry,
+        # drop those here as well so both decoders give the same output
+        a_rows = {}
+        for zh1 in HMM_A:
+            i = vocab.add(zh1)
+            for zh2, p in HMM_A[zh1].items():
+                log_p = math.log(p)
+                if log_p < 0:
+                    a_rows.setdefault(vocab.add(zh2), []).append((i, log_p))
+
+        b_rows = {}
+        for zh in HMM_B:
+            i = vocab.add(zh)
+            for en, p in HMM_B[zh].items():
+                log_p = math.log(p)
+                if log_p < 0:
+                    b_rows.setdefault(vocab.add(en), []).append((i, log_p))
+
+        c_rows = {}
+        for en in map:
+            seen = set()
+            entries = []
+            for zh in map[en]:
+                i = vocab.add(zh)
+                if i not in seen:
+                    seen.add(i)
+                    entries.append((i, None))
+            c_rows[vocab.add(en)] = entries
+
+        n = len(vocab)
+        a = build_csr(a_rows, n)
+        b = build_csr(b_rows, n)
+        cand = build_csr(c_rows, n, sort=False)[:2]
+        a_backoff = None
+        if backoff:
+            a_backoff = np.full(n, -np.inf)
+            for zh1, p in backoff.items():
+                a_backoff[vocab.get(zh1)] = math.log(p)
+        return cls(vocab, log_pi, a, b, cand, a_backoff)
+
+    @classmethod
+    def from_store(cls, store):
+        '''
+        build the engine on top of a memory-mapped HMM.bin (see Dataset.compile_tables)
+        '''
+        a = store.csr("A")
+        b = store.csr("B")
+        cand = store["cand.indptr"], store["cand.indices"]
+        a_backoff = store["A.backoff"] if "A.backoff" in store else None
+        return cls(store.strings("vocab"), store["PI.logp"], a, b, cand, a_backoff)
+
+    def arrays(self):
+        '''
+        arrays to write with preprocess.store.write_store, the inverse of from_store
+        '''
+        arrays = pack_strings(self.vocab, "vocab")
+        arrays["PI.logp"] = self.log_pi
+        arrays.update({"A.indptr": self.a_indptr, "A.indices": self.a_indices, "A.logp": self.a_logp})
+        arrays.update({"B.indptr": self.b_indptr, "B.indices": self.b_indices, "B.logp": self.b_logp})
+        arrays.update({"cand.indptr": self.c_indptr, "cand.indices": self.c_indices})
+        if self.a_backoff is not None:
+            arrays["A.backoff"] = self.a_backoff
+        return arrays
+
+    def lookup(self, indptr, indices, values, row, cols, default=None):
+        '''
+        values of the sorted CSR row `row` at the column ids `cols`, -inf
+        (or default[cols]) if absent
+        '''
+        lo, hi = indptr[row], indptr[row + 1]
+        out = np.full(len(cols), -np.inf) if default is None else default[cols]
+        if lo == hi:
+            return out
+        keys = indices[lo:hi]
+        pos = np.searchsorted(keys, cols)
+        np.minimum(pos, hi - lo - 1, out=pos)
+        hit = keys[pos] == cols
+        out[hit] = values[lo:hi][pos[hit]]
+        return out
+
+    def row(self, rows, indptr, indices, values, row):
+        '''
+        {column id: value} of a CSR row, memoized
+        '''
+        entries = rows.get(row)
+        if entries is None:
+            lo, hi = indptr[row], indptr[row + 1]
+            entries = rows[row] = dict(zip(indices[lo:hi].tolist(), values[lo:hi].tolist()))
+        return entries
+
+    def step_small(self, en, cands, states, delta):
+        '''
+        one Viterbi step in Python, same scores and ties as the numpy step
+        return:
+            delta, psi (lists over cands)
+        '''
+        if self.a_backoff is not None and self.backoff_list is None:
+            self.backoff_list = self.a_backoff.tolist()
+        backoff = self.backoff_list
+        log_pb = self.row(self.b_rows, self.b_indptr, self.b_indices, self.b_logp, en)
+        new_delta, psi = [], []
+        for zh_t in cands:
+            log_pa = self.row(self.a_rows, self.a_indptr, self.a_indices, self.a_logp, zh_t)
+            pb = log_pb.get(zh_t, -math.inf)
+            best, arg = -math.inf, 0
+            for k, zh in enumerate(states):
+                pa = log_pa.get(zh)
+                if pa is None:
+                    pa = -math.inf if backoff is None else backoff[zh]
+                score = (delta[k] + pa) + pb
+                if score > best:
+                    best, arg = score, k
+            if best > -1e6:
+                new_delta.append(best)
+                psi.append(arg)
+            else:
+                new_delta.append(-1e6)
+                psi.append(-1)
+        return new_delta, psi
+
+    def prune(self, delta):
+        '''
+        return:
+            sorted positions of the states kept, None if all are kept
+        '''
+        keep = None
+        if self.beam_margin is not None:
+            keep = np.flatnonzero(delta >= delta.max() - self.beam_margin)
+        if self.beam_width is not None and len(delta if keep is None else keep) > self.beam_width:
+            if keep is None:
+                keep = np.arange(len(delta))
+            # stable sort, equal scores keep the earlier state like heapq.nlargest
+            top = np.argsort(-delta[keep], kind="stable")[:self.beam_width]
+            keep = np.sort(keep[top])
+        return keep
+
+    def decode(self, en_seg_list):
+        '''
+        param:
+            en_seg_list(list): lower-cased English tokens
+        return:
+            target(str)
+        '''
+        T = len(en_seg_list)
+        if T == 0:
+            return ""
+        en_ids = [self.vocab.get(w) for w in en_seg_list]
+
+        # step 0: states with a valid emission for the first word
+        en = en_ids[0]
+        if en < 0:
+            return ""
+        lo, hi = self.b_indptr[en], self.b_indptr[en + 1]
+        states = self.b_indices[lo:hi]
+        keep = states < len(self.log_pi)
+        states = states[keep]
+        delta = self.log_pi[states] + self.b_logp[lo:hi][keep]
+        if len(states) == 0:
+            return ""
+        keep = self.prune(delta)
+        if keep is not None:
+            states, delta = states[keep], delta[keep]
+
+        lattice = [states]
+        backptr = [None]
+        lookups = 0
+        for i in range(1, T):
+            en = en_ids[i]
+            if en < 0:
+                return ""
+            cands = self.c_indices[self.c_indptr[en]:self.c_indptr[en + 1]]
+            if len(cands) == 0:
+                return ""
+
+            lookups += len(cands) * len(states)
+            if len(cands) * len(states) <= self.small_step:
+                delta, psi = self.step_small(en, cands.tolist(), states.tolist(), delta.tolist())
+                delta, psi = np.array(delta), np.array(psi)
+            else:
+                log_pb = self.lookup(self.b_indptr, self.b_indices, self.b_logp, en, cands)
+                log_pa = np.empty((len(cands), len(states)))
+                for k, zh_t in enumerate(cands):
+                    log_pa[k] = self.lookup(self.a_indptr, self.a_indices, self.a_logp, zh_t, states, self.a_backoff)
+
+                scores = (delta[None, :] + log_pa) + log_pb[:, None]
+                psi = np.argmax(scores, axis=1)
+                best = scores[np.arange(len(cands)), psi]
+                valid = best > -1e6
+                delta = np.where(valid, best, -1e6)
+                psi = np.where(valid, psi, -1)
+            keep = self.prune(delta)
+            if keep is not None:
+                cands, delta, psi = cands[keep], delta[keep], psi[keep]
+            backptr.append(psi)
+            lattice.append(cands)
+            states = cands
+
+        if profiler.enabled:
+            profiler.count("hmm.viterbi_steps", T)
+            profiler.count("hmm.states_expanded", sum(len(states) for states in lattice))
+            profiler.count("hmm.transition_lookups", lookups)
+
+        k = int(np.argmax(delta))
+        if not delta[k] > -1e6:
+            return ""
+        target = []
+        for i in range(T - 1, -1, -1):
+            target.append(self.vocab[int(lattice[i][k])])
+            if i > 0:
+                k = int(backptr[i][k])
+        return "".join(reversed(target))
@@ -1,39 +1,66 @@
 import xml.etree.ElementTree as ET
 from tqdm import tqdm
 import os
-import jieba
-import nltk
 import json
+from itertools import islice
+from preprocess.segment import load_segments
+from preprocess import resources
+from preprocess.tables import build_tables, smooth
+from preprocess.phrases import build_phrase_table
+from models.viterbi import ViterbiEngine, prune_transitions
+from models.lm import kneser_ney
+from preprocess.store import Vocab, write_store, pack_strings, pack_csr, pack_vector, dict_table_rows, list_table_rows
 
 class Dataset:
-    def __init__(self, type="train", year=2010):
+    def __init__(self, type="train", year=2010, streaming=False):
         '''
         param:
             type(str): train / validate / test
             year(int): 2010-2015 (specify the test file)
+            streaming(bool): don't load the corpus into memory, read it with
+                iter_items / iter_chunks instead
         '''
         self.type = type
         self.data_root = "data/zh-en"
+        self.segments = None
+
+        if streaming:
+            self.data = None
+            self.corpus_files = self.get_corpus_files(type, year)
+        else:
+            print("loading data ...")
+            if self.type == "train":
+                self.load_train_data()
+            elif self.type == "validate":
+                self.load_validate_data()
+            elif self.type == "test":
+                self.load_test_data(year)
 
-        print("loading data ...")
-        if self.type == "train":
-            self.load_train_data()
-        elif self.type == "validate":
-            self.load_validate_data()
-        elif self.type == "test":
-            self.load_test_data(year)
-        
         self.exp_dir = "exps_MEM"
         self.exp_dir_hmm = "exps_HMM"
         if not os.path.exists(self.exp_dir):
             os.mkdir(self.exp_dir)
-        nltk.download('punkt')
+        resources.ensure_punkt()
     
+    def get_corpus_files(self, type, year=2010):
+        '''
+        return:
+            [English file, Chinese file]
+        '''
+        if type == "train":
+            names = ["train.tags.zh-en.en", "train.tags.zh-en.zh"]
+        elif type == "validate":
+            names = ["IWSLT17.TED.dev2010.zh-en.en.xml", "IWSLT17.TED.dev2010.zh-en.zh.xml"]
+        else:
+            names = [f"IWSLT17.TED.tst{year}.zh-en.en.xml", f"IWSLT17.TED.tst{year}.zh-en.zh.xml"]
+        return [os.path.join(self.data_root, name) for name in names]
+
     def load_train_data(self):
         self.data = []
 
-        corpus_en_file = open(os.path.join(self.data_root, "train.tags.zh-en.en"), encoding='utf-8')
-        corpus_zh_file = open(os.path.join(self.data_root, "train.tags.zh-en.zh"), encoding='utf-8')
+        self.corpus_files = self.get_corpus_files("train")
+        corpus_en_file = open(self.corpus_files[0], encoding='utf-8')
+        corpus_zh_file = open(self.corpus_files[1], encoding='utf-8')
 
         corpus_en = corpus_en_file.readlines()
         corpus_zh = corpus_zh_file.readlines()
@@ -59,8 +86,9 @@ class Dataset:
         zh_data = []
         self.data = []
 
-        corpus_en_file = open(os.path.join(self.data_root, "IWSLT17.TED.dev2010.zh-en.en.xml"), encoding='utf-8')
-        corpus_zh_file = open(os.path.join(self.data_root, "IWSLT17.TED.dev2010.zh-en.zh.xml"), encoding='utf-8')
+        self.corpus_files = self.get_corpus_files("validate")
+        corpus_en_file = open(self.corpus_files[0], encoding='utf-8')
+        corpus_zh_file = open(self.corpus_files[1], encoding='utf-8')
 
         en_tree = ET.parse(corpus_en_file)
         en_root = en_tree.getroot()[0]
@@ -91,8 +119,9 @@ class Dataset:
         zh_data = []
         self.data = []
 
-        corpus_en_file = open(os.path.join(self.data_root, f"IWSLT17.TED.tst{year}.zh-en.en.xml"), encoding='utf-8')
-        corpus_zh_file = open(os.path.join(self.data_root, f"IWSLT17.TED.tst{year}.zh-en.zh.xml"), encoding='utf-8')
+        self.corpus_files = self.get_corpus_files("test", year)
+        corpus_en_file = open(self.corpus_files[0], encoding='utf-8')
+        corpus_zh_file = open(self.corpus_files[1], encoding='utf-8')
 
         en_tree = ET.parse(corpus_en_file)
         en_root = en_tree.getroot()[0]
@@ -118,6 +147,59 @@ class Dataset:
         corpus_en_file.close()
         corpus_zh_file.close()
     
+    def iter_train_lines(self, en_path, zh_path):
+        with open(en_path, encoding='utf-8') as corpus_en_file, open(zh_path, encoding='utf-8') as corpus_zh_file:
+            for en, zh in zip(corpus_en_file, corpus_zh_file):
+                en = en.strip()
+                zh = zh.strip()
+                if en[0] == '<': # meta-description, just discard it
+                    continue
+                yield en, zh
+
+    def iter_xml_segs(self, path):
+        with open(path, encoding='utf-8') as corpus_file:
+            for _, elem in ET.iterparse(corpus_file, events=("end",)):
+                if elem.tag == "seg":
+                    yield elem.text.strip()
+                    elem.clear()
+                elif elem.tag == "doc":
+                    elem.clear()
+
+    def iter_items(self):
+        '''
+        stream the pairs one by one, in streaming mode without keeping the corpus in memory
+        yield:
+            {'en': 'xxx', 'zh': 'yyy'}
+        '''
+        if self.data is not None:
+            yield from self.data
+            return
+
+        en_path, zh_path = self.corpus_files
+        if self.type == "train":
+            pairs = self.iter_train_lines(en_path, zh_path)
+        else:
+            pairs = zip(self.iter_xml_segs(en_path), self.iter_xml_segs(zh_path))
+        for en, zh in pairs:
+            # optional, remove the blank space in the chinese sentence
+            yield {"en": en, "zh": zh.replace(" ", "")}
+
+    def iter_chunks(self, size):
+        '''
+        param:
+            size(int): number of pairs per chunk
+        yield:
+            [{'en': 'xxx', 'zh': 'yyy'}, ...] with at most size pairs
+        '''
+        chunk = []
+        for pair in self.iter_items():
+            chunk.append(pair)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
     def build_vocab(self):
         '''
         build English & Chinese vocabulary dictionary
@@ -132,16 +214,15 @@ class Dataset:
         self.en_word_n = 0
         self.zh_word_n = 0
 
-        corpus = self.get_all_item()
-        for pair in tqdm(corpus):
+        segments = self.get_segments()
+        for i in tqdm(range(len(segments))):
             # English
             # divide with nltk
             self.en_word2idx['<unk>'] = {"idx": 0, "count": 0}
             self.en_idx2word[0] = {"word": '<unk>', "count": 0}
 
-            en_seg_list = nltk.word_tokenize(pair['en'])
+            en_seg_list = segments.en(i)
             for w in en_seg_list:
-                w = w.lower() 
                 if w not in self.en_word2idx: # first appear
                     self.en_word_n += 1
                     self.en_word2idx[w] = {"idx": self.en_word_n, "count": 1}
@@ -152,7 +233,7 @@ class Dataset:
                     self.en_idx2word[word_idx]["count"] += 1
             # Chinese
             # divide with jieba
-            zh_seg_list = list(jieba.cut(pair['zh'], cut_all=False))
+            zh_seg_list = segments.zh(i)
             for w in zh_seg_list:
                 if w not in self.zh_word2idx: # first appear
                     self.zh_word_n += 1
@@ -163,7 +244,7 @@ class Dataset:
                     word_idx = self.zh_word2idx[w]["idx"]
                     self.zh_idx2word[word_idx]["count"] += 1
             
-            write_list = [w.lower() + ' ' for w in en_seg_list] + [' ', '|||', ' '] +  [w + ' ' for w in zh_seg_list]
+            write_list = [w + ' ' for w in en_seg_list] + [' ', '|||', ' '] +  [w + ' ' for w in zh_seg_list]
             align_file.writelines(write_list)
             align_file.write('\n')
 
@@ -185,15 +266,14 @@ class Dataset:
     def build_translate_table(self):
         align_file = open(os.path.join(self.exp_dir, "forward.align"), encoding='utf-8')
         align_corpus = align_file.readlines()
-        corpus = self.get_all_item()
+        segments = self.get_segments()
 
         # calculate translate table
         self.support = {}
         for i in tqdm(range(len(align_corpus))):
             sentence = align_corpus[i].strip().split(' ')
-            en_seg_list = nltk.word_tokenize(corpus[i]['en'])
-            en_seg_list = [w.lower() for w in en_seg_list]
-            zh_seg_list = list(jieba.cut(corpus[i]['zh'], cut_all=False))
+            en_seg_list = segments.en(i)
+            zh_seg_list = segments.zh(i)
 
             for w in sentence:
                 if w == '':
@@ -223,13 +303,31 @@ class Dataset:
         with open(os.path.join(self.exp_dir, "translate_table.json"), 'w', encoding='utf8') as json_file:
             json.dump(self.support, json_file, ensure_ascii=False)
 
+    def build_phrase_table(self, max_length=3, min_count=1, workers=1):
+        '''
+        phrase pairs of up to max_length words consistent with forward.align,
+        written to exps_MEM/phrase_table.bin (see preprocess/phrases.py), used by
+        MEM.Model(phrases=True)
+        param:
+            max_length(int): longest source / target phrase, in words
+            min_count(int): drop the multi-word phrase pairs seen fewer times
+            workers(int): extraction processes, one corpus shard at a time
+        '''
+        align_path = os.path.join(self.exp_dir, "forward.align")
+        if not os.path.exists(align_path):
+            print("forward.align Not Found.")
+            return
+        arrays, meta = build_phrase_table(self.get_segments(workers), align_path, max_length, workers,
+                                          min_count=min_count)
+        write_store(os.path.join(self.exp_dir, "phrase_table.bin"), arrays, meta=meta)
+
     def build_language_model(self):
         language_model = {"start_word": {}, "2-gram": {}}
-        corpus = self.get_all_item()
+        segments = self.get_segments()
         start_n = 0
-        for pair in tqdm(corpus):
+        for i in tqdm(range(len(segments))):
             # Chinese, divide with jieba
-            zh_seg_list = list(jieba.cut(pair['zh'], cut_all=False))
+            zh_seg_list = segments.zh(i)
             # fist word
             start_n += 1
             first_word = zh_seg_list[0]
@@ -263,12 +361,24 @@ class Dataset:
         with open(os.path.join(self.exp_dir, "language_model.json"), 'w', encoding='utf8') as json_file:
             json.dump(language_model, json_file, ensure_ascii=False)
 
+    def build_kn_language_model(self, bits=8):
+        '''
+        interpolated Kneser-Ney trigram LM of the Chinese side, written to
+        exps_MEM/lm.bin as a quantized trie (see models/lm.py), MEM.Model(lm="kn")
+        param:
+            bits(int): 8 / 16, quantization of the log-probs
+        '''
+        segments = self.get_segments()
+        arrays, vocab, meta = kneser_ney(segments.zh_ids, segments.zh_offsets, segments.words, bits)
+        arrays.update(pack_strings(vocab, "vocab"))
+        write_store(os.path.join(self.exp_dir, "lm.bin"), arrays, meta=meta)
+
     def generate_HMM_PI(self):
         HMM_PI = {}
-        corpus = self.get_all_item()
+        segments = self.get_segments()
         total = 0
-        for pair in tqdm(corpus):
-            zh_seg_list = list(jieba.cut(pair['zh'], cut_all=False))
+        for i in tqdm(range(len(segments))):
+            zh_seg_list = segments.zh(i)
             total += 1
             pi_i = zh_seg_list[0]
             if pi_i not in HMM_PI:
@@ -282,11 +392,17 @@ class Dataset:
         with open(os.path.join(self.exp_dir_hmm, "HMM_PI.json"), 'w', encoding='utf8') as json_file:
             json.dump(HMM_PI, json_file, ensure_ascii=False)
 
-    def generate_HMM_A(self):
+    def generate_HMM_A(self, smoothing=None, add_k=0.1):
+        '''
+        param:
+            smoothing(str): None / "add-k" / "witten-bell", the backoff weights for
+                unseen transitions go to HMM_A_backoff.json (see preprocess.tables.smooth)
+            add_k(float): add-k pseudo count
+        '''
         HMM_A = {}
-        corpus = self.get_all_item()
-        for pair in tqdm(corpus):
-            zh_seg_list = list(jieba.cut(pair['zh'], cut_all=False))
+        segments = self.get_segments()
+        for k in tqdm(range(len(segments))):
+            zh_seg_list = segments.zh(k)
             for i in range(len(zh_seg_list) - 1):
                 w1 = zh_seg_list[i]
                 w2 = zh_seg_list[i + 1]
@@ -298,27 +414,38 @@ class Dataset:
                     else:
                         HMM_A[w1][w2] += 1.0
 
-        for key in HMM_A:
-            total = 0
-            for w in HMM_A[key]:
-                total += HMM_A[key][w]
-            for w in HMM_A[key]:
-                HMM_A[key][w] = HMM_A[key][w] / total
+        if smoothing is not None:
+            HMM_A, backoff, unigram = smooth(HMM_A, smoothing, add_k)
+            with open(os.path.join(self.exp_dir_hmm, "HMM_A_backoff.json"), 'w', encoding='utf8') as json_file:
+                json.dump({"smoothing": smoothing, "backoff": backoff, "unigram": unigram}, json_file, ensure_ascii=False)
+        else:
+            self.remove_backoff("HMM_A_backoff.json")
+            for key in HMM_A:
+                total = 0
+                for w in HMM_A[key]:
+                    total += HMM_A[key][w]
+                for w in HMM_A[key]:
+                    HMM_A[key][w] = HMM_A[key][w] / total
 
         with open(os.path.join(self.exp_dir_hmm, "HMM_A.json"), 'w', encoding='utf8') as json_file:
             json.dump(HMM_A, json_file, ensure_ascii=False)
 
-    def generate_HMM_B(self):
+    def generate_HMM_B(self, smoothing=None, add_k=0.1):
+        '''
+        param:
+            smoothing(str): None / "add-k" / "witten-bell" over the top 10 English
+                words of every state, backoff weights go to HMM_B_backoff.json
+            add_k(float): add-k pseudo count
+        '''
         align_file = open(os.path.join(self.exp_dir, "forward.align"), encoding='utf-8')
         align_corpus = align_file.readlines()
-        corpus = self.get_all_item()
+        segments = self.get_segments()
 
         HMM_B = {}
         for i in tqdm(range(len(align_corpus))):
             sentence = align_corpus[i].strip().split(' ')
-            en_seg_list = nltk.word_tokenize(corpus[i]['en'])
-            en_seg_list = [w.lower() for w in en_seg_list]
-            zh_seg_list = list(jieba.cut(corpus[i]['zh'], cut_all=False))
+            en_seg_list = segments.en(i)
+            zh_seg_list = segments.zh(i)
 
             for w in sentence:
                 if w == '':
@@ -338,25 +465,41 @@ class Dataset:
             HMM_B[key] = sorted(HMM_B[key].items(), key=lambda x: x[1], reverse=True)
             if len(HMM_B[key]) > 10:
                 HMM_B[key] = HMM_B[key][:10]
+            if smoothing is not None:
+                HMM_B[key] = dict(HMM_B[key])
+                continue
             total = 0
             for w in HMM_B[key]:
                 total += w[1]
             HMM_B[key] = {w[0]: (w[1] / total) for w in HMM_B[key]}
+        if smoothing is not None:
+            HMM_B, backoff, unigram = smooth(HMM_B, smoothing, add_k)
+            with open(os.path.join(self.exp_dir_hmm, "HMM_B_backoff.json"), 'w', encoding='utf8') as json_file:
+                json.dump({"smoothing": smoothing, "backoff": backoff, "unigram": unigram}, json_file, ensure_ascii=False)
+        else:
+            self.remove_backoff("HMM_B_backoff.json")
         with open(os.path.join(self.exp_dir_hmm, "HMM_B.json"), 'w', encoding='utf8') as json_file:
             json.dump(HMM_B, json_file, ensure_ascii=False)
 
+    def remove_backoff(self, name):
+        '''
+        an unsmoothed rebuild drops the backoff table of an earlier smoothed one
+        '''
+        path = os.path.join(self.exp_dir_hmm, name)
+        if os.path.exists(path):
+            os.remove(path)
+
     def generate_map(self):
         align_file = open(os.path.join(self.exp_dir, "forward.align"), encoding='utf-8')
         align_corpus = align_file.readlines()
-        corpus = self.get_all_item()
+        segments = self.get_segments()
 
         # calculate translate table
         self.support = {}
         for i in tqdm(range(len(align_corpus))):
             sentence = align_corpus[i].strip().split(' ')
-            en_seg_list = nltk.word_tokenize(corpus[i]['en'])
-            en_seg_list = [w.lower() for w in en_seg_list]
-            zh_seg_list = list(jieba.cut(corpus[i]['zh'], cut_all=False))
+            en_seg_list = segments.en(i)
+            zh_seg_list = segments.zh(i)
 
             for w in sentence:
                 if w == '':
@@ -383,29 +526,115 @@ class Dataset:
         with open(os.path.join(self.exp_dir_hmm, "map.json"), 'w', encoding='utf8') as json_file:
             json.dump(self.support, json_file, ensure_ascii=False)
 
+    def load_table(self, exp_dir, name):
+        path = os.path.join(exp_dir, name)
+        if not os.path.exists(path):
+            print(f"{name} Not Found.")
+            return None
+        with open(path, 'r', encoding='utf-8') as json_file:
+            return json.load(json_file)
+
+    def compile_tables(self, top_k=None, mass=None):
+        '''
+        compile the json tables into memory-mapped binary stores
+            exps_HMM/HMM.bin: HMM_PI, HMM_A, HMM_B, map (layout of models.viterbi.ViterbiEngine)
+            exps_MEM/MEM.bin: translate_table, language_model
+        load them with HMM.Model(compiled=True) / MEM.Model(compiled=True)
+        param:
+            top_k(int), mass(float): prune HMM_A to the top_k successors / the
+                successors covering `mass` of the probability per predecessor,
+                the dropped transitions share a backoff weight (models.viterbi.prune_transitions)
+        '''
+        hmm_tables = [self.load_table(self.exp_dir_hmm, name)
+                      for name in ["HMM_PI.json", "HMM_A.json", "HMM_B.json", "map.json"]]
+        if all(t is not None for t in hmm_tables):
+            backoff = None
+            if top_k is not None or mass is not None:
+                hmm_tables[1], backoff = prune_transitions(hmm_tables[1], top_k, mass)
+            engine = ViterbiEngine.from_tables(*hmm_tables, backoff=backoff)
+            write_store(os.path.join(self.exp_dir_hmm, "HMM.bin"), engine.arrays())
+
+        translate_table = self.load_table(self.exp_dir, "translate_table.json")
+        language_model = self.load_table(self.exp_dir, "language_model.json")
+        if translate_table is not None and language_model is not None:
+            vocab = Vocab()
+            translate_rows = list_table_rows(translate_table, vocab)
+            bigram_rows = dict_table_rows(language_model["2-gram"], vocab)
+            arrays = pack_vector(language_model["start_word"], vocab, "start")
+            arrays.update(pack_csr(translate_rows, len(vocab), "translate", sort=False))
+            arrays.update(pack_csr(bigram_rows, len(vocab), "2-gram"))
+            arrays.update(pack_strings(vocab, "vocab"))
+            write_store(os.path.join(self.exp_dir, "MEM.bin"), arrays)
+
+    def build_all_tables(self, workers=1, smoothing=None, add_k=0.1):
+        '''
+        build translate_table, language_model, HMM_PI, HMM_A, HMM_B and map in
+        a single pass over the corpus, sharded over `workers` processes
+        (see preprocess/tables.py), the output is the same as calling the
+        separate build_* / generate_* methods (with the same smoothing)
+        '''
+        align_path = os.path.join(self.exp_dir, "forward.align")
+        if not os.path.exists(align_path):
+            print("forward.align Not Found, skip HMM_B, map and translate_table.")
+            align_path = None
+
+        tables = build_tables(self.get_segments(workers), align_path, workers, smoothing, add_k)
+        if smoothing is None:
+            self.remove_backoff("HMM_A_backoff.json")
+            if align_path is not None:
+                self.remove_backoff("HMM_B_backoff.json")
+        exp_dirs = {"translate_table": self.exp_dir, "language_model": self.exp_dir}
+        for name, table in tables.items():
+            path = os.path.join(exp_dirs.get(name, self.exp_dir_hmm), f"{name}.json")
+            with open(path, 'w', encoding='utf8') as json_file:
+                json.dump(table, json_file, ensure_ascii=False)
+
+    def get_segments(self, workers=1):
+        '''
+        tokenized corpus, segmented once per corpus file / tokenizer version
+        and cached on disk (see preprocess/segment.py)
+        param:
+            workers(int): processes used if the corpus has to be segmented
+        return:
+            Segments, segments.en(i) / segments.zh(i) are the tokens of get_item(i)
+        '''
+        if self.segments is None:
+            self.segments = load_segments(self.corpus_files, self.iter_items(),
+                                          os.path.join(self.exp_dir, "segments"), workers)
+        return self.segments
+
     def get_data_size(self):
         '''
         get the total number of training pairs
         '''
+        if self.data is None:
+            return sum(1 for _ in self.iter_items())
         return len(self.data)
     
     def get_all_item(self):
         '''
-        get all of the training pairs
+        get all of the training pairs (in streaming mode this reads the whole corpus)
         return:
             [{'en': 'xxx', 'zh': 'yyy'},
              {'en': 'aaa', 'zh': 'bbb'},
              ...
              {'en': 'iii', 'zh': 'jjj'}]
         '''
+        if self.data is None:
+            return list(self.iter_items())
         return self.data
     
     def get_item(self, i):
         '''
-        get one of the training pair
+        get one of the training pair (in streaming mode the corpus is read up to it)
         param:
             i(int): index of training data
         return:
             {'en': 'xxx', 'zh': 'yyy'}
         '''
+        if self.data is None:
+            if i >= 0:
+                for pair in islice(self.iter_items(), i, None):
+                    return pair
+            raise IndexError(f"pair {i} is not in the corpus (streaming mode only supports 0 <= i < size)")
         return self.data[i]
@@ -0,0 +1,261 @@
+'''
+Phrase table: phrase pairs consistent with the forward.align word
+alignments, source and target up to max_length words, extracted per corpus
+shard (preprocess.tables.map_shards) and stored in a preprocess.store file
+(exps_MEM/phrase_table.bin).
+
+Layout, P source phrases over the segment vocabulary:
+    src.words[P, max_length]    word ids of the source phrases, padded with -1,
+                                rows sorted, so the phrases sharing a prefix are
+                                a contiguous range and a shorter phrase comes
+                                before its extensions
+    src.ptr[p]..src.ptr[p + 1]  translations of phrase p, most frequent first
+    src.count[p]                occurrences of phrase p in the extracted pairs
+    tgt.ptr, tgt.words          word ids of every translation
+    tgt.logp                    log p(zh phrase | en phrase), relative frequency
+    tgt.lex                     log lexical weight lex(zh phrase | en phrase), the
+                                word translation probabilities along the most
+                                frequent alignment inside the pair (Koehn et al.
+                                2003), low for a rare pair made of unlikely words
+PhraseTable.lookup narrows the row range one source word at a time with a
+binary search in the next column, so all the phrases starting at a
+position are found in at most max_length searches.
+'''
+
+from collections import Counter
+from functools import partial
+import math
+import numpy as np
+from preprocess.store import Store, pack_strings
+from preprocess.segment import Segments
+from preprocess.tables import read_lines, map_shards
+from profiling import profiler
+
+
+def extract(links, n_en, n_zh, max_length):
+    '''
+    param:
+        links(list): alignment points (en position, zh position)
+        n_en(int), n_zh(int): sentence lengths
+    return:
+        [(en start, en end, zh start, zh end), ...] spans of the consistent phrase
+        pairs: no word inside is aligned outside, unaligned zh words at the
+        border are added in every combination
+    '''
+    en_links = [[] for _ in range(n_en)]
+    zh_links = [[] for _ in range(n_zh)]
+    for e, f in links:
+        en_links[e].append(f)
+        zh_links[f].append(e)
+
+    spans = []
+    for e1 in range(n_en):
+        f1, f2 = n_zh, -1
+        for e2 in range(e1, min(n_en, e1 + max_length)):
+            for f in en_links[e2]:
+                f1, f2 = min(f1, f), max(f2, f)
+            if f2 < 0:
+                continue
+            if f2 - f1 >= max_length:
+                break
+            if any(e < e1 or e > e2 for f in range(f1, f2 + 1) for e in zh_links[f]):
+                continue
+            fs = f1
+            while fs >= 0 and (fs == f1 or not zh_links[fs]) and f2 - fs < max_length:
+                fe = f2
+                while fe < n_zh and (fe == f2 or not zh_links[fe]) and fe - fs < max_length:
+                    spans.append((e1, e2 + 1, fs, fe + 1))
+                    fe += 1
+                fs -= 1
+    return spans
+
+
+def extract_shard(args, max_length=3):
+    '''
+    return:
+        phrase pair counts {(en ids, zh ids, alignment inside the pair): n},
+        word link counts {(en id, zh id): n}, unaligned zh word counts {zh id: n}
+    '''
+    segments_path, lo, hi, align_path, align_offset, n_align = args
+    segments = Segments(Store(segments_path))
+    align_lines = read_lines(align_path, align_offset, n_align)
+
+    counts = Counter()
+    word_links = Counter()
+    unaligned = Counter()
+    for k in range(lo, min(hi, lo + len(align_lines))):
+        en_ids = segments.en_ids[segments.en_offsets[k]:segments.en_offsets[k + 1]].tolist()
+        zh_ids = segments.zh_ids[segments.zh_offsets[k]:segments.zh_offsets[k + 1]].tolist()
+        links = []
+        for w in align_lines[k - lo].strip().split(' '):
+            if w == '':
+                continue
+            links.append((int(w.split('-')[0]), int(w.split('-')[1])))
+        for e, f in links:
+            word_links[en_ids[e], zh_ids[f]] += 1
+        aligned = {f for _, f in links}
+        unaligned.update(zh_ids[f] for f in range(len(zh_ids)) if f not in aligned)
+        for e1, e2, f1, f2 in extract(links, len(en_ids), len(zh_ids), max_length):
+            inside = tuple(sorted((e - e1, f - f1) for e, f in links if e1 <= e < e2 and f1 <= f < f2))
+            counts[tuple(en_ids[e1:e2]), tuple(zh_ids[f1:f2]), inside] += 1
+    return counts, word_links, unaligned
+
+
+def lexical_weight(src, tgt, inside, word_p, null_p):
+    '''
+    log lex(tgt | src): every zh word gets the mean w(zh | en) of the en words
+    it is aligned to, w(zh | NULL) if it is unaligned
+    '''
+    logp = 0.0
+    for i, f in enumerate(tgt):
+        sources = [src[e] for e, j in inside if j == i]
+        if sources:
+            p = sum(word_p.get((e, f), 0.0) for e in sources) / len(sources)
+        else:
+            p = null_p.get(f, 0.0)
+        logp += math.log(max(p, 1e-6))
+    return logp
+
+
+def build_phrase_table(segments, align_path, max_length=3, workers=1, top_k=10, min_count=1):
+    '''
+    param:
+        segments(Segments): tokenized corpus (Dataset.get_segments)
+        align_path(str): forward.align
+        max_length(int): longest source / target phrase, in words
+        workers(int): extraction processes
+        top_k(int): translations kept per source phrase, their probabilities
+            are renormalized like translate_table
+        min_count(int): drop the phrase pairs of several source words seen fewer
+            times (single words are always kept)
+    return:
+        arrays for write_store (see the layout above), metadata(dict)
+    '''
+    with profiler.timer("preprocess.phrases"):
+        counts, word_links, unaligned = Counter(), Counter(), Counter()
+        for part in map_shards(partial(extract_shard, max_length=max_length), segments, align_path, workers):
+            for total, partial_counts in zip([counts, word_links, unaligned], part):
+                total.update(partial_counts)
+
+    # word translation probabilities w(zh | en), w(zh | NULL)
+    en_total = Counter()
+    for (e, _), c in word_links.items():
+        en_total[e] += c
+    word_p = {(e, f): c / en_total[e] for (e, f), c in word_links.items()}
+    null_total = sum(unaligned.values())
+    null_p = {f: c / null_total for f, c in unaligned.items()}
+
+    # pair count, alignment seen most often inside the pair
+    pairs = {}
+    for (src, tgt, inside), c in counts.items():
+        entry = pairs.setdefault((src, tgt), [0, inside, 0])
+        entry[0] += c
+        if c > entry[2]:
+            entry[1], entry[2] = inside, c
+
+    by_source = {}
+    for (src, tgt), (c, inside, _) in pairs.items():
+        if c < min_count and len(src) > 1:
+            continue
+        by_source.setdefault(src, []).append((tgt, c, lexical_weight(src, tgt, inside, word_p, null_p)))
+    sources = sorted(by_source, key=lambda src: src + (-1,) * (max_length - len(src)))
+
+    src_words = np.full((len(sources), max_length), -1, dtype=np.int32)
+    src_ptr = [0]
+    src_count = []
+    tgt_ptr = [0]
+    tgt_words = []
+    tgt_logp = []
+    tgt_lex = []
+    for p, src in enumerate(sources):
+        src_words[p, :len(src)] = src
+        src_count.append(sum(c for _, c, _ in by_source[src]))
+        top = sorted(by_source[src], key=lambda x: x[1], reverse=True)[:top_k]
+        total = sum(c for _, c, _ in top)
+        for tgt, c, lex in top:
+            tgt_words.extend(tgt)
+            tgt_ptr.append(len(tgt_words))
+            tgt_logp.append(math.log(c / total))
+            tgt_lex.append(lex)
+        src_ptr.append(len(tgt_logp))
+
+    arrays = {"src.words": src_words, "src.ptr": np.array(src_ptr, dtype=np.int64),
+              "src.count": np.array(src_count, dtype=np.int64),
+              "tgt.ptr": np.array(tgt_ptr, dtype=np.int64), "tgt.words": np.array(tgt_words, dtype=np.int32),
+              "tgt.logp": np.array(tgt_logp, dtype=np.float64), "tgt.lex": np.array(tgt_lex, dtype=np.float64)}
+    arrays.update(pack_strings(segments.words, "vocab"))
+    meta = {"max_length": max_length, "phrases": len(sources), "pairs": len(tgt_logp)}
+    return arrays, meta
+
+
+class PhraseTable:
+    '''
+    read-only view of a phrase table written by build_phrase_table
+        lookup(words, i): the phrases of the table starting at words[i]
+        translations(p): translations of phrase p, most frequent first, scored by
+            their lexical weight, i.e. on the same scale as a sequence of word
+            translations
+        confident(p): p is seen at least min_count times and its most frequent
+            translation has a relative frequency of at least min_p
+    '''
+    def __init__(self, store, min_count=20, min_p=0.2, memo_size=1 << 16):
+        if "src.count" not in store:
+            raise ValueError(f"{store.path} has no phrase counts, rebuild it with Dataset.build_phrase_table")
+        self.vocab = store.strings("vocab")
+        self.max_length = store.meta["max_length"]
+        self.src_words = store["src.words"]
+        self.src_ptr = store["src.ptr"]
+        self.src_count = store["src.count"]
+        self.tgt_ptr = store["tgt.ptr"]
+        self.tgt_words = store["tgt.words"]
+        self.tgt_logp = store["tgt.logp"]
+        self.tgt_lex = store["tgt.lex"]
+        self.min_count = min_count
+        self.min_logp = math.log(min_p)
+        self.memo = {}
+        self.memo_size = memo_size
+
+    def __len__(self):
+        return len(self.src_words)
+
+    def translations(self, p):
+        '''
+        return:
+            [(zh words(tuple), log lex), ...] of source phrase p
+        '''
+        result = self.memo.get(p)
+        if result is None:
+            if len(self.memo) >= self.memo_size:
+                self.memo.clear()
+            lo, hi = int(self.src_ptr[p]), int(self.src_ptr[p + 1])
+            ptr = self.tgt_ptr[lo:hi + 1].tolist()
+            words = self.tgt_words[ptr[0]:ptr[-1]].tolist()
+            result = self.memo[p] = [(tuple(self.vocab[k] for k in words[a - ptr[0]:b - ptr[0]]), lex)
+                                     for a, b, lex in zip(ptr, ptr[1:], self.tgt_lex[lo:hi].tolist())]
+        return result
+
+    def confident(self, p):
+        return self.src_count[p] >= self.min_count and self.tgt_logp[self.src_ptr[p]] >= self.min_logp
+
+    def lookup(self, words, i):
+        '''
+        param:
+            words(list): source sentence
+            i(int): start position
+        return:
+            [(end, p), ...] for every phrase p = words[i:end] in the table, shortest first
+        '''
+        spans = []
+        lo, hi = 0, len(self.src_words)
+        for k in range(min(self.max_length, len(words) - i)):
+            w = self.vocab.get(words[i + k])
+            if w < 0:
+                break
+            column = self.src_words[lo:hi, k]
+            lo, hi = lo + int(np.searchsorted(column, w, 'left')), lo + int(np.searchsorted(column, w, 'right'))
+            if lo == hi:
+                break
+            # the phrase of exactly k + 1 words sorts first, its next column is padding
+            if k + 1 == self.max_length or self.src_words[lo, k + 1] < 0:
+                spans.append((i + k + 1, lo))
+        return spans
@@ -0,0 +1,182 @@
+'''
+Tokenizer resources, set up once per process and usable offline. nltk and
+jieba are only imported here, on first use.
+
+- nltk punkt is looked up once and downloaded at most once (never with
+  MT_OFFLINE=1). The result is kept in the environment, so worker
+  processes don't look again. Without punkt, English is split by the
+  Treebank word tokenizer alone, i.e. without the sentence splitting
+  step of nltk.word_tokenize.
+- jieba's prefix dictionary is loaded from a cache of plain arrays
+  (JIEBA_CACHE, words as one utf-8 blob and their frequencies, read with
+  allow_pickle=False), about 4x faster than jieba's own marshal cache. It
+  lives in the per-user cache directory, created private (0700), so no
+  other user can plant it. warmup() loads it before the first cut, e.g. at
+  server start.
+'''
+
+import os
+import tempfile
+import zipfile
+from importlib.metadata import version, PackageNotFoundError
+
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache")),
+                         "machine_translation")
+JIEBA_CACHE = os.environ.get("MT_JIEBA_CACHE", os.path.join(CACHE_DIR, "jieba.npz"))
+PUNKT = ["punkt_tab", "punkt"]
+
+_punkt = None
+_word_tokenize = None
+_jieba = None
+
+
+def package_version(name):
+    '''
+    version without importing the package
+    '''
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return __import__(name).__version__
+
+
+def offline():
+    return os.environ.get("MT_OFFLINE", "") not in ("", "0")
+
+
+def find_punkt():
+    import nltk
+    for name in PUNKT:
+        try:
+            nltk.data.find(f"tokenizers/{name}")
+            return True
+        except LookupError:
+            continue
+    return False
+
+
+def ensure_punkt():
+    '''
+    return:
+        whether nltk.word_tokenize can be used, checked once per process tree
+    '''
+    global _punkt
+    if _punkt is None:
+        known = os.environ.get("MT_PUNKT")
+        if known is not None:
+            _punkt = known == "1"
+        else:
+            _punkt = find_punkt()
+            if not _punkt and not offline():
+                import nltk
+                for name in PUNKT:
+                    nltk.download(name, quiet=True)
+                _punkt = find_punkt()
+            if not _punkt:
+                print("nltk punkt Not Found, English is tokenized without sentence splitting.")
+            os.environ["MT_PUNKT"] = "1" if _punkt else "0"
+    return _punkt
+
+
+def word_tokenize(sentence):
+    global _word_tokenize
+    if _word_tokenize is None:
+        if ensure_punkt():
+            import nltk
+            _word_tokenize = nltk.word_tokenize
+        else:
+            from nltk.tokenize import NLTKWordTokenizer
+            _word_tokenize = NLTKWordTokenizer().tokenize
+    return _word_tokenize(sentence)
+
+
+def tokenizer_name():
+    '''
+    part of the segment cache key, the fallback tokenizer gives different tokens
+    '''
+    return f"nltk-{package_version('nltk')}" + ("" if ensure_punkt() else "-treebank")
+
+
+def jieba_key(jieba):
+    dictionary = jieba.dt.dictionary
+    stamp = os.path.getmtime(dictionary) if dictionary else 0
+    return f"jieba-{jieba.__version__}/{dictionary or 'default'}/{stamp}"
+
+
+def read_jieba_cache(path, key):
+    '''
+    return:
+        jieba FREQ(dict), total(int) from the cache, None if it is missing,
+        unreadable or was made for another dictionary
+    '''
+    import numpy as np
+    try:
+        with np.load(path, allow_pickle=False) as cache:
+            if str(cache["key"]) != key:
+                return None
+            words = cache["words"].tobytes().decode('utf-8').split('\n')
+            return dict(zip(words, cache["freq"].tolist())), int(cache["total"])
+    except (OSError, EOFError, KeyError, ValueError, UnicodeDecodeError, zipfile.BadZipFile):
+        return None
+
+
+def write_jieba_cache(path, key, freq, total):
+    '''
+    words are joined by newlines, jieba's dictionary is line based so no word
+    contains one
+    '''
+    import numpy as np
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as cache_file:
+        np.savez(cache_file, key=np.array(key), words=np.frombuffer("\n".join(freq).encode('utf-8'), dtype=np.uint8),
+                 freq=np.fromiter(freq.values(), dtype=np.int64, count=len(freq)), total=np.array(total))
+    os.replace(tmp_path, path)
+
+
+def load_jieba(path=None):
+    '''
+    fill jieba's prefix dictionary from the cache, (re)building the cache
+    when it is missing or was made for another dictionary
+    return:
+        the jieba module, initialized
+    '''
+    import jieba
+    path = path or JIEBA_CACHE
+    with jieba.dt.lock:
+        if jieba.dt.initialized:
+            return jieba
+        key = jieba_key(jieba)
+        cached = read_jieba_cache(path, key)
+        if cached is not None:
+            jieba.dt.FREQ, jieba.dt.total = cached
+            jieba.dt.initialized = True
+            return jieba
+        jieba.dt.initialize()
+        try:
+            write_jieba_cache(path, key, jieba.dt.FREQ, jieba.dt.total)
+        except OSError as e:
+            print("jieba cache not written:", repr(e))
+    return jieba
+
+
+def jieba_cut(sentence):
+    '''
+    jieba.cut(sentence), the dictionary is loaded on the first call
+    '''
+    global _jieba
+    if _jieba is None:
+        _jieba = load_jieba()
+    return _jieba.cut(sentence, cut_all=False)
+
+
+def warmup(punkt=True, jieba=False):
+    '''
+    load the tokenizers ahead of the first request, forked workers started
+    afterwards inherit them
+    '''
+    if punkt:
+        word_tokenize("warm up")
+    if jieba:
+        jieba_cut("预热")
@@ -0,0 +1,132 @@
+'''
+Segmentation cache: every corpus is tokenized once (nltk for English,
+lower-cased, jieba for Chinese) and stored as token-id arrays plus offsets
+in a preprocess.store file, keyed by the corpus file hash and the tokenizer
+version. The tokenizers come from preprocess.resources.
+'''
+
+import os
+import hashlib
+from functools import lru_cache
+from itertools import islice
+from multiprocessing import Pool
+from array import array
+import numpy as np
+from preprocess.store import Vocab, Store, write_store, pack_strings
+from preprocess import resources
+from profiling import profiler
+
+SEGMENT_VERSION = 1
+
+
+def tokenizer_version():
+    return f"segment-{SEGMENT_VERSION}/jieba-{resources.package_version('jieba')}/{resources.tokenizer_name()}"
+
+
+def tokenize_en(sentence):
+    return [w.lower() for w in resources.word_tokenize(sentence)]
+
+
+def cut_zh(sentence):
+    return list(resources.jieba_cut(sentence))
+
+
+@lru_cache(maxsize=65536)
+def cut_zh_cached(sentence):
+    '''
+    in-process memo for repeated sentences (metric targets, predictions)
+    '''
+    return tuple(cut_zh(sentence))
+
+
+def corpus_key(paths):
+    h = hashlib.sha1(tokenizer_version().encode('utf-8'))
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+class Segments:
+    '''
+    tokenized corpus, aligned with Dataset.get_all_item()
+        en(i): lower-cased English tokens of pair i
+        zh(i): Chinese words of pair i
+    the raw ids (en_ids / zh_ids + offsets) index into vocab
+    '''
+    def __init__(self, store):
+        self.path = store.path
+        self.vocab = store.strings("vocab")
+        self.words = list(self.vocab)
+        self.en_offsets = store["en.offsets"]
+        self.en_ids = store["en.ids"]
+        self.zh_offsets = store["zh.offsets"]
+        self.zh_ids = store["zh.ids"]
+
+    def __len__(self):
+        return len(self.en_offsets) - 1
+
+    def en(self, i):
+        return [self.words[k] for k in self.en_ids[self.en_offsets[i]:self.en_offsets[i + 1]].tolist()]
+
+    def zh(self, i):
+        return [self.words[k] for k in self.zh_ids[self.zh_offsets[i]:self.zh_offsets[i + 1]].tolist()]
+
+
+def tokenize_chunk(chunk):
+    return [(tokenize_en(pair['en']), cut_zh(pair['zh'])) for pair in chunk]
+
+
+def build_segments(data, path, workers=1, chunk_size=1000):
+    '''
+    param:
+        data(iterable): {'en': 'xxx', 'zh': 'yyy'} pairs, may be a stream
+        path(str): output store file
+        workers(int): tokenizer processes
+    '''
+    from tqdm import tqdm
+    data = iter(data)
+    chunks = iter(lambda: list(islice(data, chunk_size)), [])
+    vocab = Vocab()
+    streams = {"en": (array('i'), array('q', [0])), "zh": (array('i'), array('q', [0]))}
+
+    def add(tokenized):
+        for en_tokens, zh_tokens in tokenized:
+            for lang, tokens in [("en", en_tokens), ("zh", zh_tokens)]:
+                ids, offsets = streams[lang]
+                ids.extend(vocab.add(w) for w in tokens)
+                offsets.append(len(ids))
+
+    if workers > 1:
+        with Pool(workers) as pool:
+            for tokenized in tqdm(pool.imap(tokenize_chunk, chunks)):
+                add(tokenized)
+    else:
+        for chunk in tqdm(chunks):
+            add(tokenize_chunk(chunk))
+
+    arrays = pack_strings(vocab, "vocab")
+    for lang, (ids, offsets) in streams.items():
+        arrays[f"{lang}.ids"] = np.frombuffer(ids, dtype=np.int32)
+        arrays[f"{lang}.offsets"] = np.frombuffer(offsets, dtype=np.int64)
+    write_store(path, arrays, meta={"tokenizer": tokenizer_version()})
+
+
+def load_segments(paths, data, cache_dir, workers=1):
+    '''
+    param:
+        paths(list): corpus files the data was read from (cache key)
+        data(iterable): {'en': 'xxx', 'zh': 'yyy'} pairs, only read on a cache miss
+        cache_dir(str): where the segment files are kept
+        workers(int): processes used if the corpus has to be segmented
+    return:
+        Segments
+    '''
+    path = os.path.join(cache_dir, f"segments-{corpus_key(paths)}.bin")
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        print("segmenting corpus ...")
+        with profiler.timer("preprocess.segment"):
+            build_segments(data, path, workers)
+    return Segments(Store(path))
@@ -0,0 +1,342 @@
+'''
+Compact binary table store.
+
+File layout:
+    8 bytes    magic "MTSTORE1"
+    8 bytes    header length (little-endian uint64)
+    header     json {"meta": {...}, "arrays": {name: {"dtype", "shape", "offset"}}}
+    data       raw arrays, each aligned to 64 bytes, offsets relative to the
+               first aligned byte after the header
+
+Strings are interned into one vocabulary (utf-8 blob + offsets + an id
+permutation sorted by bytes for lookup), tables are CSR arrays of ids and
+log-probs. Store memory-maps the file read-only, so every worker process
+opening the same file shares the same pages.
+'''
+
+import os
+import json
+import math
+import mmap
+import struct
+from collections.abc import Mapping
+import numpy as np
+
+
+MAGIC = b"MTSTORE1"
+ALIGN = 64
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+class Vocab:
+    '''
+    intern strings to contiguous integer ids
+    '''
+    def __init__(self, words=()):
+        self.word2id = {}
+        self.id2word = []
+        for w in words:
+            self.add(w)
+
+    def add(self, word):
+        idx = self.word2id.get(word)
+        if idx is None:
+            idx = len(self.id2word)
+            self.word2id[word] = idx
+            self.id2word.append(word)
+        return idx
+
+    def get(self, word, default=-1):
+        return self.word2id.get(word, default)
+
+    def __getitem__(self, idx):
+        return self.id2word[idx]
+
+    def __iter__(self):
+        return iter(self.id2word)
+
+    def __len__(self):
+        return len(self.id2word)
+
+
+def build_csr(rows, n_rows, sort=True):
+    '''
+    pack {row_id: [(col_id, value), ...]} into CSR arrays
+    param:
+        rows(dict): row id -> list of (col id, value) pairs, value may be None
+        n_rows(int): number of rows (size of the row id space)
+        sort(bool): sort each row by column id, otherwise keep the given order
+    return:
+        indptr(np.int64), indices(np.int32), values(np.float64)
+    '''
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    for r, entries in rows.items():
+        indptr[r + 1] = len(entries)
+    np.cumsum(indptr, out=indptr)
+
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    values = np.zeros(indptr[-1], dtype=np.float64)
+    for r, entries in rows.items():
+        if sort:
+            entries = sorted(entries, key=lambda x: x[0])
+        start = indptr[r]
+        for k, (c, v) in enumerate(entries):
+            indices[start + k] = c
+            if v is not None:
+                values[start + k] = v
+    return indptr, indices, values
+
+
+def pack_strings(words, name):
+    '''
+    param:
+        words(list): id -> string
+        name(str): array name prefix
+    return:
+        {name.blob, name.offsets, name.order} arrays for write_store
+    '''
+    encoded = [w.encode('utf-8') for w in words]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded], dtype=np.int64)
+    blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    order = np.array(sorted(range(len(encoded)), key=lambda i: encoded[i]), dtype=np.int32)
+    return {f"{name}.blob": blob, f"{name}.offsets": offsets, f"{name}.order": order}
+
+
+def pack_csr(rows, n_rows, name, sort=True):
+    indptr, indices, values = build_csr(rows, n_rows, sort)
+    return {f"{name}.indptr": indptr, f"{name}.indices": indices, f"{name}.logp": values}
+
+
+def pack_vector(table, vocab, name):
+    '''
+    {col: p} -> sorted column ids and log-probs
+    '''
+    entries = sorted((vocab.add(w), math.log(p)) for w, p in table.items())
+    indices = np.array([i for i, _ in entries], dtype=np.int32)
+    logp = np.array([p for _, p in entries], dtype=np.float64)
+    return {f"{name}.indices": indices, f"{name}.logp": logp}
+
+
+def dict_table_rows(table, vocab):
+    '''
+    {row: {col: p}} -> {row id: [(col id, log p), ...]} for pack_csr
+    '''
+    rows = {}
+    for key in table:
+        rows[vocab.add(key)] = [(vocab.add(w), math.log(p)) for w, p in table[key].items()]
+    return rows
+
+
+def list_table_rows(table, vocab):
+    '''
+    {row: [[col, p], ...]} -> {row id: [(col id, log p), ...]} for pack_csr
+    '''
+    rows = {}
+    for key in table:
+        rows[vocab.add(key)] = [(vocab.add(w), math.log(p)) for w, p in table[key]]
+    return rows
+
+
+def write_store(path, arrays, meta=None):
+    '''
+    param:
+        path(str): output file
+        arrays(dict): name -> 1-d numpy array
+        meta(dict): json-serializable metadata
+    '''
+    header = {"meta": meta or {}, "arrays": {}}
+    offset = 0
+    for name, arr in arrays.items():
+        offset = _align(offset)
+        header["arrays"][name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+        offset += arr.nbytes
+    header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    base = _align(len(MAGIC) + 8 + len(header_bytes))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name, arr in arrays.items():
+            f.seek(base + header["arrays"][name]["offset"])
+            f.write(np.ascontiguousarray(arr).tobytes())
+    os.replace(tmp_path, path)
+
+
+class Store:
+    '''
+    read-only, memory-mapped view of a file written by write_store
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a table store")
+        header_len = struct.unpack("<Q", self._mmap[len(MAGIC):len(MAGIC) + 8])[0]
+        header = json.loads(self._mmap[len(MAGIC) + 8:len(MAGIC) + 8 + header_len].decode('utf-8'))
+        self._base = _align(len(MAGIC) + 8 + header_len)
+        self._arrays = header["arrays"]
+        self.meta = header["meta"]
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    def __getitem__(self, name):
+        info = self._arrays[name]
+        dtype = np.dtype(info["dtype"])
+        count = int(np.prod(info["shape"]))
+        if count == 0:
+            return np.empty(info["shape"], dtype=dtype)
+        arr = np.frombuffer(self._mmap, dtype=dtype, count=count, offset=self._base + info["offset"])
+        return arr.reshape(info["shape"])
+
+    def strings(self, name):
+        return StringTable(self[f"{name}.blob"], self[f"{name}.offsets"], self[f"{name}.order"])
+
+    def csr(self, name):
+        return self[f"{name}.indptr"], self[f"{name}.indices"], self[f"{name}.logp"]
+
+
+class StringTable:
+    '''
+    interned vocabulary backed by store arrays, lookups are a binary search
+    over the byte-sorted id permutation, so nothing is rebuilt on load; the
+    ids found are memoized (at most the vocabulary, unknown words are not
+    kept), the decoders ask for the same few hundred words over and over
+    '''
+    def __init__(self, blob, offsets, order):
+        self.blob = blob
+        self.offsets = offsets
+        self.order = order
+        self.ids = {}
+
+    def _bytes(self, idx):
+        return self.blob[self.offsets[idx]:self.offsets[idx + 1]].tobytes()
+
+    def __getitem__(self, idx):
+        return self._bytes(idx).decode('utf-8')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def get(self, word, default=-1):
+        idx = self.ids.get(word)
+        if idx is None:
+            idx = self._search(word)
+            if idx < 0:
+                return default
+            self.ids[word] = idx
+        return idx
+
+    def _search(self, word):
+        key = word.encode('utf-8')
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._bytes(self.order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.order) and self._bytes(self.order[lo]) == key:
+            return int(self.order[lo])
+        return -1
+
+
+class Row(Mapping):
+    '''
+    {col: p} view of one sorted CSR row, the probabilities are read into a
+    {col id: p} dict on the first lookup
+    '''
+    def __init__(self, indices, logp, vocab):
+        self.indices = indices
+        self.logp = logp
+        self.vocab = vocab
+        self.probs = None
+
+    def _probs(self):
+        if self.probs is None:
+            self.probs = dict(zip(self.indices.tolist(), np.exp(self.logp).tolist()))
+        return self.probs
+
+    def __getitem__(self, word):
+        p = self._probs().get(self.vocab.get(word))
+        if p is None:
+            raise KeyError(word)
+        return p
+
+    def __contains__(self, word):
+        return self.vocab.get(word) in self._probs()
+
+    def __iter__(self):
+        for i in self.indices:
+            yield self.vocab[int(i)]
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class DictTable(Mapping):
+    '''
+    {row: {col: p}} view of a CSR table with sorted rows
+    '''
+    def __init__(self, csr, vocab):
+        self.indptr, self.indices, self.logp = csr
+        self.vocab = vocab
+        self.rows = {}
+
+    def _span(self, word):
+        idx = self.vocab.get(word)
+        if idx < 0 or idx + 1 >= len(self.indptr) or self.indptr[idx] == self.indptr[idx + 1]:
+            raise KeyError(word)
+        return self.indptr[idx], self.indptr[idx + 1]
+
+    def __getitem__(self, word):
+        row = self.rows.get(word)
+        if row is None:
+            lo, hi = self._span(word)
+            row = self.rows[word] = Row(self.indices[lo:hi], self.logp[lo:hi], self.vocab)
+        return row
+
+    def __contains__(self, word):
+        if word in self.rows:
+            return True
+        idx = self.vocab.get(word)
+        return 0 <= idx < len(self.indptr) - 1 and bool(self.indptr[idx] != self.indptr[idx + 1])
+
+    def __iter__(self):
+        for i in np.flatnonzero(np.diff(self.indptr)):
+            yield self.vocab[int(i)]
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self.indptr)))
+
+    def col_max(self):
+        '''
+        largest log-prob of every column id over all rows, -inf if it never occurs
+        '''
+        best = np.full(len(self.vocab), -np.inf)
+        np.maximum.at(best, self.indices, self.logp)
+        return best
+
+
+class ListTable(DictTable):
+    '''
+    {row: [[col, p], ...]} view of a CSR table kept in the original order
+    '''
+    def __getitem__(self, word):
+        row = self.rows.get(word)
+        if row is None:
+            lo, hi = self._span(word)
+            row = self.rows[word] = [[self.vocab[i], math.exp(p)]
+                                     for i, p in zip(self.indices[lo:hi].tolist(), self.logp[lo:hi].tolist())]
+        return row
@@ -0,0 +1,193 @@
+'''
+Single-pass statistics builder: the corpus is split into contiguous shards,
+every shard is counted in a worker process (start words, 2-grams and the
+forward.align co-occurrences in both directions) and the partial counters
+are merged in shard order, so every table keeps the key order of the
+sequential builders in Dataset.
+'''
+
+from collections import Counter
+from itertools import islice
+from multiprocessing import Pool
+from array import array
+from preprocess.store import Store
+from preprocess.segment import Segments
+from profiling import profiler
+
+
+def read_lines(path, offset, n):
+    if path is None or n <= 0:
+        return []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return [line.decode('utf-8') for line in islice(f, n)]
+
+
+def line_offsets(path):
+    offsets = array('q', [0])
+    with open(path, 'rb') as f:
+        for line in f:
+            offsets.append(offsets[-1] + len(line))
+    return offsets
+
+
+def count_shard(args):
+    segments_path, lo, hi, align_path, align_offset, n_align = args
+    segments = Segments(Store(segments_path))
+    align_lines = read_lines(align_path, align_offset, n_align)
+
+    start = Counter()
+    bigram = {}
+    en2zh = {}
+    zh2en = {}
+    for k in range(lo, hi):
+        zh_seg_list = segments.zh(k)
+        start[zh_seg_list[0]] += 1
+        for i in range(len(zh_seg_list) - 1):
+            bigram.setdefault(zh_seg_list[i], Counter())[zh_seg_list[i + 1]] += 1
+
+        if k - lo >= len(align_lines):
+            continue
+        en_seg_list = segments.en(k)
+        for w in align_lines[k - lo].strip().split(' '):
+            if w == '':
+                continue
+            en = en_seg_list[int(w.split('-')[0])]
+            zh = zh_seg_list[int(w.split('-')[1])]
+            en2zh.setdefault(en, Counter())[zh] += 1
+            zh2en.setdefault(zh, Counter())[en] += 1
+    return start, bigram, en2zh, zh2en
+
+
+def merge(nested_counts):
+    merged = {}
+    for part in nested_counts:
+        for key, counter in part.items():
+            if key in merged:
+                merged[key].update(counter)
+            else:
+                merged[key] = counter
+    return merged
+
+
+def normalize(counter):
+    total = sum(counter.values())
+    return {w: c / total for w, c in counter.items()}
+
+
+def smooth(counts, method, add_k=0.1):
+    '''
+    add-k / Witten-Bell smoothing of a conditional table
+    param:
+        counts(dict): {w1: {w2: count}}
+        method(str): "add-k" / "witten-bell"
+        add_k(float): add-k pseudo count
+    return:
+        table {w1: {w2: p}} over the seen pairs (same key order as counts),
+        backoff {w1: weight}, unigram {w2: p}: an unseen pair (w1, w2) gets
+        backoff.get(w1, 1.0) * unigram[w2]
+    '''
+    column = Counter()
+    for row in counts.values():
+        column.update(row)
+    table = {}
+    backoff = {}
+    if method == "add-k":
+        V = len(column)
+        unigram = {w: 1 / V for w in column}
+        for w1, row in counts.items():
+            denom = sum(row.values()) + add_k * V
+            table[w1] = {w2: (c + add_k) / denom for w2, c in row.items()}
+            backoff[w1] = add_k * V / denom
+    elif method == "witten-bell":
+        unigram = normalize(column)
+        for w1, row in counts.items():
+            T = len(row)
+            denom = sum(row.values()) + T
+            table[w1] = {w2: (c + T * unigram[w2]) / denom for w2, c in row.items()}
+            backoff[w1] = T / denom
+    else:
+        raise ValueError(f"unknown smoothing {method}")
+    return table, backoff, unigram
+
+
+def top_10(counter):
+    return sorted(counter.items(), key=lambda x: x[1], reverse=True)[:10]
+
+
+def map_shards(function, segments, align_path, workers=1):
+    '''
+    param:
+        function: called with (segments path, lo, hi, align_path, byte offset of
+            alignment line lo, number of alignment lines) for every shard
+    return:
+        the results of the shards, in corpus order
+    '''
+    n = len(segments)
+    n_shards = max(1, min(n, workers * 4))
+    bounds = [n * s // n_shards for s in range(n_shards + 1)]
+    offsets = line_offsets(align_path) if align_path is not None else array('q', [0])
+    n_align = len(offsets) - 1
+    shards = [(segments.path, lo, hi, align_path, offsets[min(lo, n_align)], min(hi, n_align) - lo)
+              for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+    if workers > 1:
+        with Pool(workers) as pool:
+            return pool.map(function, shards)
+    return [function(shard) for shard in shards]
+
+
+def count_corpus(segments, align_path, workers=1):
+    '''
+    param:
+        segments(Segments): tokenized corpus (Dataset.get_segments)
+        align_path(str): forward.align, None if there is none
+        workers(int): number of processes, each shard reads its own part of
+            the segments / alignment files, so memory stays bounded
+    return:
+        start(Counter), bigram(dict of Counter), en2zh(dict of Counter), zh2en(dict of Counter)
+    '''
+    partials = map_shards(count_shard, segments, align_path, workers)
+
+    start = Counter()
+    for p in partials:
+        start.update(p[0])
+    bigram, en2zh, zh2en = (merge(p[i] for p in partials) for i in range(1, 4))
+    return start, bigram, en2zh, zh2en
+
+
+def build_tables(segments, align_path, workers=1, smoothing=None, add_k=0.1):
+    '''
+    param:
+        smoothing(str): None / "add-k" / "witten-bell" for HMM_A and HMM_B,
+            adds "HMM_A_backoff" and "HMM_B_backoff" (see smooth)
+    return:
+        {"HMM_PI": ..., "HMM_A": ..., "language_model": ...} and, if
+        align_path is given, "HMM_B", "map" and "translate_table", in the
+        same format as the Dataset.generate_* / build_* methods
+    '''
+    with profiler.timer("preprocess.count"):
+        start, bigram, en2zh, zh2en = count_corpus(segments, align_path, workers)
+    if profiler.enabled:
+        profiler.count("preprocess.sentences", len(segments))
+
+    start_p = normalize(start)
+    bigram_p = {w: normalize(c) for w, c in bigram.items()}
+    tables = {"HMM_PI": start_p, "HMM_A": bigram_p,
+              "language_model": {"start_word": start_p, "2-gram": bigram_p}}
+    if smoothing is not None:
+        tables["HMM_A"], backoff, unigram = smooth(bigram, smoothing, add_k)
+        tables["HMM_A_backoff"] = {"smoothing": smoothing, "backoff": backoff, "unigram": unigram}
+    if align_path is not None:
+        tables["HMM_B"] = {zh: normalize(dict(top_10(c))) for zh, c in zh2en.items()}
+        if smoothing is not None:
+            tables["HMM_B"], backoff, unigram = smooth({zh: dict(top_10(c)) for zh, c in zh2en.items()}, smoothing, add_k)
+            tables["HMM_B_backoff"] = {"smoothing": smoothing, "backoff": backoff, "unigram": unigram}
+        tables["map"] = {en: [w for w, _ in top_10(c)] for en, c in en2zh.items()}
+        translate_table = {}
+        for en, c in en2zh.items():
+            top = top_10(c)
+            total = sum(n for _, n in top)
+            translate_table[en] = [[w, n / total] for w, n in top]
+        tables["translate_table"] = translate_table
+    return tables
@@ -0,0 +1,127 @@
+'''
+Opt-in instrumentation: per-stage timers and counters for the decoders and
+the preprocessing, exported as JSON or Prometheus text, and cProfile dumps
+of a sampled fraction of calls.
+
+Disabled by default, the hot paths only test `profiler.enabled`. Enable it
+with enable() or the environment (inherited by worker processes):
+    MT_PROFILE=1 MT_PROFILE_SAMPLE=0.01 MT_PROFILE_DIR=profiles
+
+A top-level module, so models/ and preprocess/ can be instrumented without
+importing the evaluation package.
+'''
+
+import os
+import time
+import random
+import cProfile
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+NULL_TIMER = nullcontext()
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = os.environ.get("MT_PROFILE", "") not in ("", "0")
+        self.sample_rate = float(os.environ.get("MT_PROFILE_SAMPLE", 0.0))
+        self.profile_dir = os.environ.get("MT_PROFILE_DIR", "profiles")
+        self.timers = {}
+        self.counters = Counter()
+        self.dumps = 0
+
+    def reset(self):
+        self.timers = {}
+        self.counters = Counter()
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def add_time(self, name, seconds, n=1):
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [n, seconds]
+        else:
+            timer[0] += n
+            timer[1] += seconds
+
+    def timer(self, name):
+        '''
+        with profiler.timer("stage"): ..., a shared no-op context when disabled
+        '''
+        if not self.enabled:
+            return NULL_TIMER
+        return self.timed(name)
+
+    @contextmanager
+    def timed(self, name):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - begin)
+
+    def sample(self, name, function, *args):
+        '''
+        call function(*args), with probability sample_rate under cProfile,
+        the stats go to profile_dir/<name>-<pid>-<n>.pstats
+        '''
+        if not self.enabled or self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return function(*args)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            self.dumps += 1
+            profile.dump_stats(os.path.join(self.profile_dir, f"{name}-{os.getpid()}-{self.dumps}.pstats"))
+
+    def drain(self):
+        '''
+        return and reset the raw timers / counters, for merge() in another process
+        '''
+        state = (self.timers, self.counters)
+        self.reset()
+        return state
+
+    def merge(self, state):
+        timers, counters = state
+        for name, (n, t) in timers.items():
+            self.add_time(name, t, n)
+        self.counters.update(counters)
+
+    def snapshot(self):
+        return {"timers": {name: {"count": n, "total s": t, "mean ms": t / n * 1000 if n else 0.0}
+                           for name, (n, t) in sorted(self.timers.items())},
+                "counters": dict(sorted(self.counters.items()))}
+
+    def prometheus(self, prefix="mt"):
+        lines = [f"# TYPE {prefix}_stage_seconds_total counter",
+                 f"# TYPE {prefix}_stage_calls_total counter"]
+        for name, (n, t) in sorted(self.timers.items()):
+            lines.append(f'{prefix}_stage_seconds_total{{stage="{name}"}} {t}')
+            lines.append(f'{prefix}_stage_calls_total{{stage="{name}"}} {n}')
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        for name, n in sorted(self.counters.items()):
+            lines.append(f'{prefix}_events_total{{name="{name}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+
+profiler = Profiler()
+
+
+def enable(sample_rate=0.0, profile_dir="profiles"):
+    '''
+    also sets the environment, so worker processes started afterwards are instrumented too
+    '''
+    profiler.enabled = True
+    profiler.sample_rate = sample_rate
+    profiler.profile_dir = profile_dir
+    os.environ["MT_PROFILE"] = "1"
+    os.environ["MT_PROFILE_SAMPLE"] = str(sample_rate)
+    os.environ["MT_PROFILE_DIR"] = profile_dir
+
+
+def disable():
+    profiler.enabled = False
+    os.environ.pop("MT_PROFILE", None)
@@ -1,10 +1,14 @@
+import os
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset,DataLoader
-import sys
-sys.path.append("../preprocess/")
-import dataset as dd
-import jieba
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Dataset,IterableDataset,DataLoader,Sampler,BatchSampler,SequentialSampler
+import numpy as np
+from array import array
+from preprocess.segment import corpus_key, cut_zh_cached
+from preprocess.store import Store, write_store, pack_strings
+from profiling import profiler
 import time
 
 class MyDataset(Dataset):
@@ -19,7 +23,7 @@ class MyDataset(Dataset):
         ch = self.ch_data[index]
 
         en_index = [self.en_word_2_index[i] for i in en.split()]
-        ch_index = [self.ch_word_2_index[i] for i in jieba.cut(ch)]
+        ch_index = [self.ch_word_2_index[i] for i in cut_zh_cached(ch)]
 
         return en_index,ch_index
 
@@ -53,14 +57,126 @@ class MyDataset(Dataset):
         return len(self.ch_data)
 
 
+class StreamDataset(IterableDataset):
+    '''
+    reads the pairs from a streaming preprocess Dataset, so the corpus is never held in memory
+    '''
+    def __init__(self,dst,en_word_2_index,ch_word_2_index):
+        self.dst = dst
+        self.en_word_2_index = en_word_2_index
+        self.ch_word_2_index = ch_word_2_index
+
+    def __iter__(self):
+        segments = self.dst.get_segments()
+        for k, pair in enumerate(self.dst.iter_items()):
+            en_index = [self.en_word_2_index[i] for i in pair["en"].split()]
+            ch_index = [self.ch_word_2_index[i] for i in segments.zh(k)]
+            yield en_index,ch_index
+
+    batch_data_process = MyDataset.batch_data_process
+
+
+class TokenDataset(Dataset):
+    '''
+    pre-tensorized corpus: the int32 token ids of all sentences concatenated,
+    plus offsets, items are sentence indexes and the collate builds the padded batch
+    '''
+    def __init__(self,en_ids,en_offsets,ch_ids,ch_offsets,en_word_2_index,ch_word_2_index):
+        self.en_ids = en_ids
+        self.en_offsets = en_offsets
+        self.ch_ids = ch_ids
+        self.ch_offsets = ch_offsets
+        self.en_pad = en_word_2_index["<PAD>"]
+        self.ch_pad = ch_word_2_index["<PAD>"]
+        self.ch_bos = ch_word_2_index["<BOS>"]
+        self.ch_eos = ch_word_2_index["<EOS>"]
+
+    def __getitem__(self,index):
+        return index
+
+    def __len__(self):
+        return len(self.en_offsets) - 1
+
+    def lengths(self):
+        return np.maximum(np.diff(self.en_offsets), np.diff(self.ch_offsets))
+
+    def batch_data_process(self,indexes):
+        indexes = np.asarray(indexes)
+        en_begin, en_end = self.en_offsets[indexes], self.en_offsets[indexes + 1]
+        ch_begin, ch_end = self.ch_offsets[indexes], self.ch_offsets[indexes + 1]
+
+        en_index = np.full((len(indexes), (en_end - en_begin).max()), self.en_pad, dtype = np.int64)
+        ch_index = np.full((len(indexes), (ch_end - ch_begin).max() + 2), self.ch_pad, dtype = np.int64)
+        ch_index[:, 0] = self.ch_bos
+        for row in range(len(indexes)):
+            en_len = en_end[row] - en_begin[row]
+            ch_len = ch_end[row] - ch_begin[row]
+            en_index[row, :en_len] = self.en_ids[en_begin[row]:en_end[row]]
+            ch_index[row, 1:ch_len + 1] = self.ch_ids[ch_begin[row]:ch_end[row]]
+            ch_index[row, ch_len + 1] = self.ch_eos
+
+        return torch.from_numpy(en_index),torch.from_numpy(ch_index)
+
+
+class BucketBatchSampler(Sampler):
+    '''
+    shuffles the corpus, sorts pools of pool_size batches by length and cuts
+    them into batches, so a batch holds sentences of similar length; the
+    batch order is shuffled again
+    with torch.distributed initialized, every rank draws the same shuffle
+    (seed + epoch, see set_epoch) and takes every world_size-th batch, the
+    batch list is wrapped around so that all ranks run the same number of steps
+    '''
+    def __init__(self,lengths,batch_size,pool_size = 100,rank = None,world_size = None,seed = 0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        distributed = dist.is_available() and dist.is_initialized()
+        self.rank = rank if rank is not None else (dist.get_rank() if distributed else 0)
+        self.world_size = world_size if world_size is not None else (dist.get_world_size() if distributed else 1)
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self,epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = None
+        if self.world_size > 1:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+        indexes = torch.randperm(len(self.lengths), generator = generator).numpy()
+        pool = self.batch_size * self.pool_size
+        batches = []
+        for p in range(0, len(indexes), pool):
+            chunk = indexes[p:p + pool]
+            chunk = chunk[np.argsort(self.lengths[chunk], kind = "stable")]
+            batches += [chunk[b:b + self.batch_size].tolist() for b in range(0, len(chunk), self.batch_size)]
+        order = torch.randperm(len(batches), generator = generator).tolist()
+        # cycle the batch list, there may be fewer batches than ranks
+        total = len(self) * self.world_size
+        order = (order * -(-total // max(1, len(order))))[:total]
+        for b in order[self.rank::self.world_size]:
+            yield batches[b]
+
+    def __len__(self):
+        pool = self.batch_size * self.pool_size
+        n = len(self.lengths)
+        n_batches = (n // pool) * self.pool_size + -(-(n % pool) // self.batch_size)
+        return -(-n_batches // self.world_size)
+
+
 class Encoder(nn.Module):
     def __init__(self,encoder_embedding_num,encoder_hidden_num,en_corpus_len):
         super().__init__()
         self.embedding = nn.Embedding(en_corpus_len,encoder_embedding_num)
         self.lstm = nn.LSTM(encoder_embedding_num,encoder_hidden_num,batch_first=True)
 
-    def forward(self,en_index):
+    def forward(self,en_index,en_len=None):
         en_embedding = self.embedding(en_index)
+        if en_len is not None:
+            # skip the right padding, so a padded batch encodes like single sentences
+            en_embedding = nn.utils.rnn.pack_padded_sequence(en_embedding,en_len,batch_first=True,enforce_sorted=False)
         _,encoder_hidden =self.lstm(en_embedding)
 
         return encoder_hidden
@@ -101,66 +217,230 @@ class Seq2Seq(nn.Module):
         return loss
 
 class Model:
-    def __init__(self, encoding_embedding_num, encoding_hidden_num, decoder_embedding_num, decoder_hidden_num, batch_size):
-        data = dd.Dataset().get_all_item()
+    def __init__(self, encoding_embedding_num, encoding_hidden_num, decoder_embedding_num, decoder_hidden_num, batch_size, streaming = False, num_workers = 0, bucket = True):
+        '''
+        param:
+            streaming(bool): stream the training corpus from disk every epoch instead of keeping it in memory
+            num_workers(int): DataLoader worker processes
+            bucket(bool): shuffle and batch sentences of similar length together,
+                otherwise keep the corpus order
+        '''
+        self.exp_dir = "exps_seq2seq"
         self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        self.config = {"encoding_embedding_num": encoding_embedding_num, "encoding_hidden_num": encoding_hidden_num,
+                       "decoder_embedding_num": decoder_embedding_num, "decoder_hidden_num": decoder_hidden_num}
+        self.ch_counts = None
+        self.epoch = 0
+        # TranslationCache in front of translate / translate_batch, None to disable
+        self.cache = None
+        # the corpus reader is only needed for training, Model.load does not import it
+        from preprocess import dataset as dd
+        dst = dd.Dataset(streaming = streaming)
+        if streaming:
+            self.build_vocab(dst)
+            self.dataset = StreamDataset(dst, self.en_word_2_index, self.ch_word_2_index)
+            self.dataloader = DataLoader(self.dataset, batch_size, collate_fn = self.dataset.batch_data_process)
+        else:
+            self.dataset = self.load_token_dataset(dst)
+            if bucket:
+                sampler = BucketBatchSampler(self.dataset.lengths(), batch_size)
+            else:
+                sampler = BatchSampler(SequentialSampler(self.dataset), batch_size, drop_last = False)
+            self.dataloader = DataLoader(self.dataset, batch_sampler = sampler, collate_fn = self.dataset.batch_data_process,
+                                         num_workers = num_workers, pin_memory = self.device != "cpu")
+            self.ch_counts = np.bincount(self.dataset.ch_ids, minlength = len(self.ch_index_2_word))
+        en_corpus_len = len(self.en_index_2_word)
+        ch_corpus_len = len(self.ch_index_2_word)
+        self.model = Seq2Seq(encoding_embedding_num, encoding_hidden_num, en_corpus_len, decoder_embedding_num, decoder_hidden_num, ch_corpus_len)
+        self.model = self.model.to(self.device)
+
+    def build_vocab(self, dst, record = False):
+        '''
+        build the vocabularies in one pass over the corpus
+        param:
+            record(bool): also return the token ids, (en_ids, en_offsets, ch_ids, ch_offsets) arrays
+        '''
+        segments = dst.get_segments()
         self.ch_word_2_index = {}
         self.ch_index_2_word = []
-        self.ch_datas = []
         self.en_word_2_index = {}
         self.en_index_2_word = []
-        self.en_datas = []
+        en_ids, en_offsets = array('i'), array('q', [0])
+        ch_ids, ch_offsets = array('i'), array('q', [0])
         en_idx = 0
         ch_idx = 0
-        for pair in data:
+        for k, pair in enumerate(dst.iter_items()):
+            ch_words = segments.zh(k)
             for char in pair["en"].split():
                 if not self.en_word_2_index.__contains__(char):
                     self.en_word_2_index[char] = en_idx
                     self.en_index_2_word.append(char)
                     en_idx += 1
-            for char in jieba.cut(pair["zh"]):
+                if record:
+                    en_ids.append(self.en_word_2_index[char])
+            for char in ch_words:
                 if not self.ch_word_2_index.__contains__(char):
                     self.ch_word_2_index[char] = ch_idx
                     self.ch_index_2_word.append(char)
                     ch_idx += 1
-            self.ch_datas.append(pair["zh"])
-            self.en_datas.append(pair["en"])
+                if record:
+                    ch_ids.append(self.ch_word_2_index[char])
+            if record:
+                en_offsets.append(len(en_ids))
+                ch_offsets.append(len(ch_ids))
         ch_corpus_len = len(self.ch_word_2_index)
         en_corpus_len = len(self.en_word_2_index)
         self.ch_word_2_index.update({"<PAD>":ch_corpus_len, "<BOS>":ch_corpus_len + 1 , "<EOS>":ch_corpus_len+2})
         self.en_word_2_index.update({"<PAD>":en_corpus_len})
         self.ch_index_2_word += ["<PAD>","<BOS>","<EOS>"]
         self.en_index_2_word += ["<PAD>"]
-        ch_corpus_len += 3
-        en_corpus_len += 1
-        self.dataset = MyDataset(self.en_datas, self.ch_datas, self.en_word_2_index, self.ch_word_2_index)
-        self.dataloader = DataLoader(self.dataset, batch_size, shuffle = False, collate_fn = self.dataset.batch_data_process)
-        self.model = Seq2Seq(encoding_embedding_num, encoding_hidden_num, en_corpus_len, decoder_embedding_num, decoder_hidden_num, ch_corpus_len)
+        if record:
+            return (np.frombuffer(en_ids, dtype = np.int32), np.frombuffer(en_offsets, dtype = np.int64),
+                    np.frombuffer(ch_ids, dtype = np.int32), np.frombuffer(ch_offsets, dtype = np.int64))
+
+    def load_token_dataset(self, dst):
+        '''
+        the corpus is converted to token ids once and cached in exps_seq2seq,
+        keyed by the corpus files and tokenizer version
+        '''
+        path = os.path.join(self.exp_dir, f"tokens-{corpus_key(dst.corpus_files)}.bin")
+        if os.path.exists(path):
+            store = Store(path)
+            self.en_index_2_word = list(store.strings("en_vocab"))
+            self.ch_index_2_word = list(store.strings("ch_vocab"))
+            self.en_word_2_index = {w: i for i, w in enumerate(self.en_index_2_word)}
+            self.ch_word_2_index = {w: i for i, w in enumerate(self.ch_index_2_word)}
+            ids = (store["en.ids"], store["en.offsets"], store["ch.ids"], store["ch.offsets"])
+        else:
+            ids = self.build_vocab(dst, record = True)
+            arrays = {"en.ids": ids[0], "en.offsets": ids[1], "ch.ids": ids[2], "ch.offsets": ids[3]}
+            arrays.update(pack_strings(self.en_index_2_word, "en_vocab"))
+            arrays.update(pack_strings(self.ch_index_2_word, "ch_vocab"))
+            os.makedirs(self.exp_dir, exist_ok = True)
+            write_store(path, arrays)
+        return TokenDataset(*ids, self.en_word_2_index, self.ch_word_2_index)
+
+    @classmethod
+    def load(cls, path = "exps_seq2seq/checkpoint.pt", device = None):
+        '''
+        serving-only constructor: weights and vocabularies come from the
+        checkpoint, the corpus is not read and the model can not be trained
+        '''
+        self = cls.__new__(cls)
+        self.exp_dir = os.path.dirname(path)
+        self.device = device or ("cuda:0" if torch.cuda.is_available() else "cpu")
+        checkpoint = torch.load(path, map_location = self.device)
+        self.config = checkpoint["config"]
+        self.epoch = checkpoint["epoch"]
+        self.cache = None
+        self.dataset = None
+        self.dataloader = None
+        self.en_index_2_word = checkpoint["en_vocab"]
+        self.ch_index_2_word = checkpoint["ch_vocab"]
+        self.en_word_2_index = {w: i for i, w in enumerate(self.en_index_2_word)}
+        self.ch_word_2_index = {w: i for i, w in enumerate(self.ch_index_2_word)}
+        self.ch_counts = checkpoint["ch_counts"].numpy() if checkpoint["ch_counts"] is not None else None
+        c = self.config
+        self.model = Seq2Seq(c["encoding_embedding_num"], c["encoding_hidden_num"], len(self.en_index_2_word),
+                             c["decoder_embedding_num"], c["decoder_hidden_num"], len(self.ch_index_2_word))
+        self.model.load_state_dict(checkpoint["model"])
         self.model = self.model.to(self.device)
-    
-    def train(self, epoch, lr):
+        self.model.eval()
+        return self
+
+    def save(self, path = "exps_seq2seq/checkpoint.pt", opt = None):
+        '''
+        one file with the config, weights, optimizer state, epoch count and both vocabularies
+        '''
+        checkpoint = {"config": self.config,
+                      "epoch": self.epoch,
+                      "model": self.model.state_dict(),
+                      "optimizer": opt.state_dict() if opt is not None else None,
+                      "en_vocab": self.en_index_2_word,
+                      "ch_vocab": self.ch_index_2_word,
+                      "ch_counts": torch.from_numpy(self.ch_counts) if self.ch_counts is not None else None}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+        torch.save(checkpoint, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def train(self, epoch, lr, checkpoint = None):
+        '''
+        param:
+            epoch(int): total number of epochs
+            checkpoint(str): saved after every epoch; if it exists, training
+                resumes from it (weights, optimizer state and epoch count)
+        with torch.distributed initialized (seq2seq_ddp.py) every process trains
+        on its shard of the batches and rank 0 writes the checkpoint
+        '''
+        distributed = dist.is_available() and dist.is_initialized()
+        rank = dist.get_rank() if distributed else 0
+        if distributed and isinstance(self.dataset, StreamDataset):
+            raise ValueError("distributed training needs the in-memory dataset, not streaming")
+        # DistributedDataParallel all-reduces the gradients in backward, self.model keeps the plain weights
+        net = DistributedDataParallel(self.model) if distributed else self.model
         opt = torch.optim.Adam(self.model.parameters(), lr = lr)
+        start = 0
+        if checkpoint is not None and os.path.exists(checkpoint):
+            state = torch.load(checkpoint, map_location = self.device)
+            if state["en_vocab"] != self.en_index_2_word or state["ch_vocab"] != self.ch_index_2_word:
+                raise ValueError(f"{checkpoint} was trained on a different corpus")
+            self.model.load_state_dict(state["model"])
+            if state["optimizer"] is not None:
+                opt.load_state_dict(state["optimizer"])
+            self.epoch = start = state["epoch"]
+            if rank == 0:
+                print("resume from epoch", start)
+        self.model.train()
+        en_pad, ch_pad = self.en_word_2_index["<PAD>"], self.ch_word_2_index["<PAD>"]
         begin = time.time()
-        for e in range(epoch):
+        for e in range(start, epoch):
+            if hasattr(self.dataloader.batch_sampler, "set_epoch"):
+                self.dataloader.batch_sampler.set_epoch(e)
+            tokens = 0
             for en_idx, ch_idx in self.dataloader:
-                loss = self.model(en_idx, ch_idx)
+                tokens += int((en_idx != en_pad).sum()) + int((ch_idx != ch_pad).sum())
+                en_idx = en_idx.to(self.device, non_blocking = True)
+                ch_idx = ch_idx.to(self.device, non_blocking = True)
+                loss = net(en_idx, ch_idx)
                 loss.backward()
                 opt.step()
                 opt.zero_grad()
+            self.epoch += 1
+            if distributed:
+                tokens = torch.tensor(tokens)
+                dist.all_reduce(tokens)
+                tokens = int(tokens)
+            if checkpoint is not None and rank == 0:
+                self.save(checkpoint, opt)
             end = time.time()
-            print("Epoch", e+1, "time =", round(end - begin, 2))
+            if profiler.enabled:
+                profiler.add_time("seq2seq.train_epoch", end - begin)
+                profiler.count("seq2seq.train_tokens", tokens)
+            if rank == 0:
+                print("Epoch", e+1, "time =", round(end - begin, 2), "tokens/sec =", round(tokens / (end - begin)))
             begin = end
     
     def translate(self, sentence):
+        if self.cache is not None:
+            return self.cache.lookup(self.cache.sentence_key(sentence), lambda: self.greedy(sentence))
+        return self.greedy(sentence)
+
+    def greedy(self, sentence):
         en_index = torch.tensor([[self.en_word_2_index[i] for i in sentence.split()]],device = self.device)
         result = []
-        encoder_hidden = self.model.encoder(en_index)
+        with profiler.timer("seq2seq.encode"):
+            encoder_hidden = self.model.encoder(en_index)
         decoder_input = torch.tensor([[self.ch_word_2_index["<BOS>"]]],device = self.device)
         decoder_hidden = encoder_hidden
+        prof = profiler.enabled
         while True:
+            if prof:
+                step_begin = time.perf_counter()
             decoder_output, decoder_hidden = self.model.decoder(decoder_input,decoder_hidden)
             pre = self.model.classifier(decoder_output)
             w_index = int(torch.argmax(pre, dim=-1))
+            if prof:
+                profiler.add_time("seq2seq.decode_step", time.perf_counter() - step_begin)
             word = self.ch_index_2_word[w_index]
             if word == "<EOS>" or len(result) > 50:
                break
@@ -169,10 +449,102 @@ class Model:
 
         return "".join(result)
 
+    def translate_batch(self, sentences, beam_size = 1, batch_size = 64, max_len = 51):
+        '''
+        param:
+            sentences(list): ['aaa', 'bbb', 'ccc']
+            beam_size(int): 1 is greedy decoding, same output as translate
+            batch_size(int): sentences encoded / decoded together
+            max_len(int): maximum number of output words
+        return:
+            ['xxx', 'yyy', 'zzz']
+        '''
+        if self.cache is not None:
+            # beam search output depends on the beam size, greedy shares the entries of translate
+            prefix = [f"<beam {beam_size}>"] if beam_size != 1 else []
+            return self.cache.lookup_batch([self.cache.sentence_key(s, prefix) for s in sentences],
+                                           lambda missed: self.translate_batch_uncached([sentences[i] for i in missed], beam_size, batch_size, max_len))
+        return self.translate_batch_uncached(sentences, beam_size, batch_size, max_len)
+
+    def translate_batch_uncached(self, sentences, beam_size, batch_size, max_len):
+        results = [""] * len(sentences)
+        en_indexes = [[self.en_word_2_index[i] for i in s.split()] for s in sentences]
+        # sort by length to keep the padding small, empty sentences stay ""
+        order = sorted((i for i in range(len(sentences)) if en_indexes[i]), key = lambda i: len(en_indexes[i]))
+
+        self.model.eval()
+        with torch.no_grad():
+            for b in range(0, len(order), batch_size):
+                batch = order[b:b + batch_size]
+                for i, words in zip(batch, self.beam_search([en_indexes[i] for i in batch], beam_size, max_len)):
+                    results[i] = "".join(words)
+        return results
+
+    def beam_search(self, en_indexes, beam_size, max_len):
+        B, K = len(en_indexes), beam_size
+        ch_pad, bos, eos = self.ch_word_2_index["<PAD>"], self.ch_word_2_index["<BOS>"], self.ch_word_2_index["<EOS>"]
+
+        en_len = torch.tensor([len(i) for i in en_indexes])
+        en_index = torch.full((B, int(en_len.max())), self.en_word_2_index["<PAD>"], dtype = torch.long)
+        for i, idx in enumerate(en_indexes):
+            en_index[i, :len(idx)] = torch.tensor(idx)
+        with profiler.timer("seq2seq.encode"):
+            h, c = self.model.encoder(en_index.to(self.device), en_len)
+        # every sentence gets K beams, rows b * K ... b * K + K - 1
+        hidden = (h.repeat_interleave(K, dim = 1), c.repeat_interleave(K, dim = 1))
+
+        tokens = torch.full((B * K, max_len + 1), ch_pad, dtype = torch.long, device = self.device)
+        tokens[:, 0] = bos
+        next_tokens = torch.empty_like(tokens)
+        scores = torch.full((B, K), float("-inf"), device = self.device)
+        scores[:, 0] = 0
+        finished = torch.zeros(B * K, dtype = torch.bool, device = self.device)
+        base = (torch.arange(B, device = self.device) * K).unsqueeze(1)
+
+        prof = profiler.enabled
+        for t in range(max_len):
+            if prof:
+                step_begin = time.perf_counter()
+            decoder_output, hidden = self.model.decoder(tokens[:, t:t + 1], hidden)
+            log_p = torch.log_softmax(self.model.classifier(decoder_output[:, 0]), dim = -1)
+            # a finished beam only extends with <EOS> at no cost
+            log_p[finished] = float("-inf")
+            log_p[finished, eos] = 0
+            V = log_p.shape[-1]
+
+            scores, idx = (scores.view(-1, 1) + log_p).view(B, K * V).topk(K, dim = -1)
+            src = (base + torch.div(idx, V, rounding_mode = "floor")).view(-1)
+            word = (idx % V).view(-1)
+
+            hidden = (hidden[0][:, src], hidden[1][:, src])
+            torch.index_select(tokens, 0, src, out = next_tokens)
+            tokens, next_tokens = next_tokens, tokens
+            tokens[:, t + 1] = word
+            finished = finished[src] | (word == eos)
+            done = bool(finished.all())
+            if prof:
+                profiler.add_time("seq2seq.decode_step", time.perf_counter() - step_begin)
+            if done:
+                break
+
+        best = (base.view(-1) + scores.argmax(dim = -1)).tolist()
+        results = []
+        for row in tokens[best, 1:].tolist():
+            words = []
+            for w_index in row:
+                if w_index == eos:
+                    break
+                words.append(self.ch_index_2_word[w_index])
+            results.append(words)
+        return results
+
 
 if __name__ == "__main__":
-    m = Model(50, 100, 107, 100, 2)
-    m.train(40, 0.001)
+    checkpoint = "exps_seq2seq/checkpoint.pt"
+    m = Model.load(checkpoint) if os.path.exists(checkpoint) else None
+    if m is None or m.epoch < 40:
+        m = Model(50, 100, 107, 100, 2)
+        m.train(40, 0.001, checkpoint)
 
     while True:
         s = input("请输入英文: ")
@@ -0,0 +1,47 @@
+'''
+Data-parallel seq2seq training on one machine: N processes, gloo backend on
+localhost, each process trains on its shard of the batches and the gradients
+are all-reduced every step.
+
+    python seq2seq_ddp.py --procs 4 --epoch 40
+'''
+
+import os
+import argparse
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import seq2seq
+
+
+def worker(rank, args):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(args.port)
+    dist.init_process_group("gloo", rank=rank, world_size=args.procs)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.procs))
+    # same initial weights everywhere, DistributedDataParallel also broadcasts rank 0's
+    torch.manual_seed(args.seed)
+
+    # rank 0 builds the segment / token caches, the other ranks then read them
+    if rank != 0:
+        dist.barrier()
+    model = seq2seq.Model(50, 100, 107, 100, args.batch_size)
+    if rank == 0:
+        dist.barrier()
+
+    model.train(args.epoch, args.lr, args.checkpoint)
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--procs", type=int, default=os.cpu_count())
+    parser.add_argument("--epoch", type=int, default=40)
+    parser.add_argument("--lr", type=float, default=0.001)
+    parser.add_argument("--batch-size", type=int, default=2, help="per process")
+    parser.add_argument("--checkpoint", default="exps_seq2seq/checkpoint.pt")
+    parser.add_argument("--port", type=int, default=29500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    mp.spawn(worker, args=(args,), nprocs=args.procs)
@@ -0,0 +1,198 @@
+'''
+CPU serving export for seq2seq: the encoder and the single-step decoder are
+dynamically quantized to int8 (LSTM and Linear layers) and scripted into one
+TorchScript file together with the vocabularies, ExportedModel translates
+from that file without importing seq2seq or reading the corpus.
+
+    python seq2seq_export.py export --checkpoint exps_seq2seq/checkpoint.pt
+    python seq2seq_export.py bench --year 2010
+
+bench also exports the fp32 weights to TorchScript, so the file sizes compare
+the same format, and measures the resident memory of every variant after
+loading it in a fresh process.
+'''
+
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import time
+from typing import List, Tuple
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class InferenceModule(nn.Module):
+    '''
+    encoder + greedy decoding loop of a trained Seq2Seq, scriptable
+    '''
+    def __init__(self, seq2seq):
+        super().__init__()
+        self.en_embedding = seq2seq.encoder.embedding
+        self.encoder = seq2seq.encoder.lstm
+        self.ch_embedding = seq2seq.decoder.embedding
+        self.decoder = seq2seq.decoder.lstm
+        self.classifier = seq2seq.classifier
+
+    @torch.jit.export
+    def encode(self, en_index: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        _, (h, c) = self.encoder(self.en_embedding(en_index))
+        return h, c
+
+    @torch.jit.export
+    def step(self, token: torch.Tensor, h: torch.Tensor, c: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        decoder_output, (h, c) = self.decoder(self.ch_embedding(token), (h, c))
+        return self.classifier(decoder_output[:, 0]), h, c
+
+    def forward(self, en_index: torch.Tensor, bos: int, eos: int, max_len: int) -> List[int]:
+        '''
+        greedy decoding of one sentence (1, len), same stopping rule as
+        seq2seq.Model.translate
+        '''
+        h, c = self.encode(en_index)
+        token = torch.full([1, 1], bos, dtype=torch.long)
+        result: List[int] = []
+        for t in range(max_len):
+            pre, h, c = self.step(token, h, c)
+            w_index = int(torch.argmax(pre, dim=-1))
+            if w_index == eos:
+                break
+            result.append(w_index)
+            token = torch.full([1, 1], w_index, dtype=torch.long)
+        return result
+
+
+def export(model, path, quantize=True):
+    '''
+    param:
+        model(seq2seq.Model): trained model, e.g. seq2seq.Model.load(checkpoint)
+        path(str): TorchScript output file
+        quantize(bool): dynamic int8 quantization of the LSTM and Linear
+            layers, False exports the fp32 weights
+    '''
+    module = InferenceModule(copy.deepcopy(model.model).cpu()).eval()
+    if quantize:
+        module = torch.ao.quantization.quantize_dynamic(module, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+    scripted = torch.jit.script(module)
+    vocab = {"en_vocab": model.en_index_2_word, "ch_vocab": model.ch_index_2_word}
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    torch.jit.save(scripted, path, _extra_files={"vocab.json": json.dumps(vocab, ensure_ascii=False)})
+
+
+class ExportedModel:
+    '''
+    translation from an exported file, same interface as seq2seq.Model
+    (en_word_2_index, translate, translate_batch)
+    '''
+    def __init__(self, path, max_len=51):
+        extra_files = {"vocab.json": ""}
+        self.module = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+        self.module.eval()
+        vocab = json.loads(extra_files["vocab.json"])
+        self.en_index_2_word = vocab["en_vocab"]
+        self.ch_index_2_word = vocab["ch_vocab"]
+        self.en_word_2_index = {w: i for i, w in enumerate(self.en_index_2_word)}
+        self.ch_word_2_index = {w: i for i, w in enumerate(self.ch_index_2_word)}
+        self.max_len = max_len
+
+    def translate(self, sentence):
+        en_index = [self.en_word_2_index[i] for i in sentence.split()]
+        if not en_index:
+            return ""
+        with torch.no_grad():
+            result = self.module(torch.tensor([en_index]), self.ch_word_2_index["<BOS>"],
+                                 self.ch_word_2_index["<EOS>"], self.max_len)
+        return "".join(self.ch_index_2_word[i] for i in result)
+
+    def translate_batch(self, sentences):
+        return [self.translate(s) for s in sentences]
+
+
+def measure_load(kind, path):
+    '''
+    runs in a fresh process, torch and seq2seq are imported first so that
+    only the model is counted
+    param:
+        kind(str): "eager" (seq2seq.Model.load of a checkpoint) / "scripted" (ExportedModel)
+    return:
+        resident memory growth in bytes
+    '''
+    from benchmark import resident_memory
+    import seq2seq
+    rss = resident_memory()
+    model = seq2seq.Model.load(path, device="cpu") if kind == "eager" else ExportedModel(path)
+    growth = resident_memory() - rss
+    del model
+    return growth
+
+
+def load_memory(kind, path):
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(measure_load, (kind, path))
+
+
+def benchmark(models, sentences, targets):
+    '''
+    param:
+        models(dict): {name: object with translate(sentence)}
+        sentences(list): English sentences, words outside the vocabulary are dropped
+        targets(list): Chinese references
+    return:
+        {name: {"p50 ms", "p90 ms", "sentences/sec", "BLEU-1", "corpus BLEU-4"}}
+    '''
+    from evaluation.metric import Metric
+    metric = Metric()
+    report = {}
+    for name, model in models.items():
+        vocab = model.en_word_2_index
+        inputs = [" ".join(w for w in s.split() if w in vocab) for s in sentences]
+        preds, latencies = [], []
+        begin = time.perf_counter()
+        with torch.no_grad():
+            for s in inputs:
+                t = time.perf_counter()
+                preds.append(model.translate(s) if s else "")
+                latencies.append((time.perf_counter() - t) * 1000)
+        elapsed = time.perf_counter() - begin
+        report[name] = {"p50 ms": float(np.percentile(latencies, 50)),
+                        "p90 ms": float(np.percentile(latencies, 90)),
+                        "sentences/sec": len(inputs) / elapsed if elapsed > 0 else 0.0,
+                        "BLEU-1": metric.eval(pred=preds, target=targets)[1],
+                        "corpus BLEU-4": metric.bleu(pred=preds, target=targets)[1]}
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["export", "bench"])
+    parser.add_argument("--checkpoint", default="exps_seq2seq/checkpoint.pt")
+    parser.add_argument("--out", default="exps_seq2seq/seq2seq.int8.pt")
+    parser.add_argument("--fp32", action="store_true", help="export without quantization")
+    parser.add_argument("--year", type=int, default=2010, help="bench: test set")
+    args = parser.parse_args()
+
+    import seq2seq
+    model = seq2seq.Model.load(args.checkpoint, device="cpu")
+    if args.command == "export":
+        export(model, args.out, quantize=not args.fp32)
+        print("saved", args.out, os.path.getsize(args.out), "bytes")
+    else:
+        from preprocess.dataset import Dataset
+        if not os.path.exists(args.out):
+            export(model, args.out)
+        fp32_path = os.path.splitext(args.out)[0] + ".fp32.pt"
+        export(model, fp32_path, quantize=False)
+        test_data = Dataset(type="test", year=args.year).get_all_item()
+        report = benchmark({"fp32 eager": model, "fp32 scripted": ExportedModel(fp32_path),
+                            "int8 scripted": ExportedModel(args.out)},
+                           [pair["en"] for pair in test_data], [pair["zh"] for pair in test_data])
+        # same serialized format for both precisions; eager loads the whole checkpoint
+        report["fp32 scripted"]["file bytes"] = os.path.getsize(fp32_path)
+        report["int8 scripted"]["file bytes"] = os.path.getsize(args.out)
+        for name, kind, path in [("fp32 eager", "eager", args.checkpoint), ("fp32 scripted", "scripted", fp32_path),
+                                 ("int8 scripted", "scripted", args.out)]:
+            report[name]["resident MB after load"] = load_memory(kind, path) / (1 << 20)
+        print(json.dumps(report, indent=2))
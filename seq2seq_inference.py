@@ -0,0 +1,247 @@
+'''
+Inference helpers for seq2seq.Model: a fused single-step decoder that keeps
+the LSTM state between calls, and a per-sentence vocabulary shortlist taken
+from the alignment candidates in exps_HMM/map.json, so the output projection
+only runs over a few hundred rows instead of the whole Chinese vocabulary.
+'''
+
+import json
+import os
+import time
+import numpy as np
+import torch
+from profiling import profiler
+from preprocess.segment import tokenize_en
+
+
+class Shortlist:
+    '''
+    candidate output words of a sentence: the aligned translations of its
+    words plus the n_frequent most frequent Chinese words and <EOS>
+    '''
+    def __init__(self, en_index_2_word, ch_word_2_index, map_path="exps_HMM/map.json", frequent=None):
+        '''
+        param:
+            en_index_2_word(list): seq2seq source vocabulary
+            ch_word_2_index(dict): seq2seq target vocabulary
+            map_path(str): {en word: [zh words]}, keys are lower-cased nltk tokens; a
+                source word split on whitespace only ("world.") gets the candidates
+                of its nltk tokens ("world", ".")
+            frequent(list): target ids that are always kept
+        '''
+        if not os.path.exists(map_path):
+            print(f"{map_path} Not Found, the shortlist only has the frequent words.")
+            candidates = {}
+        else:
+            with open(map_path, 'r', encoding='utf8') as json_file:
+                candidates = json.load(json_file)
+
+        self.always = np.unique(np.array(list(frequent or []) + [ch_word_2_index["<EOS>"]], dtype=np.int64))
+        self.candidates = []
+        for w in en_index_2_word:
+            tokens = [w.lower()] if w.lower() in candidates or not candidates else tokenize_en(w)
+            ids = [ch_word_2_index[zh] for token in tokens for zh in candidates.get(token, []) if zh in ch_word_2_index]
+            self.candidates.append(np.unique(np.array(ids, dtype=np.int64)))
+
+    @classmethod
+    def from_model(cls, model, map_path="exps_HMM/map.json", n_frequent=300):
+        '''
+        the frequent words are counted on the pre-tensorized training corpus
+        (kept in the checkpoint), a streaming model only gets the aligned candidates
+        '''
+        frequent = []
+        if model.ch_counts is not None and n_frequent > 0:
+            frequent = np.argsort(-model.ch_counts, kind="stable")[:n_frequent].tolist()
+        return cls(model.en_index_2_word, model.ch_word_2_index, map_path, frequent)
+
+    def rows(self, en_indexes):
+        '''
+        param:
+            en_indexes(list): source ids of one sentence
+        return:
+            sorted target ids (np.array)
+        '''
+        return np.unique(np.concatenate([self.always] + [self.candidates[i] for i in en_indexes]))
+
+    def batch_rows(self, batch):
+        '''
+        param:
+            batch(list): source ids of every sentence
+        return:
+            rows (batch, R) the sorted target ids of every sentence, padded by
+            repeating its first id, pad (batch, R) True on the padding
+        '''
+        per_sentence = [self.rows(en_indexes) for en_indexes in batch]
+        R = max(len(r) for r in per_sentence)
+        rows = np.empty((len(batch), R), dtype=np.int64)
+        pad = np.zeros((len(batch), R), dtype=bool)
+        for i, r in enumerate(per_sentence):
+            rows[i, :len(r)] = r
+            rows[i, len(r):] = r[0]
+            pad[i, len(r):] = True
+        return rows, pad
+
+
+class StepDecoder:
+    '''
+    one decoder step as embedding lookup + one fused LSTM cell matmul +
+    projection over the selected rows only; weights are read from the
+    trained Seq2Seq once, so retrain means building a new StepDecoder
+    '''
+    def __init__(self, seq2seq):
+        decoder = seq2seq.decoder
+        lstm = decoder.lstm
+        with torch.no_grad():
+            self.embedding = decoder.embedding.weight.detach()
+            # gates = [x, h] @ [W_ih, W_hh]^T + b_ih + b_hh, gate order i, f, g, o
+            self.weight = torch.cat([lstm.weight_ih_l0, lstm.weight_hh_l0], dim=1).t().contiguous()
+            self.bias = (lstm.bias_ih_l0 + lstm.bias_hh_l0).detach()
+            self.out_weight = seq2seq.classifier.weight.detach()
+            self.out_bias = seq2seq.classifier.bias.detach()
+        self.encoder = seq2seq.encoder
+        self.hidden_num = lstm.hidden_size
+
+    def init_state(self, en_index, en_len=None):
+        '''
+        return:
+            (h, c), each (batch, hidden)
+        '''
+        h, c = self.encoder(en_index, en_len)
+        return h[0], c[0]
+
+    def project(self, rows, pad=None):
+        '''
+        param:
+            rows(torch.tensor): (batch, R) target ids kept for every sentence, None
+                for the full vocabulary
+            pad(torch.tensor): (batch, R) padding of rows, never predicted
+        return:
+            (weight, bias) of the output projection, (batch, R, hidden) and (batch, R)
+            with a shortlist
+        '''
+        if rows is None:
+            return self.out_weight, self.out_bias
+        bias = self.out_bias[rows]
+        if pad is not None:
+            bias = bias.masked_fill(pad, float("-inf"))
+        return self.out_weight[rows], bias
+
+    def step(self, tokens, state, projection):
+        '''
+        param:
+            tokens(torch.tensor): (batch,) previous words
+            state: (h, c) from init_state / the previous step
+            projection: from project()
+        return:
+            logits (batch, vocabulary) or (batch, R), new state
+        '''
+        h, c = state
+        x = torch.cat([self.embedding[tokens], h], dim=1)
+        gates = torch.addmm(self.bias, x, self.weight)
+        i, f, g, o = gates.chunk(4, dim=1)
+        c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+        h = torch.sigmoid(o) * torch.tanh(c)
+        weight, bias = projection
+        if weight.dim() == 3:
+            logits = torch.baddbmm(bias.unsqueeze(2), weight, h.unsqueeze(2)).squeeze(2)
+        else:
+            logits = torch.addmm(bias, h, weight.t())
+        return logits, (h, c)
+
+
+class Translator:
+    '''
+    greedy decoding with StepDecoder, without a shortlist the output is the
+    same as seq2seq.Model.translate / translate_batch
+    '''
+    def __init__(self, model, shortlist=None, max_len=51, cache=None):
+        '''
+        param:
+            model(seq2seq.Model): trained model
+            shortlist(Shortlist): None decodes over the full vocabulary
+            max_len(int): maximum number of output words
+            cache(TranslationCache): not shared with model.cache, the shortlist changes the output
+        '''
+        self.model = model
+        self.cache = cache
+        self.shortlist = shortlist
+        self.max_len = max_len
+        self.device = model.device
+        self.decoder = StepDecoder(model.model)
+        self.bos = model.ch_word_2_index["<BOS>"]
+        self.eos = model.ch_word_2_index["<EOS>"]
+
+    def translate(self, sentence):
+        return self.translate_batch([sentence])[0]
+
+    def translate_batch(self, sentences, batch_size=64):
+        '''
+        param:
+            sentences(list): ['aaa', 'bbb', 'ccc']
+        return:
+            ['xxx', 'yyy', 'zzz']
+        '''
+        if self.cache is not None:
+            return self.cache.lookup_batch([self.cache.sentence_key(s) for s in sentences],
+                                      lambda missed: self.translate_batch_uncached([sentences[i] for i in missed], batch_size))
+        return self.translate_batch_uncached(sentences, batch_size)
+
+    def translate_batch_uncached(self, sentences, batch_size=64):
+        results = [""] * len(sentences)
+        en_indexes = [[self.model.en_word_2_index[i] for i in s.split()] for s in sentences]
+        order = sorted((i for i in range(len(sentences)) if en_indexes[i]), key=lambda i: len(en_indexes[i]))
+
+        self.model.model.eval()
+        with torch.no_grad():
+            for b in range(0, len(order), batch_size):
+                batch = order[b:b + batch_size]
+                for i, words in zip(batch, self.greedy([en_indexes[i] for i in batch])):
+                    results[i] = "".join(words)
+        return results
+
+    def greedy(self, en_indexes):
+        B = len(en_indexes)
+        en_len = torch.tensor([len(i) for i in en_indexes])
+        en_index = torch.full((B, int(en_len.max())), self.model.en_word_2_index["<PAD>"], dtype=torch.long)
+        for i, idx in enumerate(en_indexes):
+            en_index[i, :len(idx)] = torch.tensor(idx)
+        with profiler.timer("seq2seq.encode"):
+            state = self.decoder.init_state(en_index.to(self.device), en_len)
+
+        # every sentence gets its own shortlist, its output does not depend on the batch
+        rows, pad = None, None
+        if self.shortlist is not None:
+            rows, pad = self.shortlist.batch_rows(en_indexes)
+            rows, pad = torch.from_numpy(rows).to(self.device), torch.from_numpy(pad).to(self.device)
+        projection = self.decoder.project(rows, pad)
+
+        tokens = torch.full((B,), self.bos, dtype=torch.long, device=self.device)
+        output = torch.empty((B, self.max_len), dtype=torch.long, device=self.device)
+        finished = torch.zeros(B, dtype=torch.bool, device=self.device)
+        steps = 0
+        prof = profiler.enabled
+        for t in range(self.max_len):
+            if prof:
+                step_begin = time.perf_counter()
+            logits, state = self.decoder.step(tokens, state, projection)
+            tokens = logits.argmax(dim=-1)
+            if rows is not None:
+                tokens = rows.gather(1, tokens.unsqueeze(1)).squeeze(1)
+            output[:, t] = tokens
+            steps += 1
+            finished |= tokens == self.eos
+            done = bool(finished.all())
+            if prof:
+                profiler.add_time("seq2seq.decode_step", time.perf_counter() - step_begin)
+            if done:
+                break
+
+        results = []
+        for row in output[:, :steps].tolist():
+            words = []
+            for w_index in row:
+                if w_index == self.eos:
+                    break
+                words.append(self.model.ch_index_2_word[w_index])
+            results.append(words)
+        return results
@@ -0,0 +1,318 @@
+'''
+Translation HTTP service: loads one model once and serves it with asyncio.
+Concurrent requests are collected into micro-batches (up to --max-batch
+sentences or --max-wait-ms) and decoded by evaluation.runner.Runner, i.e.
+batched seq2seq decoding or the HMM / MEM process pool.
+
+    python serve.py --model HMM --engine numpy --workers 4
+
+    POST /translate  {"text": "..."} or {"texts": ["...", ...]}
+    GET  /metrics    queue depth, batch size histogram, latency percentiles,
+                     ?format=prometheus for Prometheus text (with --profile the stage timers)
+    GET  /health
+'''
+
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from evaluation.runner import Runner
+from preprocess import resources
+import profiling
+
+MAX_BODY = 1 << 20
+
+
+class Metrics:
+    def __init__(self, window=10000):
+        self.begin = time.time()
+        self.requests = 0
+        self.rejected = 0
+        self.errors = 0
+        self.sentences = 0
+        self.batch_sizes = Counter()
+        # seconds, last `window` sentences
+        self.queue_wait = deque(maxlen=window)
+        self.latency = deque(maxlen=window)
+
+    def percentiles(self, values):
+        if not values:
+            return {}
+        values = np.array(values) * 1000
+        return {f"p{q} ms": float(np.percentile(values, q)) for q in (50, 90, 99)}
+
+    def report(self, queue):
+        return {"uptime s": time.time() - self.begin,
+                "requests": self.requests,
+                "rejected": self.rejected,
+                "errors": self.errors,
+                "sentences": self.sentences,
+                "queue depth": queue.qsize(),
+                "queue capacity": queue.maxsize,
+                "batch size histogram": {str(k): v for k, v in sorted(self.batch_sizes.items())},
+                "queue wait": self.percentiles(self.queue_wait),
+                "latency": self.percentiles(self.latency)}
+
+    def prometheus(self, queue, prefix="mt"):
+        lines = [f"{prefix}_requests_total {self.requests}",
+                 f"{prefix}_rejected_total {self.rejected}",
+                 f"{prefix}_errors_total {self.errors}",
+                 f"{prefix}_sentences_total {self.sentences}",
+                 f"{prefix}_queue_depth {queue.qsize()}"]
+        total = 0
+        for size in sorted(self.batch_sizes):
+            total += self.batch_sizes[size]
+            lines.append(f'{prefix}_batch_size_bucket{{le="{size}"}} {total}')
+        lines.append(f'{prefix}_batch_size_bucket{{le="+Inf"}} {total}')
+        for name, values in [("queue_wait", self.queue_wait), ("latency", self.latency)]:
+            for key, value in self.percentiles(values).items():
+                q = float(key.split()[0][1:]) / 100
+                lines.append(f'{prefix}_{name}_seconds{{quantile="{q}"}} {value / 1000}')
+        return "\n".join(lines) + "\n"
+
+
+class Batcher:
+    '''
+    queue of (sentence, future, enqueue time); `concurrency` loops each take
+    a micro-batch and translate it in a worker thread
+    '''
+    def __init__(self, runner, max_batch=32, max_wait_ms=10.0, max_queue=1024, concurrency=1):
+        self.runner = runner
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.metrics = Metrics()
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.loop()) for _ in range(self.concurrency)]
+
+    def submit(self, sentences):
+        '''
+        return:
+            futures, None if the queue has no room for all sentences (backpressure)
+        '''
+        if self.queue.maxsize - self.queue.qsize() < len(sentences):
+            self.metrics.rejected += 1
+            return None
+        loop = asyncio.get_running_loop()
+        futures = []
+        for sentence in sentences:
+            future = loop.create_future()
+            self.queue.put_nowait((sentence, future, time.perf_counter()))
+            futures.append(future)
+        return futures
+
+    async def collect(self):
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def translate(self, sentences):
+        return [pred for pred, _, _ in self.runner.iter_translate(sentences)]
+
+    async def loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect()
+            start = time.perf_counter()
+            self.metrics.batch_sizes[len(batch)] += 1
+            try:
+                preds = await loop.run_in_executor(self.executor, self.translate, [s for s, _, _ in batch])
+            except Exception as e:
+                self.metrics.errors += 1
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            end = time.perf_counter()
+            for (_, future, enqueued), pred in zip(batch, preds):
+                self.metrics.queue_wait.append(start - enqueued)
+                self.metrics.latency.append(end - enqueued)
+                if future.done():
+                    continue
+                if pred is None:
+                    # the model raised on this sentence (see evaluation.runner.translate_one)
+                    self.metrics.errors += 1
+                    future.set_exception(RuntimeError("translation failed"))
+                else:
+                    future.set_result(pred)
+            self.metrics.sentences += len(batch)
+
+
+class PayloadTooLarge(Exception):
+    pass
+
+
+async def read_request(reader):
+    '''
+    return:
+        method, path, headers(dict), body(bytes); None at end of stream
+    raise:
+        ValueError on a malformed request line / Content-Length,
+        PayloadTooLarge if the body is larger than MAX_BODY
+    '''
+    line = await reader.readline()
+    if not line:
+        return None
+    method, path, _ = line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length < 0:
+        raise ValueError("negative Content-Length")
+    if length > MAX_BODY:
+        raise PayloadTooLarge()
+    body = await reader.readexactly(length) if length else b''
+    return method, path, headers, body
+
+
+def response(status, payload, extra_headers=()):
+    reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+               500: "Internal Server Error", 503: "Service Unavailable"}
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    head = [f"HTTP/1.1 {status} {reasons[status]}", "Content-Type: application/json; charset=utf-8",
+            f"Content-Length: {len(body)}"] + list(extra_headers)
+    return ("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + body
+
+
+def text_response(text):
+    body = text.encode('utf-8')
+    head = ["HTTP/1.1 200 OK", "Content-Type: text/plain; version=0.0.4", f"Content-Length: {len(body)}"]
+    return ("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + body
+
+
+class Server:
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    async def handle(self, method, path, query, body):
+        metrics = self.batcher.metrics
+        if method == "GET" and path == "/health":
+            return response(200, {"status": "ok"})
+        if method == "GET" and path == "/metrics":
+            report = metrics.report(self.batcher.queue)
+            if query == "format=prometheus":
+                return text_response(metrics.prometheus(self.batcher.queue) +
+                                     (profiling.profiler.prometheus() if profiling.profiler.enabled else ""))
+            if profiling.profiler.enabled:
+                report["profile"] = profiling.profiler.snapshot()
+            return response(200, report)
+        if method != "POST" or path != "/translate":
+            return response(404, {"error": "not found"})
+
+        metrics.requests += 1
+        try:
+            request = json.loads(body.decode('utf-8'))
+            single = "text" in request
+            sentences = [request["text"]] if single else list(request["texts"])
+            if not all(isinstance(s, str) for s in sentences):
+                raise ValueError
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return response(400, {"error": 'expected {"text": "..."} or {"texts": ["...", ...]}'})
+
+        futures = self.batcher.submit(sentences)
+        if futures is None:
+            return response(503, {"error": "server busy"}, ["Retry-After: 1"])
+        try:
+            preds = await asyncio.gather(*futures)
+        except Exception as e:
+            return response(500, {"error": repr(e)})
+        return response(200, {"translation": preds[0]} if single else {"translations": preds})
+
+    async def connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except PayloadTooLarge:
+                    writer.write(response(413, {"error": "body too large"}, ["Connection: close"]))
+                    break
+                except ValueError:
+                    writer.write(response(400, {"error": "malformed request"}, ["Connection: close"]))
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                path, _, query = path.partition('?')
+                writer.write(await self.handle(method, path, query, body))
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def main(args, runner):
+    # the seq2seq runner decodes in this process, one batch at a time
+    concurrency = 1 if args.model == "seq2seq" else max(1, args.workers)
+    batcher = Batcher(runner, args.max_batch, args.max_wait_ms, args.max_queue, concurrency)
+    batcher.start()
+    server = await asyncio.start_server(Server(batcher).connection, args.host, args.port)
+    print(f"serving {args.model} on http://{args.host}:{args.port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="HMM", choices=["HMM", "MEM", "seq2seq"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="HMM / MEM processes")
+    parser.add_argument("--max-batch", type=int, default=32, help="sentences per micro-batch")
+    parser.add_argument("--max-wait-ms", type=float, default=10.0, help="time to fill a micro-batch")
+    parser.add_argument("--max-queue", type=int, default=1024, help="queued sentences before requests get 503")
+    parser.add_argument("--engine", default="python", choices=["python", "numpy"], help="HMM Viterbi decoder")
+    parser.add_argument("--compiled", action="store_true", help="use the compiled HMM.bin / MEM.bin tables")
+    parser.add_argument("--lm", default="bigram", choices=["bigram", "kn"], help="MEM: 2-gram tables or the Kneser-Ney exps_MEM/lm.bin")
+    parser.add_argument("--phrases", action="store_true", help="MEM: multi-word spans from exps_MEM/phrase_table.bin")
+    parser.add_argument("--beam-threshold", type=float, default=None, help="MEM: score margin to the best hypothesis, e.g. 10")
+    parser.add_argument("--distortion-limit", type=int, default=None, help="MEM: maximum reordering jump, e.g. 6")
+    parser.add_argument("--shortlist", action="store_true", help="seq2seq: restrict the output vocabulary")
+    parser.add_argument("--cache-size", type=int, default=0, help="translation cache entries per process")
+    parser.add_argument("--profile", action="store_true", help="stage timers / counters in /metrics")
+    parser.add_argument("--profile-sample", type=float, default=0.0, help="fraction of calls dumped as cProfile stats")
+    parser.add_argument("--profile-dir", default="profiles")
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable(args.profile_sample, args.profile_dir)
+
+    options = {}
+    if args.model == "HMM":
+        options = {"engine": args.engine, "compiled": args.compiled}
+    elif args.model == "MEM":
+        options = {"compiled": args.compiled, "lm": args.lm, "phrases": args.phrases,
+                   "beam_threshold": args.beam_threshold, "distortion_limit": args.distortion_limit}
+    elif args.model == "seq2seq":
+        options = {"shortlist": args.shortlist}
+
+    # tokenizer resources are looked up before the workers start, not on the first request
+    resources.warmup()
+    runner = Runner(args.model, args.workers, options, args.cache_size)
+    try:
+        asyncio.run(main(args, runner))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        runner.close()